@@ -89,6 +89,7 @@ class BadWords(callbacks.Privmsg):
             self.makeRegexp(self.words())
             self.lastModified = time.time()
 
+    outFilterCommands = ('PRIVMSG',)
     def outFilter(self, irc, msg):
         if self.filtering and msg.command == 'PRIVMSG' and self.words():
             self.updateRegexp()
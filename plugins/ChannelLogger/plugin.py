@@ -53,8 +53,6 @@ class ChannelLogger(callbacks.Plugin):
     def __init__(self, irc):
         self.__parent = super(ChannelLogger, self)
         self.__parent.__init__(irc)
-        self.lastMsgs = {}
-        self.lastStates = {}
         self.logs = {}
         self.flusher = self.flush
         world.flushers.append(self.flusher)
@@ -64,26 +62,10 @@ class ChannelLogger(callbacks.Plugin):
             log.close()
         world.flushers = [x for x in world.flushers if x is not self.flusher]
 
-    def __call__(self, irc, msg):
-        try:
-            # I don't know why I put this in, but it doesn't work, because it
-            # doesn't call doNick or doQuit.
-            # if msg.args and irc.isChannel(msg.args[0]):
-            self.__parent.__call__(irc, msg)
-            if irc in self.lastMsgs:
-                if irc not in self.lastStates:
-                    self.lastStates[irc] = irc.state.copy()
-                self.lastStates[irc].addMsg(irc, self.lastMsgs[irc])
-        finally:
-            # We must make sure this always gets updated.
-            self.lastMsgs[irc] = msg
-
     def reset(self):
         for log in self._logs():
             log.close()
         self.logs.clear()
-        self.lastMsgs.clear()
-        self.lastStates.clear()
 
     def _logs(self):
         for logs in self.logs.itervalues():
@@ -245,14 +227,11 @@ class ChannelLogger(callbacks.Plugin):
                    '*** %s changes topic to "%s"\n', msg.nick, msg.args[1])
 
     def doQuit(self, irc, msg):
-        if not isinstance(irc, irclib.Irc):
-            irc = irc.getRealIrc()
-        for (channel, chan) in self.lastStates[irc].channels.iteritems():
-            if msg.nick in chan.users:
-                self.doLog(irc, channel,
-                           '*** %s <%s> has quit IRC\n',
-                           msg.nick, msg.prefix)
+        for channel in msg.tagged('channels') or []:
+            self.doLog(irc, channel,
+                       '*** %s <%s> has quit IRC\n', msg.nick, msg.prefix)
 
+    outFilterCommands = ('PRIVMSG', 'NOTICE')
     def outFilter(self, irc, msg):
         # Gotta catch my own messages *somehow* :)
         # Let's try this little trick...
@@ -81,11 +81,18 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
         callbacks.Plugin.__init__(self, irc)
         plugins.ChannelDBHandler.__init__(self)
 
+    def die(self):
+        callbacks.Plugin.die(self)
+        plugins.ChannelDBHandler.die(self)
+
     def makeDb(self, filename):
-        if os.path.exists(filename):
-            return sqlite.connect(filename)
-        db = sqlite.connect(filename)
-        cursor = db.cursor()
+        exists = os.path.exists(filename)
+        db = plugins.openSqliteDatabase(filename)
+        if not exists:
+            db.submit(self._makeTables)
+        return db
+
+    def _makeTables(self, cursor):
         cursor.execute("""CREATE TABLE keys (
                           id INTEGER PRIMARY KEY,
                           key TEXT UNIQUE ON CONFLICT IGNORE,
@@ -104,8 +111,6 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
                             DELETE FROM factoids WHERE key_id = old.id;
                           END
                        """)
-        db.commit()
-        return db
 
     def getCommandHelp(self, command, simpleSyntax=None):
         method = self.getCommandMethod(command)
@@ -125,25 +130,25 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
                         name=callbacks.formatCommand(command))
         return super(Factoids, self).getCommandHelp(command, simpleSyntax)
 
-    def learn(self, irc, msg, args, channel, key, factoid):
-        db = self.getDb(channel)
-        cursor = db.cursor()
+    def _learn(self, cursor, key, name, factoid):
         cursor.execute("SELECT id, locked FROM keys WHERE key LIKE %s", key)
         if cursor.rowcount == 0:
             cursor.execute("""INSERT INTO keys VALUES (NULL, %s, 0)""", key)
-            db.commit()
             cursor.execute("SELECT id, locked FROM keys WHERE key LIKE %s",key)
         (id, locked) = map(int, cursor.fetchone())
-        capability = ircdb.makeChannelCapability(channel, 'factoids')
         if not locked:
-            if ircdb.users.hasUser(msg.prefix):
-                name = ircdb.users.getUser(msg.prefix).name
-            else:
-                name = msg.nick
             cursor.execute("""INSERT INTO factoids VALUES
                               (NULL, %s, %s, %s, %s)""",
                            id, name, int(time.time()), factoid)
-            db.commit()
+        return locked
+
+    def learn(self, irc, msg, args, channel, key, factoid):
+        if ircdb.users.hasUser(msg.prefix):
+            name = ircdb.users.getUser(msg.prefix).name
+        else:
+            name = msg.nick
+        db = self.getDb(channel)
+        if not db.transaction(self._learn, key, name, factoid):
             irc.replySuccess()
         else:
             irc.error('That factoid is locked.')
@@ -160,12 +165,11 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
 
     def _lookupFactoid(self, channel, key):
         db = self.getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT factoids.fact FROM factoids, keys
-                          WHERE keys.key LIKE %s AND factoids.key_id=keys.id
-                          ORDER BY factoids.id
-                          LIMIT 20""", key)
-        return [t[0] for t in cursor.fetchall()]
+        rows = db.query("""SELECT factoids.fact FROM factoids, keys
+                           WHERE keys.key LIKE %s AND factoids.key_id=keys.id
+                           ORDER BY factoids.id
+                           LIMIT 20""", key)
+        return [t[0] for t in rows]
 
     def _replyFactoids(self, irc, msg, key, factoids,
                        number=0, error=True):
@@ -230,9 +234,7 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
         sent in the channel itself.
         """
         db = self.getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("UPDATE keys SET locked=1 WHERE key LIKE %s", key)
-        db.commit()
+        db.execute("UPDATE keys SET locked=1 WHERE key LIKE %s", key)
         irc.replySuccess()
     lock = wrap(lock, ['channel', 'text'])
 
@@ -244,9 +246,7 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
         sent in the channel itself.
         """
         db = self.getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("UPDATE keys SET locked=0 WHERE key LIKE %s", key)
-        db.commit()
+        db.execute("UPDATE keys SET locked=0 WHERE key LIKE %s", key)
         irc.replySuccess()
     unlock = wrap(unlock, ['channel', 'text'])
 
@@ -270,37 +270,44 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
                 number = True
         key = ' '.join(words)
         db = self.getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT keys.id, factoids.id
-                          FROM keys, factoids
-                          WHERE key LIKE %s AND
-                                factoids.key_id=keys.id""", key)
-        if cursor.rowcount == 0:
+        results = db.query("""SELECT keys.id, factoids.id
+                              FROM keys, factoids
+                              WHERE key LIKE %s AND
+                                    factoids.key_id=keys.id""", key)
+        if not results:
             irc.error('There is no such factoid.')
-        elif cursor.rowcount == 1 or number is True:
-            (id, _) = cursor.fetchone()
-            cursor.execute("""DELETE FROM factoids WHERE key_id=%s""", id)
-            cursor.execute("""DELETE FROM keys WHERE key LIKE %s""", key)
-            db.commit()
+        elif len(results) == 1 or number is True:
+            (id, _) = results[0]
+            db.execute("""DELETE FROM factoids WHERE key_id=%s""", id)
+            db.execute("""DELETE FROM keys WHERE key LIKE %s""", key)
             irc.replySuccess()
         else:
             if number is not None:
-                results = cursor.fetchall()
                 try:
                     (_, id) = results[number-1]
                 except IndexError:
                     irc.error('Invalid factoid number.')
                     return
-                cursor.execute("DELETE FROM factoids WHERE id=%s", id)
-                db.commit()
+                db.execute("DELETE FROM factoids WHERE id=%s", id)
                 irc.replySuccess()
             else:
                 irc.error('%s factoids have that key.  '
                           'Please specify which one to remove, '
                           'or use * to designate all of them.' %
-                          cursor.rowcount)
+                          len(results))
     forget = wrap(forget, ['channel', many('something')])
 
+    def _random(self, cursor):
+        cursor.execute("""SELECT fact, key_id FROM factoids
+                          ORDER BY random()
+                          LIMIT 3""")
+        L = []
+        for (factoid, id) in cursor.fetchall():
+            cursor.execute("""SELECT key FROM keys WHERE id=%s""", id)
+            (key,) = cursor.fetchone()
+            L.append((key, factoid))
+        return L
+
     def random(self, irc, msg, args, channel):
         """[<channel>]
 
@@ -308,16 +315,10 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
         is only necessary if the message isn't sent in the channel itself.
         """
         db = self.getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT fact, key_id FROM factoids
-                          ORDER BY random()
-                          LIMIT 3""")
-        if cursor.rowcount != 0:
-            L = []
-            for (factoid, id) in cursor.fetchall():
-                cursor.execute("""SELECT key FROM keys WHERE id=%s""", id)
-                (key,) = cursor.fetchone()
-                L.append('"%s": %s' % (ircutils.bold(key), factoid))
+        factoids = db.read(self._random)
+        if factoids:
+            L = ['"%s": %s' % (ircutils.bold(key), factoid)
+                 for (key, factoid) in factoids]
             irc.reply('; '.join(L))
         else:
             irc.error('I couldn\'t find a factoid.')
@@ -331,16 +332,14 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
         itself.
         """
         db = self.getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("SELECT id, locked FROM keys WHERE key LIKE %s", key)
-        if cursor.rowcount == 0:
+        rows = db.query("SELECT id, locked FROM keys WHERE key LIKE %s", key)
+        if not rows:
             irc.error('No factoid matches that key.')
             return
-        (id, locked) = map(int, cursor.fetchone())
-        cursor.execute("""SELECT  added_by, added_at FROM factoids
-                          WHERE key_id=%s
-                          ORDER BY id""", id)
-        factoids = cursor.fetchall()
+        (id, locked) = map(int, rows[0])
+        factoids = db.query("""SELECT  added_by, added_at FROM factoids
+                               WHERE key_id=%s
+                               ORDER BY id""", id)
         L = []
         counter = 0
         for (added_by, added_at) in factoids:
@@ -363,20 +362,18 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
         <regexp>.
         """
         db = self.getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT factoids.id, factoids.fact
-                          FROM keys, factoids
-                          WHERE keys.key LIKE %s AND
-                                keys.id=factoids.key_id""", key)
-        if cursor.rowcount == 0:
+        results = db.query("""SELECT factoids.id, factoids.fact
+                              FROM keys, factoids
+                              WHERE keys.key LIKE %s AND
+                                    keys.id=factoids.key_id""", key)
+        if not results:
             irc.error(format('I couldn\'t find any key %q', key))
             return
-        elif cursor.rowcount < number:
+        elif len(results) < number:
             irc.errorInvalid('key id')
-        (id, fact) = cursor.fetchall()[number-1]
+        (id, fact) = results[number-1]
         newfact = replacer(fact)
-        cursor.execute("UPDATE factoids SET fact=%s WHERE id=%s", newfact, id)
-        db.commit()
+        db.execute("UPDATE factoids SET fact=%s WHERE id=%s", newfact, id)
         irc.replySuccess()
     change = wrap(change, ['channel', 'something',
                            'factoidId', 'regexpReplacer'])
@@ -393,10 +390,9 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
             raise callbacks.ArgumentError
         tables = ['keys']
         formats = []
-        criteria = []
+        criteria = ['1']
+        regexps = []
         target = 'keys.key'
-        predicateName = 'p'
-        db = self.getDb(channel)
         for (option, arg) in optlist:
             if option == 'values':
                 target = 'factoids.fact'
@@ -404,29 +400,29 @@ class Factoids(callbacks.Plugin, plugins.ChannelDBHandler):
                     tables.append('factoids')
                 criteria.append('factoids.key_id=keys.id')
             elif option == 'regexp':
-                criteria.append('%s(TARGET)' % predicateName)
-                def p(s, r=arg):
-                    return int(bool(r.search(s)))
-                db.create_function(predicateName, 1, p)
-                predicateName += 'p'
+                regexps.append(arg)
         for glob in globs:
             criteria.append('TARGET LIKE %s')
             formats.append(glob.translate(self._sqlTrans))
-        cursor = db.cursor()
-        sql = """SELECT keys.key FROM %s WHERE %s""" % \
+        # The regexps are matched here rather than with an SQL function,
+        # since the query is run on whichever of the database's connections
+        # is free.
+        sql = """SELECT keys.key, TARGET FROM %s WHERE %s""" % \
               (', '.join(tables), ' AND '.join(criteria))
         sql = sql.replace('TARGET', target)
-        cursor.execute(sql, formats)
-        if cursor.rowcount == 0:
+        db = self.getDb(channel)
+        results = [key for (key, s) in db.query(sql, *formats)
+                   if utils.iter.all(lambda r: r.search(s), regexps)]
+        if not results:
             irc.reply('No keys matched that query.')
-        elif cursor.rowcount == 1 and \
+        elif len(results) == 1 and \
              self.registryValue('showFactoidIfOnlyOneMatch', channel):
-            self.whatis(irc, msg, [channel, cursor.fetchone()[0]])
-        elif cursor.rowcount > 100:
+            self.whatis(irc, msg, [channel, results[0]])
+        elif len(results) > 100:
             irc.reply('More than 100 keys matched that query; '
                       'please narrow your query.')
         else:
-            keys = [repr(t[0]) for t in cursor.fetchall()]
+            keys = [repr(key) for key in results]
             s = format('%L', keys)
             irc.reply(s)
     search = wrap(search, ['channel',
@@ -55,6 +55,7 @@ class Filter(callbacks.Plugin):
         self.__parent.__init__(irc)
         self.outFilters = ircutils.IrcDict()
 
+    outFilterCommands = ('PRIVMSG',)
     def outFilter(self, irc, msg):
         if msg.command == 'PRIVMSG':
             if msg.args[0] in self.outFilters:
@@ -259,13 +259,10 @@ class Games(callbacks.Plugin):
         in the channel itself.
         """
         i = 0
-        for m in reversed(irc.state.history):
-            if m.command != 'PRIVMSG':
-                continue
+        for m in irc.state.history.scan(command='PRIVMSG', channel=channel,
+                                        reverse=True):
             if not m.prefix:
                 continue
-            if not ircutils.strEqual(m.args[0], channel):
-                continue
             if msg.prefix == m.prefix:
                 i += 1
             else:
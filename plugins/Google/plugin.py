@@ -79,6 +79,8 @@ class Google(callbacks.PluginRegexp):
         return ircutils.bold(ret)
 
     _googleRe = re.compile(r'\b(google)\b', re.I)
+    outFilterCommands = ('PRIVMSG',)
+    outFilterChannelValue = 'colorfulFilter'
     def outFilter(self, irc, msg):
         if msg.command == 'PRIVMSG' and \
            self.registryValue('colorfulFilter', msg.args[0]):
@@ -57,15 +57,15 @@ class Herald(callbacks.Plugin):
         self.__parent = super(Herald, self)
         self.__parent.__init__(irc)
         self.db = HeraldDB(filename)
-        world.flushers.append(self.db.flush)
+        world.flushers.append(self.db.snapshot)
         self.lastParts = plugins.ChannelUserDictionary()
         splitTimeout = conf.supybot.plugins.Herald.throttle.afterSplit
         self.splitters = TimeoutQueue(splitTimeout)
         self.lastHerald = plugins.ChannelUserDictionary()
 
     def die(self):
-        if self.db.flush in world.flushers:
-            world.flushers.remove(self.db.flush)
+        if self.db.snapshot in world.flushers:
+            world.flushers.remove(self.db.snapshot)
         self.db.close()
         self.__parent.die()
 
@@ -58,45 +58,41 @@ class SqliteKarmaDB(object):
         filename = plugins.makeChannelFilename(self.filename, channel)
         if filename in self.dbs:
             return self.dbs[filename]
-        if os.path.exists(filename):
-            self.dbs[filename] = sqlite.connect(filename)
-            return self.dbs[filename]
-        db = sqlite.connect(filename)
+        def setup(db):
+            def p(s1, s2):
+                return int(ircutils.nickEqual(s1, s2))
+            db.create_function('nickeq', 2, p)
+        exists = os.path.exists(filename)
+        db = plugins.openSqliteDatabase(filename, setup)
         self.dbs[filename] = db
-        cursor = db.cursor()
-        cursor.execute("""CREATE TABLE karma (
+        if not exists:
+            db.execute("""CREATE TABLE karma (
                           id INTEGER PRIMARY KEY,
                           name TEXT,
                           normalized TEXT UNIQUE ON CONFLICT IGNORE,
                           added INTEGER,
                           subtracted INTEGER
                           )""")
-        db.commit()
-        def p(s1, s2):
-            return int(ircutils.nickEqual(s1, s2))
-        db.create_function('nickeq', 2, p)
         return db
 
     def get(self, channel, thing):
         db = self._getDb(channel)
         thing = thing.lower()
-        cursor = db.cursor()
-        cursor.execute("""SELECT added, subtracted FROM karma
-                          WHERE normalized=%s""", thing)
-        if cursor.rowcount == 0:
+        rows = db.query("""SELECT added, subtracted FROM karma
+                           WHERE normalized=%s""", thing)
+        if not rows:
             return None
         else:
-            return map(int, cursor.fetchone())
+            return map(int, rows[0])
 
     def gets(self, channel, things):
         db = self._getDb(channel)
-        cursor = db.cursor()
         normalizedThings = dict(zip(map(lambda s: s.lower(), things), things))
         criteria = ' OR '.join(['normalized=%s'] * len(normalizedThings))
         sql = """SELECT name, added-subtracted FROM karma
                  WHERE %s ORDER BY added-subtracted DESC""" % criteria
-        cursor.execute(sql, *normalizedThings)
-        L = [(name, int(karma)) for (name, karma) in cursor.fetchall()]
+        rows = db.query(sql, *normalizedThings)
+        L = [(name, int(karma)) for (name, karma) in rows]
         for (name, _) in L:
             del normalizedThings[name.lower()]
         neutrals = normalizedThings.values()
@@ -105,56 +101,48 @@ class SqliteKarmaDB(object):
 
     def top(self, channel, limit):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT name, added-subtracted FROM karma
-                          ORDER BY added-subtracted DESC LIMIT %s""", limit)
-        return [(t[0], int(t[1])) for t in cursor.fetchall()]
+        rows = db.query("""SELECT name, added-subtracted FROM karma
+                           ORDER BY added-subtracted DESC LIMIT %s""", limit)
+        return [(t[0], int(t[1])) for t in rows]
 
     def bottom(self, channel, limit):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT name, added-subtracted FROM karma
-                          ORDER BY added-subtracted ASC LIMIT %s""", limit)
-        return [(t[0], int(t[1])) for t in cursor.fetchall()]
+        rows = db.query("""SELECT name, added-subtracted FROM karma
+                           ORDER BY added-subtracted ASC LIMIT %s""", limit)
+        return [(t[0], int(t[1])) for t in rows]
 
     def rank(self, channel, thing):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT added-subtracted FROM karma
-                          WHERE name=%s""", thing)
-        if cursor.rowcount == 0:
+        rows = db.query("""SELECT added-subtracted FROM karma
+                           WHERE name=%s""", thing)
+        if not rows:
             return None
-        karma = int(cursor.fetchone()[0])
-        cursor.execute("""SELECT COUNT(*) FROM karma
-                          WHERE added-subtracted > %s""", karma)
-        rank = int(cursor.fetchone()[0])
+        karma = int(rows[0][0])
+        rows = db.query("""SELECT COUNT(*) FROM karma
+                           WHERE added-subtracted > %s""", karma)
+        rank = int(rows[0][0])
         return rank+1
 
     def size(self, channel):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT COUNT(*) FROM karma""")
-        return int(cursor.fetchone()[0])
+        rows = db.query("""SELECT COUNT(*) FROM karma""")
+        return int(rows[0][0])
 
     def increment(self, channel, name):
         db = self._getDb(channel)
-        cursor = db.cursor()
         normalized = name.lower()
-        cursor.execute("""INSERT INTO karma VALUES (NULL, %s, %s, 0, 0)""",
-                       name, normalized)
-        cursor.execute("""UPDATE karma SET added=added+1
-                          WHERE normalized=%s""", normalized)
-        db.commit()
+        db.execute("""INSERT INTO karma VALUES (NULL, %s, %s, 0, 0)""",
+                   name, normalized)
+        db.execute("""UPDATE karma SET added=added+1
+                      WHERE normalized=%s""", normalized)
 
     def decrement(self, channel, name):
         db = self._getDb(channel)
-        cursor = db.cursor()
         normalized = name.lower()
-        cursor.execute("""INSERT INTO karma VALUES (NULL, %s, %s, 0, 0)""",
-                       name, normalized)
-        cursor.execute("""UPDATE karma SET subtracted=subtracted+1
-                          WHERE normalized=%s""", normalized)
-        db.commit()
+        db.execute("""INSERT INTO karma VALUES (NULL, %s, %s, 0, 0)""",
+                   name, normalized)
+        db.execute("""UPDATE karma SET subtracted=subtracted+1
+                      WHERE normalized=%s""", normalized)
 
     def most(self, channel, kind, limit):
         if kind == 'increased':
@@ -168,43 +156,41 @@ class SqliteKarmaDB(object):
         sql = """SELECT name, %s FROM karma ORDER BY %s DESC LIMIT %s""" % \
               (orderby, orderby, limit)
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute(sql)
-        return [(name, int(i)) for (name, i) in cursor.fetchall()]
+        return [(name, int(i)) for (name, i) in db.query(sql)]
 
     def clear(self, channel, name):
         db = self._getDb(channel)
-        cursor = db.cursor()
         normalized = name.lower()
-        cursor.execute("""UPDATE karma SET subtracted=0, added=0
-                          WHERE normalized=%s""", normalized)
-        db.commit()
+        db.execute("""UPDATE karma SET subtracted=0, added=0
+                      WHERE normalized=%s""", normalized)
 
     def dump(self, channel, filename):
         filename = conf.supybot.directories.data.dirize(filename)
         fd = utils.transactionalFile(filename)
         out = csv.writer(fd)
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT name, added, subtracted FROM karma""")
-        for (name, added, subtracted) in cursor.fetchall():
+        rows = db.query("""SELECT name, added, subtracted FROM karma""")
+        for (name, added, subtracted) in rows:
             out.writerow([name, added, subtracted])
         fd.close()
 
-    def load(self, channel, filename):
-        filename = conf.supybot.directories.data.dirize(filename)
-        fd = file(filename)
-        reader = csv.reader(fd)
-        db = self._getDb(channel)
-        cursor = db.cursor()
+    def _load(self, cursor, rows):
         cursor.execute("""DELETE FROM karma""")
-        for (name, added, subtracted) in reader:
+        for (name, added, subtracted) in rows:
             normalized = name.lower()
             cursor.execute("""INSERT INTO karma
                               VALUES (NULL, %s, %s, %s, %s)""",
                            name, normalized, added, subtracted)
-        db.commit()
-        fd.close()
+
+    def load(self, channel, filename):
+        filename = conf.supybot.directories.data.dirize(filename)
+        fd = file(filename)
+        try:
+            rows = list(csv.reader(fd))
+        finally:
+            fd.close()
+        db = self._getDb(channel)
+        db.transaction(self._load, rows)
 
 KarmaDB = plugins.DB('Karma',
                      {'sqlite': SqliteKarmaDB})
@@ -146,7 +146,7 @@ class Misc(callbacks.Plugin):
                 else:
                     irc.reply('There are no public plugins.')
         else:
-            commands = cb.listCommands()
+            commands = callbacks.getCommandTrie(irc.callbacks).listCommands(cb)
             if commands:
                 commands.sort()
                 irc.reply(format('%L', commands))
@@ -166,16 +166,13 @@ class Misc(callbacks.Plugin):
         Searches for <string> in the commands currently offered by the bot,
         returning a list of the commands containing that string.
         """
-        commands = {}
         L = []
-        for cb in irc.callbacks:
+        trie = callbacks.getCommandTrie(irc.callbacks)
+        for (cb, commands) in trie.commands:
             if isinstance(cb, callbacks.Plugin):
-                for command in cb.listCommands():
+                for command in commands:
                     if s in command:
-                        commands.setdefault(command, []).append(cb.name())
-        for (key, names) in commands.iteritems():
-            for name in names:
-                L.append('%s %s' % (name, key))
+                        L.append('%s %s' % (cb.name(), command))
         if L:
             L.sort()
             irc.reply(format('%L', L))
@@ -269,6 +266,9 @@ class Misc(callbacks.Plugin):
                msg.command == 'PRIVMSG' and \
                ircutils.isChannel(msg.args[0])
 
+    # How many messages last searches for its regexps at once; without
+    # --nolimit, it stops after the first chunk with a match, newest first.
+    regexpChunkSize = 50
     def last(self, irc, msg, args, optlist):
         """[--{from,in,on,with,without,regexp} <value>] [--nolimit]
 
@@ -281,12 +281,15 @@ class Misc(callbacks.Plugin):
         given in is searched.
         """
         predicates = {}
+        regexps = []
         nolimit = False
         skipfirst = True
         if ircutils.isChannel(msg.args[0]):
+            channel = msg.args[0]
             predicates['in'] = lambda m: ircutils.strEqual(m.args[0],
                                                            msg.args[0])
         else:
+            channel = None
             skipfirst = False
         for (option, arg) in optlist:
             if option == 'from':
@@ -297,6 +300,7 @@ class Misc(callbacks.Plugin):
                 def f(m, arg=arg):
                     return ircutils.strEqual(m.args[0], arg)
                 predicates['in'] = f
+                channel = arg
                 if arg != msg.args[0]:
                     skipfirst = False
             elif option == 'on':
@@ -312,18 +316,15 @@ class Misc(callbacks.Plugin):
                     return arg.lower() not in m.args[1].lower()
                 predicates.setdefault('without', []).append(f)
             elif option == 'regexp':
-                def f(m, arg=arg):
-                    if ircmsgs.isAction(m):
-                        m1 = ircmsgs.unAction(m)
-                    else:
-                        m1 = m.args[1]
-                    return regexp_wrapper(m1, reobj=arg, timeout=0.1,
-                                          plugin_name=self.name(),
-                                          fcn_name='last')
-                predicates.setdefault('regexp', []).append(f)
+                regexps.append(arg)
             elif option == 'nolimit':
                 nolimit = True
-        iterable = ifilter(self._validLastMsg, reversed(irc.state.history))
+        # Only the messages to the channel need to be looked at, and the
+        # history can find those without parsing the others.
+        iterable = ifilter(self._validLastMsg,
+                           irc.state.history.scan(command='PRIVMSG',
+                                                  channel=channel,
+                                                  reverse=True))
         if skipfirst:
             # Drop the first message only if our current channel is the same as
             # the channel we've been instructed to look at.
@@ -352,25 +353,53 @@ class Misc(callbacks.Plugin):
             showNick = False
         else:
             showNick = True
+        def searchRegexps(candidates):
+            # The regexps are user-supplied, so they're searched in the worker
+            # processes, a chunk of candidates at a time.
+            for reobj in regexps:
+                texts = []
+                for m in candidates:
+                    if ircmsgs.isAction(m):
+                        texts.append(ircmsgs.unAction(m))
+                    else:
+                        texts.append(m.args[1])
+                matched = regexp_batch(texts, reobj, timeout=0.1,
+                                       plugin_name=self.name(),
+                                       fcn_name='last')
+                candidates = [m for (m, b) in zip(candidates, matched) if b]
+            return candidates
+        found = []
+        chunk = []
         for m in iterable:
             for predicate in predicates:
                 if not predicate(m):
                     break
             else:
-                if nolimit:
-                    resp.append(ircmsgs.prettyPrint(m,
-                                                    timestampFormat=tsf,
-                                                    showNick=showNick))
+                if regexps:
+                    chunk.append(m)
+                    if len(chunk) < self.regexpChunkSize:
+                        continue
+                    found.extend(searchRegexps(chunk))
+                    chunk = []
                 else:
-                    irc.reply(ircmsgs.prettyPrint(m,
-                                                  timestampFormat=tsf,
-                                                  showNick=showNick))
-                    return
+                    found.append(m)
+                if found and not nolimit:
+                    break
+        if chunk and (nolimit or not found):
+            found.extend(searchRegexps(chunk))
+        candidates = found
+        if not nolimit:
+            candidates = candidates[:1]
+        for m in candidates:
+            resp.append(ircmsgs.prettyPrint(m, timestampFormat=tsf,
+                                            showNick=showNick))
         if not resp:
             irc.error('I couldn\'t find a message matching that criteria in '
                       'my history of %s messages.' % len(irc.state.history))
-        else:
+        elif nolimit:
             irc.reply(format('%L', resp))
+        else:
+            irc.reply(resp[0])
     last = wrap(last, [getopts({'nolimit': '',
                                 'on': 'something',
                                 'with': 'something',
@@ -173,6 +173,32 @@ class MiscTestCase(ChannelPluginTestCase):
         finally:
             conf.supybot.plugins.Misc.timestampFormat.setValue(orig)
 
+    def testLastRegexpStopsAtFirstMatchingChunk(self):
+        module = sys.modules[self.irc.getCallback('Misc').__module__]
+        originalBatch = module.regexp_batch
+        searched = []
+        def regexp_batch(strings, *args, **kwargs):
+            searched.append(len(strings))
+            return originalBatch(strings, *args, **kwargs)
+        orig = conf.supybot.plugins.Misc.timestampFormat()
+        try:
+            module.regexp_batch = regexp_batch
+            conf.supybot.plugins.Misc.timestampFormat.setValue('')
+            for i in range(120):
+                self.feedMsg('message %s' % i, to=self.channel,
+                             frm='foo!bar@baz')
+            self.assertResponse('last --regexp "m/message [0-9]+$/"',
+                                '<foo> message 119')
+            self.assertEqual(searched, [50])
+            del searched[:]
+            self.assertResponse('last --regexp "m/message 3$/"',
+                                '<foo> message 3')
+            # The last command we gave is in the history too.
+            self.assertEqual(searched, [50, 50, 21])
+        finally:
+            module.regexp_batch = originalBatch
+            conf.supybot.plugins.Misc.timestampFormat.setValue(orig)
+
     def testNestedLastTimestampConfig(self):
         tsConfig = conf.supybot.plugins.Misc.last.nested.includeTimestamp
         orig = tsConfig()
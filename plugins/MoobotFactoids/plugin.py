@@ -107,13 +107,11 @@ class SqliteMoobotDB(object):
         if channel in self.dbs:
             return self.dbs[channel]
         filename = plugins.makeChannelFilename(self.filename, channel)
-        if os.path.exists(filename):
-            self.dbs[channel] = sqlite.connect(filename)
-            return self.dbs[channel]
-        db = sqlite.connect(filename)
+        exists = os.path.exists(filename)
+        db = plugins.openSqliteDatabase(filename)
         self.dbs[channel] = db
-        cursor = db.cursor()
-        cursor.execute("""CREATE TABLE factoids (
+        if not exists:
+            db.execute("""CREATE TABLE factoids (
                           key TEXT PRIMARY KEY,
                           created_by INTEGER,
                           created_at TIMESTAMP,
@@ -126,163 +124,122 @@ class SqliteMoobotDB(object):
                           fact TEXT,
                           requested_count INTEGER
                           )""")
-        db.commit()
         return db
 
     def getFactoid(self, channel, key):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT fact FROM factoids
-                          WHERE key LIKE %s""", key)
-        if cursor.rowcount == 0:
+        rows = db.query("""SELECT fact FROM factoids
+                           WHERE key LIKE %s""", key)
+        if not rows:
             return None
         else:
-            return cursor.fetchall()[0]
+            return rows[0]
 
     def getFactinfo(self, channel, key):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT created_by, created_at,
-                                 modified_by, modified_at,
-                                 last_requested_by, last_requested_at,
-                                 requested_count, locked_by, locked_at
-                          FROM factoids
-                          WHERE key LIKE %s""", key)
-        if cursor.rowcount == 0:
+        rows = db.query("""SELECT created_by, created_at,
+                                  modified_by, modified_at,
+                                  last_requested_by, last_requested_at,
+                                  requested_count, locked_by, locked_at
+                           FROM factoids
+                           WHERE key LIKE %s""", key)
+        if not rows:
             return None
         else:
-            return cursor.fetchone()
+            return rows[0]
 
     def randomFactoid(self, channel):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT fact, key FROM factoids
-                          ORDER BY random() LIMIT 1""")
-        if cursor.rowcount == 0:
+        rows = db.query("""SELECT fact, key FROM factoids
+                           ORDER BY random() LIMIT 1""")
+        if not rows:
             return None
         else:
-            return cursor.fetchone()
+            return rows[0]
 
     def addFactoid(self, channel, key, value, creator_id):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""INSERT INTO factoids VALUES
-                          (%s, %s, %s, NULL, NULL, NULL, NULL,
-                           NULL, NULL, %s, 0)""",
-                           key, creator_id, int(time.time()), value)
-        db.commit()
+        db.execute("""INSERT INTO factoids VALUES
+                      (%s, %s, %s, NULL, NULL, NULL, NULL,
+                       NULL, NULL, %s, 0)""",
+                       key, creator_id, int(time.time()), value)
 
     def updateFactoid(self, channel, key, newvalue, modifier_id):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""UPDATE factoids
-                          SET fact=%s, modified_by=%s,
-                          modified_at=%s WHERE key LIKE %s""",
-                          newvalue, modifier_id, int(time.time()), key)
-        db.commit()
+        db.execute("""UPDATE factoids
+                      SET fact=%s, modified_by=%s,
+                      modified_at=%s WHERE key LIKE %s""",
+                      newvalue, modifier_id, int(time.time()), key)
 
     def updateRequest(self, channel, key, hostmask):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""UPDATE factoids SET
-                          last_requested_by = %s,
-                          last_requested_at = %s,
-                          requested_count = requested_count + 1
-                          WHERE key = %s""",
-                          hostmask, int(time.time()), key)
-        db.commit()
+        db.execute("""UPDATE factoids SET
+                      last_requested_by = %s,
+                      last_requested_at = %s,
+                      requested_count = requested_count + 1
+                      WHERE key = %s""",
+                      hostmask, int(time.time()), key)
 
     def removeFactoid(self, channel, key):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""DELETE FROM factoids WHERE key LIKE %s""",
-                          key)
-        db.commit()
+        db.execute("""DELETE FROM factoids WHERE key LIKE %s""",
+                      key)
 
     def locked(self, channel, key):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute ("""SELECT locked_by FROM factoids
+        rows = db.query("""SELECT locked_by FROM factoids
                            WHERE key LIKE %s""", key)
-        if cursor.fetchone()[0] is None:
+        if rows[0][0] is None:
             return False
         else:
             return True
 
     def lock(self, channel, key, locker_id):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""UPDATE factoids
-                          SET locked_by=%s, locked_at=%s
-                          WHERE key LIKE %s""",
-                          locker_id, int(time.time()), key)
-        db.commit()
+        db.execute("""UPDATE factoids
+                      SET locked_by=%s, locked_at=%s
+                      WHERE key LIKE %s""",
+                      locker_id, int(time.time()), key)
 
     def unlock(self, channel, key):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""UPDATE factoids
-                          SET locked_by=%s, locked_at=%s
-                          WHERE key LIKE %s""", None, None, key)
-        db.commit()
+        db.execute("""UPDATE factoids
+                      SET locked_by=%s, locked_at=%s
+                      WHERE key LIKE %s""", None, None, key)
 
     def mostAuthored(self, channel, limit):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT created_by, count(key) FROM factoids
-                          GROUP BY created_by
-                          ORDER BY count(key) DESC LIMIT %s""", limit)
-        return cursor.fetchall()
+        return db.query("""SELECT created_by, count(key) FROM factoids
+                           GROUP BY created_by
+                           ORDER BY count(key) DESC LIMIT %s""", limit)
 
     def mostRecent(self, channel, limit):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT key FROM factoids
-                          ORDER BY created_at DESC LIMIT %s""", limit)
-        return cursor.fetchall()
+        return db.query("""SELECT key FROM factoids
+                           ORDER BY created_at DESC LIMIT %s""", limit)
 
     def mostPopular(self, channel, limit):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT key, requested_count FROM factoids
-                          WHERE requested_count > 0
-                          ORDER BY requested_count DESC LIMIT %s""", limit)
-        if cursor.rowcount == 0:
-            return []
-        else:
-            return cursor.fetchall()
+        return db.query("""SELECT key, requested_count FROM factoids
+                           WHERE requested_count > 0
+                           ORDER BY requested_count DESC LIMIT %s""", limit)
 
     def getKeysByAuthor(self, channel, authorId):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT key FROM factoids WHERE created_by=%s
-                          ORDER BY key""", authorId)
-        if cursor.rowcount == 0:
-            return []
-        else:
-            return cursor.fetchall()
+        return db.query("""SELECT key FROM factoids WHERE created_by=%s
+                           ORDER BY key""", authorId)
 
     def getKeysByGlob(self, channel, glob):
         db = self._getDb(channel)
-        cursor = db.cursor()
         glob = '%%%s%%' % glob
-        cursor.execute("""SELECT key FROM factoids WHERE key LIKE %s
-                          ORDER BY key""", glob)
-        if cursor.rowcount == 0:
-            return []
-        else:
-            return cursor.fetchall()
+        return db.query("""SELECT key FROM factoids WHERE key LIKE %s
+                           ORDER BY key""", glob)
 
     def getKeysByValueGlob(self, channel, glob):
         db = self._getDb(channel)
-        cursor = db.cursor()
         glob = '%%%s%%' % glob
-        cursor.execute("""SELECT key FROM factoids WHERE fact LIKE %s
-                          ORDER BY key""", glob)
-        if cursor.rowcount == 0:
-            return []
-        else:
-            return cursor.fetchall()
+        return db.query("""SELECT key FROM factoids WHERE fact LIKE %s
+                           ORDER BY key""", glob)
 
 MoobotDB = plugins.DB('MoobotFactoids', {'sqlite': SqliteMoobotDB})
 
@@ -55,7 +55,6 @@ class NoteRecord(dbi.Record):
         ]
 
 class DbiNoteDB(dbi.DB):
-    Mapping = 'flat'
     Record = NoteRecord
 
     def __init__(self, *args, **kwargs):
@@ -285,6 +284,7 @@ class Note(callbacks.Plugin):
         the notes.  If --sent is specified, only search sent notes.
         """
         criteria = []
+        regexps = []
         def to(note):
             return note.to == user.id
         def frm(note):
@@ -292,10 +292,7 @@ class Note(callbacks.Plugin):
         own = to
         for (option, arg) in optlist:
             if option == 'regexp':
-                criteria.append(lambda s:
-                                regexp_wrapper(s, reobj=arg, timeout=0.1,
-                                               plugin_name=self.name(),
-                                               fcn_name='search'))
+                regexps.append(arg)
             elif option == 'sent':
                 own = frm
         if glob:
@@ -307,6 +304,11 @@ class Note(callbacks.Plugin):
                     return False
             return True
         notes = list(self.db.select(lambda n: match(n) and own(n)))
+        for reobj in regexps:
+            matched = regexp_batch([n.text for n in notes], reobj,
+                                   timeout=0.1, plugin_name=self.name(),
+                                   fcn_name='search')
+            notes = [n for (n, b) in zip(notes, matched) if b]
         if not notes:
             irc.reply('No matching notes were found.')
         else:
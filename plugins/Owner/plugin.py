@@ -87,6 +87,7 @@ def renameCommand(cb, name, newName):
         method = getattr(cb.__class__, name)
         setattr(cb.__class__, newName, method)
         delattr(cb.__class__, name)
+        callbacks.commandsChanged()
 
 
 registerDefaultPlugin('list', 'Misc')
@@ -150,6 +151,7 @@ class Owner(callbacks.Plugin):
     def callPrecedence(self, irc):
         return ([], [cb for cb in irc.callbacks if cb is not self])
 
+    outFilterCommands = ('PRIVMSG',)
     def outFilter(self, irc, msg):
         if msg.command == 'PRIVMSG' and not world.testing:
             if ircutils.strEqual(msg.args[0], irc.nick):
@@ -389,14 +391,6 @@ class Owner(callbacks.Plugin):
                             (len(ircutils._hostmaskPatternEqualCache),
                              'result')))
             ircutils._hostmaskPatternEqualCache.clear()
-            L.append(format('ircdb username cache flushed: %n cleared.',
-                            (len(ircdb.users._nameCache),
-                             'username to id mapping')))
-            ircdb.users._nameCache.clear()
-            L.append(format('ircdb hostmask cache flushed: %n cleared.',
-                            (len(ircdb.users._hostmaskCache),
-                            'hostmask to id mapping')))
-            ircdb.users._hostmaskCache.clear()
             L.append(format('linecache line cache flushed: %n cleared.',
                             (len(linecache.cache), 'line')))
             linecache.clearcache()
@@ -72,20 +72,19 @@ class SqliteQuoteGrabsDB(object):
                                    'use QuoteGrabs.  Download it at ' \
                                    '<http://code.google.com/p/pysqlite/>'
         filename = plugins.makeChannelFilename(self.filename, channel)
-        def p(s1, s2):
-            return int(ircutils.nickEqual(s1, s2))
         if filename in self.dbs:
             return self.dbs[filename]
-        if os.path.exists(filename):
-            self.dbs[filename] = sqlite.connect(filename,
-                                                converters={'bool': bool})
-            self.dbs[filename].create_function('nickeq', 2, p)
-            return self.dbs[filename]
-        db = sqlite.connect(filename, converters={'bool': bool})
+        def connect(filename):
+            return sqlite.connect(filename, converters={'bool': bool})
+        def setup(db):
+            def p(s1, s2):
+                return int(ircutils.nickEqual(s1, s2))
+            db.create_function('nickeq', 2, p)
+        exists = os.path.exists(filename)
+        db = plugins.openSqliteDatabase(filename, setup, connect)
         self.dbs[filename] = db
-        self.dbs[filename].create_function('nickeq', 2, p)
-        cursor = db.cursor()
-        cursor.execute("""CREATE TABLE quotegrabs (
+        if not exists:
+            db.execute("""CREATE TABLE quotegrabs (
                           id INTEGER PRIMARY KEY,
                           nick TEXT,
                           hostmask TEXT,
@@ -93,85 +92,77 @@ class SqliteQuoteGrabsDB(object):
                           added_at TIMESTAMP,
                           quote TEXT
                           );""")
-        db.commit()
         return db
 
     def get(self, channel, id):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT id, nick, quote, hostmask, added_at, added_by
-                          FROM quotegrabs WHERE id = %s""", id)
-        if cursor.rowcount == 0:
+        rows = db.query("""SELECT id, nick, quote, hostmask, added_at, added_by
+                           FROM quotegrabs WHERE id = %s""", id)
+        if not rows:
             raise dbi.NoRecordError
-        (id, by, quote, hostmask, at, grabber) = cursor.fetchone()
+        (id, by, quote, hostmask, at, grabber) = rows[0]
         return QuoteGrabsRecord(id, by=by, text=quote, hostmask=hostmask,
                                 at=int(at), grabber=grabber)
 
     def random(self, channel, nick):
         db = self._getDb(channel)
-        cursor = db.cursor()
         if nick:
-            cursor.execute("""SELECT quote FROM quotegrabs
-                              WHERE nickeq(nick, %s)
-                              ORDER BY random() LIMIT 1""",
-                              nick)
+            rows = db.query("""SELECT quote FROM quotegrabs
+                               WHERE nickeq(nick, %s)
+                               ORDER BY random() LIMIT 1""",
+                               nick)
         else:
-            cursor.execute("""SELECT quote FROM quotegrabs
-                              ORDER BY random() LIMIT 1""")
-        if cursor.rowcount == 0:
+            rows = db.query("""SELECT quote FROM quotegrabs
+                               ORDER BY random() LIMIT 1""")
+        if not rows:
             raise dbi.NoRecordError
-        return cursor.fetchone()[0]
+        return rows[0][0]
 
     def list(self, channel, nick):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT id, quote FROM quotegrabs
-                          WHERE nickeq(nick, %s)
-                          ORDER BY id DESC""", nick)
-        if cursor.rowcount == 0:
+        rows = db.query("""SELECT id, quote FROM quotegrabs
+                           WHERE nickeq(nick, %s)
+                           ORDER BY id DESC""", nick)
+        if not rows:
             raise dbi.NoRecordError
-        return [QuoteGrabsRecord(id, text=quote)
-                for (id, quote) in cursor.fetchall()]
+        return [QuoteGrabsRecord(id, text=quote) for (id, quote) in rows]
 
     def getQuote(self, channel, nick):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT quote FROM quotegrabs
-                          WHERE nickeq(nick, %s)
-                          ORDER BY id DESC LIMIT 1""", nick)
-        if cursor.rowcount == 0:
+        rows = db.query("""SELECT quote FROM quotegrabs
+                           WHERE nickeq(nick, %s)
+                           ORDER BY id DESC LIMIT 1""", nick)
+        if not rows:
             raise dbi.NoRecordError
-        return cursor.fetchone()[0]
+        return rows[0][0]
 
     def select(self, channel, nick):
         db = self._getDb(channel)
-        cursor = db.cursor()
-        cursor.execute("""SELECT added_at FROM quotegrabs
-                          WHERE nickeq(nick, %s)
-                          ORDER BY id DESC LIMIT 1""", nick)
-        if cursor.rowcount == 0:
+        rows = db.query("""SELECT added_at FROM quotegrabs
+                           WHERE nickeq(nick, %s)
+                           ORDER BY id DESC LIMIT 1""", nick)
+        if not rows:
             raise dbi.NoRecordError
-        return cursor.fetchone()[0]
+        return rows[0][0]
 
-    def add(self, channel, msg, by):
-        db = self._getDb(channel)
-        cursor = db.cursor()
-        text = ircmsgs.prettyPrint(msg)
+    def _add(self, cursor, nick, prefix, by, text):
         # Check to see if the latest quotegrab is identical
         cursor.execute("""SELECT quote FROM quotegrabs
                           WHERE nick=%s
-                          ORDER BY id DESC LIMIT 1""", msg.nick)
+                          ORDER BY id DESC LIMIT 1""", nick)
         if cursor.rowcount != 0:
             if text == cursor.fetchone()[0]:
                 return
         cursor.execute("""INSERT INTO quotegrabs
                           VALUES (NULL, %s, %s, %s, %s, %s)""",
-                       msg.nick, msg.prefix, by, int(time.time()), text)
-        db.commit()
+                       nick, prefix, by, int(time.time()), text)
 
-    def remove(self, channel, grab=None):
+    def add(self, channel, msg, by):
         db = self._getDb(channel)
-        cursor = db.cursor()
+        text = ircmsgs.prettyPrint(msg)
+        db.submit(self._add, msg.nick, msg.prefix, by, text)
+
+    def _remove(self, cursor, grab):
         if grab is not None:
             # the testing if there actually *is* the to-be-deleted record is
             # strictly unnecessary -- the DELETE operation would "succeed"
@@ -188,19 +179,21 @@ class SqliteQuoteGrabsDB(object):
                 raise dbi.NoRecordError
             cursor.execute("""DELETE FROM quotegrabs WHERE id = (SELECT MAX(id)
                 FROM quotegrabs)""")
-        db.commit()
+
+    def remove(self, channel, grab=None):
+        db = self._getDb(channel)
+        db.transaction(self._remove, grab)
 
     def search(self, channel, text):
         db = self._getDb(channel)
-        cursor = db.cursor()
         text = '%' + text + '%'
-        cursor.execute("""SELECT id, nick, quote FROM quotegrabs
-                          WHERE quote LIKE %s
-                          ORDER BY id DESC""", text)
-        if cursor.rowcount == 0:
+        rows = db.query("""SELECT id, nick, quote FROM quotegrabs
+                           WHERE quote LIKE %s
+                           ORDER BY id DESC""", text)
+        if not rows:
             raise dbi.NoRecordError
         return [QuoteGrabsRecord(id, text=quote, by=nick)
-                for (id, nick, quote) in cursor.fetchall()]
+                for (id, nick, quote) in rows]
 
 QuoteGrabsDB = plugins.DB('QuoteGrabs', {'sqlite': SqliteQuoteGrabsDB})
 
@@ -211,6 +204,10 @@ class QuoteGrabs(callbacks.Plugin):
         self.__parent.__init__(irc)
         self.db = QuoteGrabsDB()
 
+    def die(self):
+        self.__parent.die()
+        self.db.close()
+
     def doPrivmsg(self, irc, msg):
         if ircmsgs.isCtcp(msg) and not ircmsgs.isAction(msg):
             return
@@ -257,9 +254,9 @@ class QuoteGrabs(callbacks.Plugin):
             raise callbacks.ArgumentError
         if ircutils.nickEqual(nick, msg.nick):
             irc.error('You can\'t quote grab yourself.', Raise=True)
-        for m in reversed(irc.state.history):
-            if m.command == 'PRIVMSG' and ircutils.nickEqual(m.nick, nick) \
-                    and ircutils.strEqual(m.args[0], chan):
+        for m in irc.state.history.scan(command='PRIVMSG', nick=nick,
+                                        reverse=True):
+            if ircutils.strEqual(m.args[0], chan):
                 self._grab(channel, irc, m, msg.prefix)
                 irc.replySuccess()
                 return
@@ -62,6 +62,9 @@ conf.registerGlobalValue(RSS, 'waitPeriod',
     registry.PositiveInteger(1800, """Indicates how many seconds the bot will
     wait between retrieving RSS feeds; requests made within this period will
     return cached results."""))
+conf.registerGlobalValue(RSS, 'concurrentFetches',
+    registry.PositiveInteger(4, """Determines how many announced feeds the
+    bot will fetch at once."""))
 conf.registerGlobalValue(RSS, 'feeds',
     FeedNames([], """Determines what feeds should be accessible as
     commands."""))
@@ -31,15 +31,19 @@
 import new
 import time
 import socket
+import hashlib
 import sgmllib
 import threading
 import feedparser
+from cStringIO import StringIO
 
 import supybot.conf as conf
 import supybot.utils as utils
 import supybot.world as world
 from supybot.commands import *
+import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
+import supybot.schedule as schedule
 import supybot.registry as registry
 import supybot.callbacks as callbacks
 
@@ -65,6 +69,13 @@ class RSS(callbacks.Plugin):
         self.lastRequest = {}
         self.cachedFeeds = {}
         self.gettingLockLock = threading.Lock()
+        # The poller's state: when each announced feed is due, how many times
+        # in a row it couldn't be fetched, the keys of the headlines it had
+        # last time, and which feeds are being fetched right now.
+        self.nextPoll = {}
+        self.failures = {}
+        self.seenHeadlines = {}
+        self.fetching = set()
         for name in self.registryValue('feeds'):
             self._registerFeed(name)
             try:
@@ -73,7 +84,20 @@ class RSS(callbacks.Plugin):
                 self.log.warning('%s is not a registered feed, removing.',name)
                 continue
             self.makeFeedCommand(name, url)
-            self.getFeed(url) # So announced feeds don't announce on startup.
+            self.getFeed(url)
+        # Like all plugins, we're loaded once per network; our poller only
+        # announces feeds on ours.
+        self.pollIrc = irc
+        self.pollEventName = 'RSS poll on %s' % irc.network
+        schedule.addPeriodicEvent(self._poll, self.pollPeriod,
+                                  name=self.pollEventName, now=False)
+
+    def die(self):
+        try:
+            schedule.removePeriodicEvent(self.pollEventName)
+        except KeyError:
+            pass
+        self.__parent.die()
 
     def isCommandMethod(self, name):
         if not self.__parent.isCommandMethod(name):
@@ -98,38 +122,70 @@ class RSS(callbacks.Plugin):
         group = self.registryValue('feeds', value=False)
         conf.registerGlobalValue(group, name, registry.String(url, ''))
 
-    def __call__(self, irc, msg):
-        self.__parent.__call__(irc, msg)
-        irc = callbacks.SimpleProxy(irc, msg)
-        newFeeds = {}
+    # How often, in seconds, the poller looks for announced feeds that are
+    # due.  Each feed is fetched every waitPeriod seconds (or its own ttl, if
+    # that's longer), and less often while it keeps failing.
+    pollPeriod = 10
+
+    def _announcedFeeds(self, irc):
+        """Returns a dict mapping the urls of the feeds announced on irc to
+        lists of the (channel, name) they're announced to."""
+        feeds = {}
         for channel in irc.state.channels:
-            feeds = self.registryValue('announce', channel)
-            for name in feeds:
+            for name in self.registryValue('announce', channel):
                 commandName = callbacks.canonicalName(name)
-                if self.isCommandMethod(commandName):
+                if commandName in self.feedNames:
                     url = self.feedNames[commandName][0]
                 else:
                     url = name
-                if self.willGetNewFeed(url):
-                    newFeeds.setdefault((url, name), []).append(channel)
-        for ((url, name), channels) in newFeeds.iteritems():
-            # We check if we can acquire the lock right here because if we
-            # don't, we'll possibly end up spawning a lot of threads to get
-            # the feed, because this thread may run for a number of bytecodes
-            # before it switches to a thread that'll get the lock in
-            # _newHeadlines.
-            if self.acquireLock(url, blocking=False):
-                try:
-                    t = threading.Thread(target=self._newHeadlines,
-                                         name=format('Fetching %u', url),
-                                         args=(irc, channels, name, url))
-                    self.log.info('Checking for announcements at %u', url)
-                    world.threadsSpawned += 1
-                    t.setDaemon(True)
-                    t.start()
-                finally:
-                    self.releaseLock(url)
-                    time.sleep(0.1) # So other threads can run.
+                feeds.setdefault(url, []).append((channel, name))
+        return feeds
+
+    def _poll(self):
+        now = time.time()
+        irc = self.pollIrc
+        feeds = self._announcedFeeds(irc)
+        for d in (self.nextPoll, self.failures, self.seenHeadlines):
+            for url in d.keys():
+                if url not in feeds:
+                    del d[url]
+        maximum = self.registryValue('concurrentFetches')
+        due = [(self.nextPoll.get(url, 0), url) for url in feeds
+               if url not in self.fetching]
+        due.sort()
+        for (t, url) in due:
+            if t > now or len(self.fetching) >= maximum:
+                break
+            self.fetching.add(url)
+            if not world.threads.submit(self._newHeadlines,
+                                        args=(irc, url, feeds[url]),
+                                        name=format('Fetching %u', url),
+                                        group=self.name()):
+                self.fetching.discard(url)
+                break
+
+    def _schedule(self, url, fetched, feed):
+        wait = self.registryValue('waitPeriod')
+        if not fetched:
+            failures = self.failures.get(url, 0) + 1
+            self.failures[url] = failures
+            wait *= 2 ** min(failures, 4)
+        else:
+            self.failures.pop(url, None)
+            try:
+                # The feed's ttl is in minutes.
+                wait = max(wait, int(feed['feed'].get('ttl', 0)) * 60)
+            except ValueError:
+                pass
+        self.nextPoll[url] = time.time() + wait
+
+    def _headlineKey(self, item):
+        """Returns a hash of what identifies an item of a feed: its GUID,
+        its link, or, failing those, its title."""
+        key = item.get('id') or item.get('link') or item.get('title', '')
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).digest()
 
     def buildHeadlines(self, headlines, channel, config='announce.showLinks'):
         newheadlines = []
@@ -146,49 +202,64 @@ class RSS(callbacks.Plugin):
                 newheadlines = [format('%s', h[0]) for h in headlines]
         return newheadlines
 
-    def _newHeadlines(self, irc, channels, name, url):
+    def _newHeadlines(self, irc, url, targets):
         try:
             # We acquire the lock here so there's only one announcement thread
-            # in this code at any given time.  Otherwise, several announcement
-            # threads will getFeed (all blocking, in turn); then they'll all
-            # want to send their news messages to the appropriate channels.
-            # Note that we're allowed to acquire this lock twice within the
-            # same thread because it's an RLock and not just a normal Lock.
+            # in this code at any given time for a feed.  Note that we're
+            # allowed to acquire this lock twice within the same thread
+            # because it's an RLock and not just a normal Lock.
             self.acquireLock(url)
             try:
-                oldresults = self.cachedFeeds[url]
-                oldheadlines = self.getHeadlines(oldresults)
-            except KeyError:
-                oldheadlines = []
-            newresults = self.getFeed(url)
-            newheadlines = self.getHeadlines(newresults)
-            if len(newheadlines) == 1:
-                s = newheadlines[0][0]
-                if s in ('Timeout downloading feed.',
-                         'Unable to download feed.'):
-                    self.log.debug('%s %u', s, url)
+                # getFeed uses the feed it got last time if that's recent
+                # enough, or if it can't get it again; it only updates
+                # lastRequest when it actually gets the feed.
+                fresh = not self.willGetNewFeed(url)
+                started = time.time()
+                try:
+                    feed = self.getFeed(url)
+                except callbacks.Error, e:
+                    self.log.info('Couldn\'t announce %u: %s', url, e)
+                    feed = {}
+                fetched = fresh or self.lastRequest.get(url, 0) >= started
+                self._schedule(url, fetched, feed)
+                if not feed.get('feed'):
+                    self.log.debug('Couldn\'t get %u for announcing.', url)
+                    return
+                items = [d for d in feed['items'] if 'title' in d]
+                keys = map(self._headlineKey, items)
+                seen = self.seenHeadlines.get(url)
+                self.seenHeadlines[url] = set(keys)
+                if seen is None:
+                    # The first time we get a feed, we only learn what's in
+                    # it; otherwise, we'd announce all of it on startup.
                     return
-            def normalize(headline):
-                return (tuple(headline[0].lower().split()), headline[1])
-            oldheadlines = set(map(normalize, oldheadlines))
-            for (i, headline) in enumerate(newheadlines):
-                if normalize(headline) in oldheadlines:
-                    newheadlines[i] = None
-            newheadlines = filter(None, newheadlines) # Removes Nones.
-            if newheadlines:
-                for channel in channels:
-                    bold = self.registryValue('bold', channel)
-                    sep = self.registryValue('headlineSeparator', channel)
-                    prefix = self.registryValue('announcementPrefix', channel)
-                    pre = format('%s%s: ', prefix, name)
-                    if bold:
-                        pre = ircutils.bold(pre)
-                        sep = ircutils.bold(sep)
-                    headlines = self.buildHeadlines(newheadlines, channel)
-                    irc.replies(headlines, prefixer=pre, joiner=sep,
-                                to=channel, prefixNick=False, private=True)
+                conv = self._getConverter(feed)
+                newheadlines = [(conv(d['title']), d.get('link'))
+                                for (d, key) in zip(items, keys)
+                                if key not in seen]
+                if newheadlines:
+                    self._announce(irc, newheadlines, targets)
+            finally:
+                self.releaseLock(url)
         finally:
-            self.releaseLock(url)
+            self.fetching.discard(url)
+
+    def _announce(self, irc, newheadlines, targets):
+        for (channel, name) in targets:
+            if channel not in irc.state.channels:
+                continue
+            msg = ircmsgs.privmsg(channel, name, prefix=irc.prefix)
+            proxy = callbacks.SimpleProxy(irc, msg)
+            bold = self.registryValue('bold', channel)
+            sep = self.registryValue('headlineSeparator', channel)
+            prefix = self.registryValue('announcementPrefix', channel)
+            pre = format('%s%s: ', prefix, name)
+            if bold:
+                pre = ircutils.bold(pre)
+                sep = ircutils.bold(sep)
+            headlines = self.buildHeadlines(newheadlines, channel)
+            proxy.replies(headlines, prefixer=pre, joiner=sep, to=channel,
+                          prefixNick=False, private=True)
 
     def willGetNewFeed(self, url):
         now = time.time()
@@ -224,9 +295,21 @@ class RSS(callbacks.Plugin):
             if self.willGetNewFeed(url):
                 try:
                     self.log.debug('Downloading new feed from %u', url)
-                    results = feedparser.parse(url)
+                    # utils.web caches the feed and revalidates it, so an
+                    # unchanged feed costs a 304 rather than a download.
+                    (text, headers) = utils.web.getUrlWithHeaders(url)
+                    # feedparser takes a string for a URL or a filename
+                    # before it takes it for a feed, and we don't want it
+                    # fetching or opening whatever a feed says.
+                    headers.setdefault('content-location', url)
+                    results = feedparser.parse(StringIO(text),
+                                               response_headers=headers)
                     if 'bozo_exception' in results:
                         raise results['bozo_exception']
+                except utils.web.Error, e:
+                    self.log.info('Couldn\'t download feed from %u: %s',
+                                  url, e)
+                    results = {}
                 except sgmllib.SGMLParseError:
                     self.log.exception('Uncaught exception from feedparser:')
                     raise callbacks.Error, 'Invalid (unparsable) RSS feed.'
@@ -300,6 +383,7 @@ class RSS(callbacks.Plugin):
         f = utils.python.changeFunctionName(f, name, docstring)
         f = new.instancemethod(f, self, RSS)
         self.feedNames[name] = (url, f)
+        callbacks.commandsChanged()
         self._registerFeed(name, url)
 
     def add(self, irc, msg, args, name, url):
@@ -322,6 +406,7 @@ class RSS(callbacks.Plugin):
             irc.error('That\'s not a valid RSS feed command name.')
             return
         del self.feedNames[name]
+        callbacks.commandsChanged()
         conf.supybot.plugins.RSS.feeds().remove(name)
         conf.supybot.plugins.RSS.feeds.unregister(name)
         irc.replySuccess()
@@ -30,6 +30,10 @@
 
 from supybot.test import *
 
+import supybot.conf as conf
+import supybot.utils as utils
+import supybot.world as world
+
 url = 'http://www.advogato.org/rss/articles.xml'
 class RSSTestCase(ChannelPluginTestCase):
     plugins = ('RSS','Plugin')
@@ -79,5 +83,191 @@ class RSSTestCase(ChannelPluginTestCase):
             self.assertNotError('rss http://www.heise.de/newsticker/heise.rdf')
             self.assertNotError('rss info http://br-linux.org/main/index.xml')
 
+class RSSGetFeedTestCase(PluginTestCase):
+    plugins = ('RSS',)
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.module = sys.modules[self.irc.getCallback('RSS').__module__]
+        self.originalParse = self.module.feedparser.parse
+        self.originalGet = utils.web.getUrlWithHeaders
+        self.parsed = []
+        def parse(source, **kwargs):
+            self.parsed.append((source, kwargs))
+            return {'feed': {'title': 'Feed'}, 'items': []}
+        self.module.feedparser.parse = parse
+
+    def tearDown(self):
+        self.module.feedparser.parse = self.originalParse
+        utils.web.getUrlWithHeaders = self.originalGet
+        PluginTestCase.tearDown(self)
+
+    def testFeedIsParsedFromItsBody(self):
+        # A feed whose body looks like a URL or a filename mustn't have
+        # feedparser go there.
+        body = 'http://example.com/elsewhere'
+        contentType = 'application/rss+xml; charset=iso-8859-1'
+        def getUrlWithHeaders(url):
+            return (body, {'content-type': contentType})
+        utils.web.getUrlWithHeaders = getUrlWithHeaders
+        rss = self.irc.getCallback('RSS')
+        feed = rss.getFeed('http://example.com/feed')
+        self.assertEqual(feed['feed'], {'title': 'Feed'})
+        [(source, kwargs)] = self.parsed
+        self.failIf(isinstance(source, basestring))
+        self.assertEqual(source.read(), body)
+        self.assertEqual(kwargs['response_headers'],
+                         {'content-type': contentType,
+                          'content-location': 'http://example.com/feed'})
+
+class FakePool(object):
+    """Keeps the tasks the poller submits, so the test can run them when it
+    wants to."""
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, f, args=(), kwargs={}, name=None, group=None):
+        self.tasks.append((f, args, kwargs))
+        return True
+
+    def run(self):
+        (tasks, self.tasks) = (self.tasks, [])
+        for (f, args, kwargs) in tasks:
+            f(*args, **kwargs)
+
+class RSSPollTestCase(ChannelPluginTestCase):
+    plugins = ('RSS',)
+    feed = 'http://example.com/feed'
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        self.rss = self.irc.getCallback('RSS')
+        self.rss.getFeed = self.getFeed
+        # Feeds that aren't in here can't be fetched.
+        self.feeds = {}
+        self.fetched = []
+        self.originalThreads = world.threads
+        world.threads = self.pool = FakePool()
+        self.announce = conf.supybot.plugins.RSS.announce.get(self.channel)
+        self.announce.setValue(set([self.feed]))
+        self.waitPeriod = conf.supybot.plugins.RSS.waitPeriod()
+
+    def tearDown(self):
+        world.threads = self.originalThreads
+        self.announce.setValue(set())
+        ChannelPluginTestCase.tearDown(self)
+
+    def getFeed(self, url):
+        self.fetched.append(url)
+        if url not in self.feeds:
+            return {'items': [{'title': 'Unable to download feed.'}]}
+        self.rss.lastRequest[url] = time.time()
+        (feed, items) = self.feeds[url]
+        return {'feed': feed, 'items': items}
+
+    def poll(self):
+        """Makes every feed due, then polls them."""
+        for url in self.rss.nextPoll:
+            self.rss.nextPoll[url] = 0
+        self.rss._poll()
+        self.pool.run()
+
+    def assertWaits(self, url, wait):
+        left = self.rss.nextPoll[url] - time.time()
+        self.failUnless(wait - 5 < left <= wait, (left, wait))
+
+    def testFirstPollOnlyLearnsTheFeed(self):
+        items = [{'title': 'First'}, {'title': 'Second'}]
+        self.feeds[self.feed] = ({'title': 'Feed'}, items)
+        self.poll()
+        self.assertEqual(self.fetched, [self.feed])
+        self.assertEqual(self.irc.takeMsg(), None)
+        items.append({'title': 'Third'})
+        self.poll()
+        m = self.irc.takeMsg()
+        self.failUnless(m is not None)
+        self.assertEqual(m.args[0], self.channel)
+        self.failUnless('Third' in m.args[1], m)
+        self.failIf('First' in m.args[1], m)
+        self.assertEqual(self.irc.takeMsg(), None)
+        self.poll()
+        self.assertEqual(self.irc.takeMsg(), None)
+
+    def testOnlyNewItemsAreAnnounced(self):
+        self.feeds[self.feed] = ({'title': 'Feed'},
+                                 [{'id': '1', 'title': 'By guid'},
+                                  {'link': 'http://example.com/2',
+                                   'title': 'By link'},
+                                  {'title': 'By title'}])
+        self.poll()
+        # Items keep their identity when what doesn't identify them changes.
+        self.feeds[self.feed] = ({'title': 'Feed'},
+                                 [{'id': '1', 'title': 'Retitled',
+                                   'link': 'http://example.com/moved'},
+                                  {'link': 'http://example.com/2',
+                                   'title': 'Retitled too'},
+                                  {'title': 'By title'},
+                                  {'id': '4', 'title': 'New'}])
+        self.poll()
+        m = self.irc.takeMsg()
+        self.failUnless(m is not None)
+        self.failUnless('New' in m.args[1], m)
+        self.failIf('Retitled' in m.args[1], m)
+        self.assertEqual(self.irc.takeMsg(), None)
+
+    def testBackoff(self):
+        for failures in range(1, 6):
+            self.poll()
+            self.assertEqual(self.rss.failures[self.feed], failures)
+            self.assertWaits(self.feed,
+                             self.waitPeriod * 2 ** min(failures, 4))
+        self.feeds[self.feed] = ({'title': 'Feed'}, [{'title': 'Item'}])
+        self.poll()
+        self.failIf(self.feed in self.rss.failures)
+        self.assertWaits(self.feed, self.waitPeriod)
+
+    def testTtl(self):
+        # The ttl is in minutes.
+        self.feeds[self.feed] = ({'ttl': '60'}, [{'title': 'Item'}])
+        self.poll()
+        self.assertWaits(self.feed, max(self.waitPeriod, 3600))
+        self.feeds[self.feed] = ({'ttl': 'soon'}, [{'title': 'Item'}])
+        self.poll()
+        self.assertWaits(self.feed, self.waitPeriod)
+
+    def testConcurrentFetches(self):
+        concurrentFetches = conf.supybot.plugins.RSS.concurrentFetches
+        original = concurrentFetches()
+        urls = ['http://example.com/%s' % i for i in range(3)]
+        try:
+            concurrentFetches.setValue(2)
+            self.announce.setValue(set(urls))
+            self.rss._poll()
+            self.assertEqual(len(self.pool.tasks), 2)
+            self.assertEqual(len(self.rss.fetching), 2)
+            # Those two are still being fetched.
+            self.rss._poll()
+            self.assertEqual(len(self.pool.tasks), 2)
+            self.pool.run()
+            self.assertEqual(self.rss.fetching, set())
+            self.rss._poll()
+            self.assertEqual(len(self.pool.tasks), 1)
+            self.pool.run()
+            self.assertEqual(sorted(self.fetched), urls)
+        finally:
+            concurrentFetches.setValue(original)
+
+    def testStateIsDroppedWithTheAnnouncement(self):
+        working = 'http://example.com/working'
+        self.feeds[working] = ({'title': 'Feed'}, [{'title': 'Item'}])
+        self.announce.setValue(set([self.feed, working]))
+        self.poll()
+        self.assertEqual(set(self.rss.nextPoll), set([self.feed, working]))
+        self.assertEqual(set(self.rss.failures), set([self.feed]))
+        self.assertEqual(set(self.rss.seenHeadlines), set([working]))
+        self.announce.setValue(set())
+        self.rss._poll()
+        self.assertEqual(self.rss.nextPoll, {})
+        self.assertEqual(self.rss.failures, {})
+        self.assertEqual(self.rss.seenHeadlines, {})
+
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -46,21 +46,9 @@ class Relay(callbacks.Plugin):
         self.__parent = super(Relay, self)
         self.__parent.__init__(irc)
         self._whois = {}
-        self.lastmsg = {}
-        self.ircstates = {}
         self.queuedTopics = MultiSet()
         self.lastRelayMsgs = ircutils.IrcDict()
 
-    def __call__(self, irc, msg):
-        try:
-            irc = self._getRealIrc(irc)
-            if irc not in self.ircstates:
-                self._addIrc(irc)
-            self.ircstates[irc].addMsg(irc, self.lastmsg[irc])
-        finally:
-            self.lastmsg[irc] = msg
-        self.__parent.__call__(irc, msg)
-
     def do376(self, irc, msg):
         networkGroup = conf.supybot.networks.get(irc.network)
         for channel in self.registryValue('channels'):
@@ -79,19 +67,6 @@ class Relay(callbacks.Plugin):
         # We should allow abbreviations at some point.
         return irc.network
 
-    def _addIrc(self, irc):
-        # Let's just be extra-special-careful here.
-        if irc not in self.ircstates:
-            self.ircstates[irc] = irclib.IrcState()
-        if irc not in self.lastmsg:
-            self.lastmsg[irc] = ircmsgs.ping('this is just a fake message')
-        if irc.afterConnect:
-            # We've probably been reloaded.  Let's send some messages to get
-            # our IrcState objects up to current.
-            for channel in self.registryValue('channels'):
-                irc.queueMsg(ircmsgs.who(channel))
-                irc.queueMsg(ircmsgs.names(channel))
-
     def join(self, irc, msg, args, channel):
         """[<channel>]
 
@@ -481,11 +456,11 @@ class Relay(callbacks.Plugin):
             s = format('%s has quit %s (%s)', msg.nick, network, msg.args[0])
         else:
             s = format('%s has quit %s.', msg.nick, network)
-        for channel in self.registryValue('channels'):
-            if channel in self.ircstates[irc].channels:
-                if msg.nick in self.ircstates[irc].channels[channel].users:
-                    m = self._msgmaker(channel, s)
-                    self._sendToOthers(irc, m)
+        channels = self.registryValue('channels')
+        for channel in msg.tagged('channels') or []:
+            if channel in channels:
+                m = self._msgmaker(channel, s)
+                self._sendToOthers(irc, m)
 
     def doError(self, irc, msg):
         irc = self._getRealIrc(irc)
@@ -495,6 +470,7 @@ class Relay(callbacks.Plugin):
             m = self._msgmaker(channel, s)
             self._sendToOthers(irc, m)
 
+    outFilterCommands = ('PRIVMSG',)
     def outFilter(self, irc, msg):
         irc = self._getRealIrc(irc)
         if msg.command == 'PRIVMSG':
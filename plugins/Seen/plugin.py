@@ -96,44 +96,22 @@ class Seen(callbacks.Plugin):
         self.__parent.__init__(irc)
         self.db = SeenDB(filename)
         self.anydb = SeenDB(anyfilename)
-        self.lastmsg = {}
-        self.ircstates = {}
-        world.flushers.append(self.db.flush)
-        world.flushers.append(self.anydb.flush)
+        world.flushers.append(self.db.snapshot)
+        world.flushers.append(self.anydb.snapshot)
 
     def die(self):
-        if self.db.flush in world.flushers:
-            world.flushers.remove(self.db.flush)
+        if self.db.snapshot in world.flushers:
+            world.flushers.remove(self.db.snapshot)
         else:
             self.log.debug('Odd, no flush in flushers: %r', world.flushers)
         self.db.close()
-        if self.anydb.flush in world.flushers:
-            world.flushers.remove(self.anydb.flush)
+        if self.anydb.snapshot in world.flushers:
+            world.flushers.remove(self.anydb.snapshot)
         else:
             self.log.debug('Odd, no flush in flushers: %r', world.flushers)
         self.anydb.close()
         self.__parent.die()
 
-    def __call__(self, irc, msg):
-        try:
-            if irc not in self.ircstates:
-                self._addIrc(irc)
-            self.ircstates[irc].addMsg(irc, self.lastmsg[irc])
-        finally:
-            self.lastmsg[irc] = msg
-        self.__parent.__call__(irc, msg)
-
-    def _addIrc(self, irc):
-        # Let's just be extra-special-careful here.
-        if irc not in self.ircstates:
-            self.ircstates[irc] = irclib.IrcState()
-        if irc not in self.lastmsg:
-            self.lastmsg[irc] = ircmsgs.ping('this is just a fake message')
-        if not world.testing:
-            for channel in irc.state.channels:
-                irc.queueMsg(ircmsgs.who(channel))
-                irc.queueMsg(ircmsgs.names(channel))
-
     def doPrivmsg(self, irc, msg):
         if ircmsgs.isCtcp(msg) and not ircmsgs.isAction(msg):
             return
@@ -161,25 +139,27 @@ class Seen(callbacks.Plugin):
     doJoin = doPart
     doKick = doPart
 
-    def doQuit(self, irc, msg):
+    def _updateChannels(self, irc, msg, channels):
         said = ircmsgs.prettyPrint(msg)
-        if irc not in self.ircstates:
-            return
         try:
             id = ircdb.users.getUserId(msg.prefix)
         except KeyError:
             id = None # Not in the database.
-        for channel in self.ircstates[irc].channels:
-            if msg.nick in self.ircstates[irc].channels[channel].users:
-                self.anydb.update(channel, msg.nick, said)
-                if id is not None:
-                    self.anydb.update(channel, id, said)
+        for channel in channels:
+            self.anydb.update(channel, msg.nick, said)
+            if id is not None:
+                self.anydb.update(channel, id, said)
+
+    def doQuit(self, irc, msg):
+        # The state has already forgotten the channels the user was in, but
+        # it tagged the message with them.
+        self._updateChannels(irc, msg, msg.tagged('channels') or [])
     doNick = doQuit
 
     def doMode(self, irc, msg):
         # Filter out messages from network Services
         if msg.nick:
-            self.doQuit(irc, msg)
+            self._updateChannels(irc, msg, irc.state.nickToChannels(msg.nick))
     doTopic = doMode
 
     def _seen(self, irc, channel, name, any=False):
@@ -303,7 +283,10 @@ class Seen(callbacks.Plugin):
             irc.error(format('You must be in %s to use this command.', channel))
             return
         end = None # By default, up until the most recent message.
-        for (i, m) in utils.seq.renumerate(irc.state.history):
+        history = irc.state.history
+        for i in history.indexes(command=('JOIN', 'PART', 'QUIT', 'KICK'),
+                                 reverse=True):
+            m = history[i]
             if end is None and m.command == 'JOIN' and \
                ircutils.strEqual(m.args[0], channel) and \
                ircutils.strEqual(m.nick, nick):
@@ -322,10 +305,13 @@ class Seen(callbacks.Plugin):
         else: # I never use this; it only kicks in when the for loop exited normally.
             irc.error(format('I couldn\'t find in my history of %s messages '
                              'where %r last left the %s',
-                             len(irc.state.history), nick, channel))
+                             len(history), nick, channel))
             return
-        msgs = [m for m in irc.state.history[i:end]
-                if m.command == 'PRIVMSG' and ircutils.strEqual(m.args[0], channel)]
+        if end is None:
+            end = len(history)
+        msgs = [history[j] for j in history.indexes(command='PRIVMSG',
+                                                    channel=channel)
+                if i <= j < end]
         if msgs:
             irc.reply(format('%L', map(ircmsgs.prettyPrint, msgs)))
         else:
@@ -56,6 +56,11 @@ class ChannelDBTestCase(ChannelPluginTestCase):
         self.assertRegexp('seen any %s' % self.nick,
                           '^%s was last seen' % self.nick)
 
+    def testAnyQuit(self):
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='baz!baz@baz'))
+        self.irc.feedMsg(ircmsgs.quit('bye', prefix='baz!baz@baz'))
+        self.assertRegexp('seen any baz', 'baz <baz!baz@baz> has quit IRC')
+
     def testSeen(self):
         self.assertNotError('seen last')
         self.assertNotError('list')
@@ -72,6 +77,19 @@ class ChannelDBTestCase(ChannelPluginTestCase):
     def testSeenNoUser(self):
         self.assertNotRegexp('seen user alsdkfjalsdfkj', 'KeyError')
 
+    def testSince(self):
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='baz!baz@baz'))
+        self.assertRegexp('since baz', 'couldn\'t find')
+        self.irc.feedMsg(ircmsgs.part(self.channel, prefix='baz!baz@baz'))
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'hi there',
+                                         prefix=self.prefix))
+        self.irc.feedMsg(ircmsgs.privmsg('#other', 'elsewhere',
+                                         prefix=self.prefix))
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='baz!baz@baz'))
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'too late',
+                                         prefix=self.prefix))
+        self.assertResponse('since BAZ', '<foo> hi there')
+
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
 
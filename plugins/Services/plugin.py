@@ -70,6 +70,7 @@ class Services(callbacks.Plugin):
             return True
         return False
 
+    outFilterCommands = ('JOIN',)
     def outFilter(self, irc, msg):
         if msg.command == 'JOIN' and not self.disabled(irc):
             if not self.identified:
@@ -107,6 +107,8 @@ class ShrinkUrl(callbacks.PluginRegexp):
         newMsg.tag('shrunken')
         irc.queueMsg(newMsg)
 
+    outFilterCommands = ('PRIVMSG',)
+    outFilterChannelValue = 'outFilter'
     def outFilter(self, irc, msg):
         channel = msg.args[0]
         if msg.command == 'PRIVMSG' and irc.isChannel(channel):
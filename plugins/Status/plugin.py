@@ -89,9 +89,11 @@ class Status(callbacks.Plugin):
         """
         threads = [t.getName() for t in threading.enumerate()]
         threads.sort()
-        s = format('I have spawned %n; %n %b still currently active: %L.',
+        s = format('I have spawned %n; %n %b still currently active: %L.  '
+                   'Thread pool: %s.',
                    (world.threadsSpawned, 'thread'),
-                   (len(threads), 'thread'), len(threads), threads)
+                   (len(threads), 'thread'), len(threads), threads,
+                   world.threads.stats())
         irc.reply(s)
     threads = wrap(threads)
 
@@ -28,7 +28,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
-import types
+import functools
 import binascii
 
 import supybot.utils as utils
@@ -133,10 +133,10 @@ class String(callbacks.Plugin):
         s/regexp/replacement/flags, returns the result of applying such a
         regexp to <text>.
         """
-        if isinstance(ff, (types.FunctionType, types.MethodType)):
+        if isinstance(ff, utils.str.PerlReplacer):
             f = ff
         else:
-            f = lambda s: ff.search(s) and ff.search(s).group(0) or ''
+            f = functools.partial(commands.regexp_match, ff)
         if f('') and len(f(' ')) > len(f(''))+1: # Matches the empty string.
             s = 'You probably don\'t want to match the empty string.'
             irc.error(s)
@@ -226,20 +226,26 @@ class Todo(callbacks.Plugin):
         if not optlist and not globs:
             raise callbacks.ArgumentError
         criteria = []
+        regexps = []
         for (option, arg) in optlist:
             if option == 'regexp':
-                criteria.append(lambda s:
-                                regexp_wrapper(s, reobj=arg, timeout=0.1,
-                                               plugin_name=self.name(),
-                                               fcn_name='search'))
+                regexps.append(arg)
         for glob in globs:
             glob = utils.python.glob2re(glob)
             criteria.append(re.compile(glob).search)
         try:
-            tasks = self.db.select(user.id, criteria)
+            tasks = list(self.db.select(user.id, criteria))
+        except dbi.NoRecordError:
+            tasks = []
+        for reobj in regexps:
+            matched = regexp_batch([t.task for t in tasks], reobj,
+                                   timeout=0.1, plugin_name=self.name(),
+                                   fcn_name='search')
+            tasks = [t for (t, b) in zip(tasks, matched) if b]
+        if tasks:
             L = [format('#%i: %s', t.id, self._shrink(t.task)) for t in tasks]
             irc.reply(format('%L', L))
-        except dbi.NoRecordError:
+        else:
             irc.reply('No tasks matched that query.')
     search = wrap(search,
                   ['user', getopts({'regexp': 'regexpMatcher'}), any('glob')])
@@ -132,20 +132,26 @@ class Topic(callbacks.Plugin):
         self.__parent.die()
 
     def _flush(self):
+        # The pickling is done here, the writing in world.flushWriter.
         try:
-            pklfd, tempfn = tempfile.mkstemp(suffix='topic', dir=datadir)
-            pkl = os.fdopen(pklfd, 'wb')
+            s = ''.join([pickle.dumps(x) for x in (self.undos, self.redos,
+                                                   self.lastTopics,
+                                                   self.watchingFor332)])
+        except Exception, e:
+            self.log.warning('Unable to store pickled data: %s', e)
+            return
+        def write():
             try:
-                pickle.dump(self.undos, pkl)
-                pickle.dump(self.redos, pkl)
-                pickle.dump(self.lastTopics, pkl)
-                pickle.dump(self.watchingFor332, pkl)
-            except Exception, e:
-                self.log.warning('Unable to store pickled data: %s', e)
-            pkl.close()
-            shutil.move(tempfn, filename)
-        except (IOError, shutil.Error), e:
-            self.log.warning('File error: %s', e)
+                pklfd, tempfn = tempfile.mkstemp(suffix='topic', dir=datadir)
+                pkl = os.fdopen(pklfd, 'wb')
+                pkl.write(s)
+                pkl.flush()
+                os.fsync(pklfd)
+                pkl.close()
+                shutil.move(tempfn, filename)
+            except (IOError, OSError, shutil.Error), e:
+                self.log.warning('File error: %s', e)
+        return write
 
     def _splitTopic(self, topic, channel):
         separator = self.registryValue('separator', channel)
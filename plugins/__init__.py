@@ -35,6 +35,7 @@ import csv
 import sys
 import math
 import time
+import Queue
 import random
 import fnmatch
 import os.path
@@ -145,6 +146,7 @@ class ChannelDBHandler(object):
     suffix = '.db'
     def __init__(self, suffix='.db'):
         self.dbCache = ircutils.IrcDict()
+        self.dbLock = threading.Lock()
         suffix = self.suffix
         if self.suffix and self.suffix[0] != '.':
             suffix = '.' + suffix
@@ -162,14 +164,21 @@ class ChannelDBHandler(object):
 
     def getDb(self, channel):
         """Use this to get a database for a specific channel."""
-        currentThread = threading.currentThread()
-        if channel not in self.dbCache and currentThread == world.mainThread:
-            self.dbCache[channel] = self.makeDb(self.makeFilename(channel))
-        if currentThread != world.mainThread:
-            db = self.makeDb(self.makeFilename(channel))
-        else:
-            db = self.dbCache[channel]
-        db.autocommit = 1
+        self.dbLock.acquire()
+        try:
+            db = self.dbCache.get(channel)
+            if db is None:
+                db = self.makeDb(self.makeFilename(channel))
+                if world.isMainThread() or isinstance(db, SqliteDatabase):
+                    self.dbCache[channel] = db
+            elif not world.isMainThread() and \
+                 not isinstance(db, SqliteDatabase):
+                # Plain database connections can't be shared between threads.
+                db = self.makeDb(self.makeFilename(channel))
+        finally:
+            self.dbLock.release()
+        if not isinstance(db, SqliteDatabase):
+            db.autocommit = 1
         return db
 
     def die(self):
@@ -186,6 +195,264 @@ class ChannelDBHandler(object):
         gc.collect()
 
 
+class SqliteDatabase(object):
+    """A thread-safe SQLite database, shared by everything using its file.
+
+    Writes are queued to a writer thread of the database's own, so they
+    never block the caller; everything queued within batchDelay seconds of
+    the first write is committed as a single transaction.  Reads are done
+    on a small pool of connections, and first wait for the writes queued
+    before them to be committed, so callers still see their own writes.
+    The database is put in WAL mode so readers and the writer don't block
+    one another.  When a write raises, the transaction is rolled back and
+    the other writes batched with it are run again, so writes shouldn't do
+    anything besides writing to the database.
+
+    Use openSqliteDatabase rather than instantiating this directly.
+    """
+    batchDelay = 0.005
+    maxReaders = 4
+    def __init__(self, filename, setup=None, connect=None):
+        if connect is None:
+            import sqlite
+            connect = sqlite.connect
+        self.filename = filename
+        self.setup = setup
+        self.connect = connect
+        self.users = 1
+        self.queue = Queue.Queue()
+        self.hurry = threading.Event()
+        self.cond = threading.Condition()
+        self.submitted = 0
+        self.committed = 0
+        self.readers = []
+        self.openReaders = 0
+        self.db = self._connect()
+        self._execute(self.db, 'PRAGMA journal_mode=WAL')
+        self._execute(self.db, 'PRAGMA synchronous=NORMAL')
+        self.writer = world.SupyThread(target=self._write,
+                                       name='SQLite writer for %s' %
+                                            os.path.basename(filename))
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def _connect(self):
+        db = self.connect(self.filename)
+        if self.setup is not None:
+            self.setup(db)
+        return db
+
+    def _execute(self, db, sql):
+        # PySQLite starts a transaction before each statement unless it's in
+        # autocommit mode, and some pragmas don't work inside of one.
+        autocommit = getattr(db, 'autocommit', None)
+        if autocommit is not None:
+            db.autocommit = 1
+        try:
+            try:
+                db.cursor().execute(sql)
+            except Exception, e:
+                log.debug('Couldn\'t %s on %s: %s', sql, self.filename, e)
+        finally:
+            if autocommit is not None:
+                db.autocommit = autocommit
+
+    def _write(self):
+        db = self.db
+        running = True
+        while running:
+            jobs = [self.queue.get()]
+            # Wait a bit to commit whatever else is written meanwhile in the
+            # same transaction, unless someone is waiting on us to read.
+            self.hurry.wait(self.batchDelay)
+            self.hurry.clear()
+            while True:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in jobs:
+                running = False
+                jobs.remove(None)
+            self._runBatch(db, jobs)
+            self.cond.acquire()
+            try:
+                self.committed += len(jobs)
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+        db.close()
+
+    def _runBatch(self, db, jobs):
+        """Runs the jobs in a single transaction and commits it.  A job that
+        raises mustn't leave half of its writes behind, so then the whole
+        transaction is rolled back and the other jobs are run again without
+        it."""
+        jobs = list(jobs)
+        while True:
+            cursor = db.cursor()
+            results = []
+            for (i, (f, args, result)) in enumerate(jobs):
+                try:
+                    results.append((result, f(cursor, *args)))
+                except Exception, e:
+                    if result is None:
+                        log.exception('Uncaught exception writing to %s:',
+                                      self.filename)
+                    else:
+                        result.append((False, e))
+                    del jobs[i]
+                    break
+            else:
+                break
+            try:
+                db.rollback()
+            except Exception, e:
+                log.exception('Uncaught exception rolling back %s:',
+                              self.filename)
+        try:
+            db.commit()
+        except Exception, e:
+            log.exception('Uncaught exception committing to %s:',
+                          self.filename)
+        for (result, x) in results:
+            if result is not None:
+                result.append((True, x))
+
+    def _submit(self, f, args, result=None):
+        self.cond.acquire()
+        try:
+            self.submitted += 1
+            self.queue.put((f, args, result))
+            return self.submitted
+        finally:
+            self.cond.release()
+
+    def _wait(self, n):
+        self.cond.acquire()
+        try:
+            while self.committed < n:
+                self.hurry.set()
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def submit(self, f, *args):
+        """Queues f(cursor, *args) to be run (and committed) by the writer
+        thread, and returns immediately."""
+        self._submit(f, args)
+
+    def execute(self, sql, *args):
+        """Queues the given SQL statement to be executed by the writer thread,
+        and returns immediately."""
+        self._submit(_executeSql, (sql,) + args)
+
+    def transaction(self, f, *args):
+        """Runs f(cursor, *args) in the writer thread and returns what it
+        returns (or raises what it raises) once it's been committed.  Use this
+        for writes that depend on what's in the database."""
+        result = []
+        self._wait(self._submit(f, args, result))
+        [(succeeded, x)] = result
+        if not succeeded:
+            raise x
+        return x
+
+    def sync(self):
+        """Waits for every write queued so far to be committed."""
+        self.cond.acquire()
+        try:
+            n = self.submitted
+        finally:
+            self.cond.release()
+        self._wait(n)
+
+    def read(self, f, *args):
+        """Returns f(cursor, *args), run with one of the read connections."""
+        self.sync()
+        self.cond.acquire()
+        try:
+            while not self.readers and self.openReaders >= self.maxReaders:
+                self.cond.wait()
+            if self.readers:
+                db = self.readers.pop()
+            else:
+                db = None
+                self.openReaders += 1
+        finally:
+            self.cond.release()
+        try:
+            if db is None:
+                db = self._connect()
+                if getattr(db, 'autocommit', None) is not None:
+                    # Otherwise PySQLite would keep a transaction open, and
+                    # we wouldn't see anything written after it started.
+                    db.autocommit = 1
+            return f(db.cursor(), *args)
+        finally:
+            self.cond.acquire()
+            try:
+                if db is None:
+                    self.openReaders -= 1
+                else:
+                    self.readers.append(db)
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+    def query(self, sql, *args):
+        """Returns the list of rows the given SQL query results in."""
+        return self.read(_querySql, sql, *args)
+
+    def close(self):
+        _sqliteLock.acquire()
+        try:
+            self.users -= 1
+            if self.users:
+                return
+            if _sqliteDatabases.get(self.filename) is self:
+                del _sqliteDatabases[self.filename]
+        finally:
+            _sqliteLock.release()
+        self.queue.put(None)
+        self.hurry.set()
+        self.writer.join()
+        self.cond.acquire()
+        try:
+            for db in self.readers:
+                db.close()
+            self.readers = []
+        finally:
+            self.cond.release()
+
+def _executeSql(cursor, sql, *args):
+    cursor.execute(sql, *args)
+
+def _querySql(cursor, sql, *args):
+    cursor.execute(sql, *args)
+    return cursor.fetchall()
+
+_sqliteLock = threading.Lock()
+_sqliteDatabases = {}
+def openSqliteDatabase(filename, setup=None, connect=None):
+    """Returns the SqliteDatabase for the given file, opening it if it isn't
+    already open.  setup, if given, is called with each new connection to
+    the database (to define SQL functions and the like); use transaction to
+    create the database's tables.  Each call should be matched by a call to
+    the database's close method."""
+    _sqliteLock.acquire()
+    try:
+        try:
+            db = _sqliteDatabases[filename]
+            db.users += 1
+        except KeyError:
+            db = SqliteDatabase(filename, setup=setup, connect=connect)
+            _sqliteDatabases[filename] = db
+        return db
+    finally:
+        _sqliteLock.release()
+
+
 class DbiChannelDB(object):
     """This just handles some of the general stuff for Channel DBI databases.
     Check out ChannelIdDatabasePlugin for an example of how to use this."""
@@ -250,13 +517,41 @@ class ChannelUserDictionary(UserDict.DictMixin):
 #     would very much feel like an extension, rather than part of the db
 #     itself.
 class ChannelUserDB(ChannelUserDictionary):
+    """A ChannelUserDictionary kept in a CSV file.
+
+    Rather than rewriting the whole file on every flush, only the entries set
+    or deleted since the last flush are appended to a journal next to it;
+    the file itself is rewritten (and the journal removed) once the journal
+    has grown bigger than it.  Values modified in place have to be marked
+    with markDirty to be flushed.
+
+    The snapshot method, which should be what's added to world.flushers,
+    only serializes the changed entries; the writing and the rewriting of the
+    file (which is done from what's on disk, not from the entries in memory)
+    are left to the world.flushWriter thread.
+    """
+    # We don't bother rewriting the file until the journal is at least this
+    # big.
+    minimumJournalSize = 64 * 1024
     def __init__(self, filename):
         ChannelUserDictionary.__init__(self)
         self.filename = filename
+        self.journalName = filename + '.journal'
+        self.dirty = set()
+        self._load(self.filename)
+        self._load(self.journalName, journal=True)
         try:
-            fd = file(self.filename)
+            self.journalSize = os.path.getsize(self.journalName)
+        except EnvironmentError:
+            self.journalSize = 0
+        self.dirty.clear()
+
+    def _load(self, filename, journal=False):
+        try:
+            fd = file(filename)
         except EnvironmentError, e:
-            log.warning('Couldn\'t open %s: %s.', self.filename, e)
+            if not journal:
+                log.warning('Couldn\'t open %s: %s.', filename, e)
             return
         reader = csv.reader(fd)
         try:
@@ -264,6 +559,10 @@ class ChannelUserDB(ChannelUserDictionary):
             for t in reader:
                 lineno += 1
                 try:
+                    if journal:
+                        op = t.pop(0)
+                    else:
+                        op = '+'
                     channel = t.pop(0)
                     id = t.pop(0)
                     try:
@@ -271,8 +570,14 @@ class ChannelUserDB(ChannelUserDictionary):
                     except ValueError:
                         # We'll skip over this so, say, nicks can be kept here.
                         pass
-                    v = self.deserialize(channel, id, t)
-                    self[channel, id] = v
+                    if op == '+':
+                        v = self.deserialize(channel, id, t)
+                        self[channel, id] = v
+                    elif op == '-':
+                        if (channel, id) in self:
+                            del self[channel, id]
+                    else:
+                        raise ValueError, 'Invalid operation: %r' % op
                 except Exception, e:
                     log.warning('Invalid line #%s in %s.',
                                 lineno, self.__class__.__name__)
@@ -281,27 +586,95 @@ class ChannelUserDB(ChannelUserDictionary):
             log.warning('Invalid line #%s in %s.',
                         lineno, self.__class__.__name__)
             log.debug('Exception: %s', utils.exnToString(e))
+        fd.close()
+
+    def __setitem__(self, key, v):
+        ChannelUserDictionary.__setitem__(self, key, v)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        ChannelUserDictionary.__delitem__(self, key)
+        self.dirty.add(key)
+
+    def markDirty(self, channel, id):
+        """Marks the entry for (channel, id) as needing to be flushed; use
+        this after modifying its value in place."""
+        self.dirty.add((channel, id))
+
+    def snapshot(self):
+        """Returns a callable writing the entries changed since the last
+        snapshot to disk, or None if nothing has changed."""
+        if not self.dirty:
+            return None
+        (dirty, self.dirty) = (self.dirty, set())
+        rows = []
+        for (channel, id) in dirty:
+            try:
+                v = self[channel, id]
+            except KeyError:
+                rows.append(['-', channel, id])
+            else:
+                L = ['+', channel, id]
+                L.extend(self.serialize(v))
+                rows.append(L)
+        return lambda: self._write(rows)
 
     def flush(self):
-        fd = utils.file.AtomicFile(self.filename, makeBackupIfSmaller=False)
-        writer = csv.writer(fd)
-        items = self.items()
-        if not items:
+        write = self.snapshot()
+        if write is not None:
+            # Our earlier writes have to be done before this one.
+            world.flushWriter.wait()
+            write()
+
+    def _write(self, rows):
+        fd = file(self.journalName, 'a')
+        csv.writer(fd).writerows(rows)
+        fd.flush()
+        os.fsync(fd.fileno())
+        fd.close()
+        self.journalSize = os.path.getsize(self.journalName)
+        if not os.path.exists(self.filename) or \
+           self.journalSize > max(self.minimumJournalSize,
+                                  os.path.getsize(self.filename)):
+            self._compact()
+
+    def _compact(self):
+        rows = {}
+        def key(channel, id):
+            return (ircutils.toLower(channel), id)
+        if os.path.exists(self.filename):
+            fd = file(self.filename)
+            try:
+                for t in csv.reader(fd):
+                    if len(t) >= 2:
+                        rows[key(t[0], t[1])] = t
+            finally:
+                fd.close()
+        fd = file(self.journalName)
+        try:
+            for t in csv.reader(fd):
+                if len(t) >= 3:
+                    if t[0] == '+':
+                        rows[key(t[1], t[2])] = t[1:]
+                    elif t[0] == '-':
+                        rows.pop(key(t[1], t[2]), None)
+        finally:
+            fd.close()
+        if not rows:
+            # Deletions still need to be kept track of, so the journal stays.
             log.debug('%s: Refusing to write blank file.',
                       self.__class__.__name__)
-            fd.rollback()
             return
-        items.sort()
-        for ((channel, id), v) in items:
-            L = self.serialize(v)
-            L.insert(0, id)
-            L.insert(0, channel)
-            writer.writerow(L)
+        fd = utils.file.AtomicFile(self.filename, makeBackupIfSmaller=False,
+                                   fsync=True)
+        csv.writer(fd).writerows(rows.itervalues())
         fd.close()
+        os.remove(self.journalName)
+        self.journalSize = 0
 
     def close(self):
         self.flush()
-        self.clear()
+        self.channels.clear()
 
     def deserialize(self, channel, id, L):
         """Should take a list of strings and return an object to be accessed
@@ -409,6 +782,7 @@ class ChannelIdDatabasePlugin(callbacks.Plugin):
         Searches for $types matching the criteria given.
         """
         predicates = []
+        regexps = []
         def p(record):
             for predicate in predicates:
                 if not predicate(record):
@@ -419,14 +793,19 @@ class ChannelIdDatabasePlugin(callbacks.Plugin):
             if opt == 'by':
                 predicates.append(lambda r, arg=arg: r.by == arg.id)
             elif opt == 'regexp':
-                predicates.append(lambda r: regexp_wrapper(r.text, reobj=arg,
-                        timeout=0.1, plugin_name=self.name(), fcn_name='search'))
+                regexps.append(arg)
         if glob:
             def globP(r, glob=glob.lower()):
                 return fnmatch.fnmatch(r.text.lower(), glob)
             predicates.append(globP)
+        records = list(self.db.select(channel, p))
+        for reobj in regexps:
+            matched = regexp_batch([r.text for r in records], reobj,
+                                   timeout=0.1, plugin_name=self.name(),
+                                   fcn_name='search')
+            records = [r for (r, b) in zip(records, matched) if b]
         L = []
-        for record in self.db.select(channel, p):
+        for record in records:
             L.append(self.searchSerializeRecord(record))
         if L:
             L.sort()
@@ -538,7 +917,6 @@ class PeriodicFileDownloader(object):
             self.getFile(filename)
 
     def _downloadFile(self, filename, url, f):
-        self.currentlyDownloading.add(filename)
         try:
             try:
                 infd = utils.web.getUrlFd(url)
@@ -587,11 +965,10 @@ class PeriodicFileDownloader(object):
             self.log.info('Beginning download of %s', url)
             args = (filename, url, f)
             name = '%s #%s' % (filename, self.downloadedCounter[filename])
-            t = threading.Thread(target=self._downloadFile, name=name,
-                                 args=(filename, url, f))
-            t.setDaemon(True)
-            t.start()
-            world.threadsSpawned += 1
+            self.currentlyDownloading.add(filename)
+            if not world.threads.submit(self._downloadFile, args=args,
+                                        name=name, group=self.name()):
+                self.currentlyDownloading.remove(filename)
 
 
 
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Times finding the callbacks for a command among many plugins, with the
+CommandTrie findCallbacksForArgs uses against asking the getCommand of every
+plugin, as findCallbacksForArgs used to.
+
+Usage: callbacks.py [number-of-plugins [number-of-commands-per-plugin]]
+"""
+
+import sys
+import time
+import random
+
+import supybot.conf as conf
+import supybot.registry as registry
+import supybot.callbacks as callbacks
+
+def command(self, irc, msg, args):
+    pass
+
+def makePlugins(plugins, commands):
+    L = []
+    for i in xrange(plugins):
+        d = {}
+        for j in xrange(commands):
+            d['command%s' % j] = command
+        d['plugin%scommand' % i] = command
+        cls = type('Plugin%s' % i, (callbacks.Plugin,), d)
+        conf.registerPlugin(cls.__name__)
+        L.append(cls(None))
+    return L
+
+def linearFind(cbs, args):
+    args = map(callbacks.canonicalName, args)
+    found = []
+    maxL = []
+    for cb in cbs:
+        L = cb.getCommand(args)
+        if L and L >= maxL:
+            maxL = L
+            found.append((cb, L))
+    found = [cb for (cb, L) in found if L == maxL]
+    if len(maxL) == 1:
+        for cb in found:
+            if cb.canonicalName() == maxL[0]:
+                return (maxL, [cb])
+        defaultPlugins = conf.supybot.commands.defaultPlugins
+        try:
+            defaultPlugin = defaultPlugins.get(maxL[0])()
+            if defaultPlugin:
+                for cb in found:
+                    if cb.name() == defaultPlugin:
+                        return (maxL, [cb])
+        except registry.NonExistentRegistryEntry:
+            pass
+        important = map(callbacks.canonicalName,
+                        defaultPlugins.importantPlugins())
+        importants = [cb for cb in found if cb.canonicalName() in important]
+        if len(importants) == 1:
+            return (maxL, importants)
+    return (maxL, found)
+
+def trieFind(cbs, args):
+    args = map(callbacks.canonicalName, args)
+    return callbacks.getCommandTrie(cbs).find(args)
+
+def bench(label, f, cbs, argses):
+    start = time.time()
+    for args in argses:
+        f(cbs, args)
+    elapsed = time.time() - start
+    print '%-15s %8.3fs %10.3fms/command' % (label, elapsed,
+                                            elapsed * 1000 / len(argses))
+
+if __name__ == '__main__':
+    plugins = 40
+    commands = 20
+    if len(sys.argv) > 1:
+        plugins = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        commands = int(sys.argv[2])
+    cbs = makePlugins(plugins, commands)
+    random.seed(0)
+    argses = []
+    for _ in xrange(2000):
+        i = random.randrange(plugins)
+        argses.append(random.choice([
+            ['plugin%scommand' % i, 'some', 'args'],
+            ['Plugin%s' % i, 'command%s' % random.randrange(commands)],
+            ['command%s' % random.randrange(commands)],
+            ['nocommand', 'at', 'all'],
+            ]))
+    start = time.time()
+    callbacks.getCommandTrie(cbs)
+    print '%-15s %8.3fs' % ('building', time.time() - start)
+    bench('linear', linearFind, cbs, argses)
+    bench('trie', trieFind, cbs, argses)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
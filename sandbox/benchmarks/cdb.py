@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+Times random lookups on a large CDB database, comparing cdb.Reader (which
+works on the mmapped file) against the seek-and-read probing it used to do,
+and then repeats the mmapped lookups from several threads sharing one Reader.
+Finally, times merging a journal of changes into the database, and
+ReaderWriter.load importing as many new records into it.
+
+Usage: cdb.py [number-of-keys]
+"""
+
+import os
+import sys
+import glob
+import time
+import random
+import tempfile
+import threading
+
+import supybot.cdb as cdb
+
+def makeDb(filename, n):
+    start = time.time()
+    maker = cdb.Maker(filename)
+    for i in xrange(n):
+        maker.add('key%s' % i, 'value%s' % i)
+    maker.finish()
+    elapsed = time.time() - start
+    print '%-30s %8.3fs' % ('Maker for %s keys' % n, elapsed)
+
+def makeKeys(n, count):
+    random.seed(0)
+    # About a tenth of them won't be found.
+    return ['key%s' % random.randrange(n + n // 10) for _ in xrange(count)]
+
+def seekingFind(fd, key):
+    def read(n, pos):
+        fd.seek(pos)
+        return fd.read(n)
+    khash = cdb.hash(key)
+    (hpos, hslots) = cdb.unpack2Ints(read(8, (khash * 8) & 2047))
+    if not hslots:
+        raise KeyError, key
+    kpos = hpos + (((khash / 256) % hslots) * 8)
+    for _ in xrange(hslots):
+        (h, p) = cdb.unpack2Ints(read(8, kpos))
+        if p == 0:
+            break
+        kpos += 8
+        if kpos == hpos + (hslots * 8):
+            kpos = hpos
+        if h == khash:
+            (u, dlen) = cdb.unpack2Ints(read(8, p))
+            if u == len(key) and read(u, p+8) == key:
+                return read(dlen, p+8+u)
+    raise KeyError, key
+
+def bench(label, f, db, keys):
+    start = time.time()
+    for key in keys:
+        try:
+            f(db, key)
+        except KeyError:
+            pass
+    elapsed = time.time() - start
+    print '%-30s %8.3fs %10.3fus/lookup' % (label, elapsed,
+                                           elapsed * 1000000 / len(keys))
+
+def benchThreaded(label, reader, keys, n=4):
+    def lookup(keys):
+        for key in keys:
+            reader.get(key)
+    threads = [threading.Thread(target=lookup, args=(keys[i::n],))
+               for i in xrange(n)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    print '%-30s %8.3fs %10.3fus/lookup' % (label, elapsed,
+                                           elapsed * 1000000 / len(keys))
+
+def benchCompaction(filename, n):
+    db = cdb.open(filename, 'w')
+    for i in xrange(0, n, 1000):
+        db['key%s' % i] = 'changed'
+        del db['key%s' % (i + 1)]
+    start = time.time()
+    db.flush()
+    elapsed = time.time() - start
+    print '%-30s %8.3fs' % ('compacting %s changes' % (n // 500), elapsed)
+    start = time.time()
+    db.load(('new%s' % i, 'value%s' % i) for i in xrange(n))
+    elapsed = time.time() - start
+    print '%-30s %8.3fs' % ('load of %s keys' % n, elapsed)
+    db.close()
+
+if __name__ == '__main__':
+    n = 1000000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    (fd, filename) = tempfile.mkstemp('.cdb')
+    os.close(fd)
+    try:
+        makeDb(filename, n)
+        keys = makeKeys(n, 200000)
+        fd = file(filename, 'rb')
+        bench('seek/read lookup', seekingFind, fd, keys)
+        fd.close()
+        reader = cdb.Reader(filename)
+        bench('mmap lookup', cdb.Reader.get, reader, keys)
+        benchThreaded('mmap lookup, 4 threads', reader, keys)
+        reader.close()
+        benchCompaction(filename, n)
+    finally:
+        # AtomicFile backs up the database when compacting shrinks it.
+        for filename in [filename] + glob.glob(filename + '.backup.*'):
+            os.remove(filename)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
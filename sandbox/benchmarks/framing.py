@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Replays a burst of inbound IRC traffic through drivers.parseMsg, framing it
+the way the Socket driver used to (string concatenation and split) and with
+drivers.LineBuffer.
+
+Usage: framing.py [captured-traffic-file]
+
+Without a file, a synthetic 100,000 line netjoin/NAMES/PRIVMSG burst is used.
+"""
+
+import sys
+import time
+import random
+
+import supybot.drivers as drivers
+
+def syntheticBurst(n=100000):
+    random.seed(0)
+    nicks = ['nick%s' % i for i in xrange(3000)]
+    L = []
+    while len(L) < n:
+        r = random.random()
+        nick = random.choice(nicks)
+        if r < 0.4:
+            L.append(':%s!~%s@host-%s.example.net JOIN :#chan%s' %
+                     (nick, nick, random.randint(0, 999), random.randint(0, 50)))
+        elif r < 0.6:
+            names = ' '.join(random.sample(nicks, 40))
+            L.append(':irc.example.net 353 bot = #chan%s :%s' %
+                     (random.randint(0, 50), names))
+        else:
+            L.append(':%s!~%s@host.example.net PRIVMSG #chan :%s' %
+                     (nick, nick, 'x' * random.randint(10, 300)))
+    return '\r\n'.join(L) + '\r\n'
+
+class FakeConn(object):
+    def __init__(self, data):
+        self.data = data
+        self.i = 0
+
+    def recv(self, size):
+        s = self.data[self.i:self.i+size]
+        self.i += len(s)
+        return s
+
+    def recv_into(self, buf, size):
+        s = self.recv(size)
+        buf[:len(s)] = s
+        return len(s)
+
+def splitting(data, readSize):
+    conn = FakeConn(data)
+    inbuffer = ''
+    n = 0
+    while conn.i < len(data):
+        inbuffer += conn.recv(readSize)
+        lines = inbuffer.split('\n')
+        inbuffer = lines.pop()
+        for line in lines:
+            if drivers.parseMsg(line) is not None:
+                n += 1
+    return n
+
+def lineBuffer(data, readSize):
+    conn = FakeConn(data)
+    inbuffer = drivers.LineBuffer(readSize)
+    n = 0
+    while conn.i < len(data):
+        inbuffer.recvFrom(conn)
+        for line in inbuffer.lines():
+            if drivers.parseMsg(line) is not None:
+                n += 1
+    return n
+
+def bench(name, f, *args):
+    start = time.time()
+    n = f(*args)
+    elapsed = time.time() - start
+    print '%-30s %8d lines %8.3fs %10.0f lines/s' % (name, n, elapsed,
+                                                      n / elapsed)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        data = open(sys.argv[1], 'rb').read()
+    else:
+        data = syntheticBurst()
+    print '%s bytes of input.' % len(data)
+    bench('split, 1024 byte reads', splitting, data, 1024)
+    bench('split, 8192 byte reads', splitting, data, 8192)
+    bench('LineBuffer, 1024 byte reads', lineBuffer, data, 1024)
+    bench('LineBuffer, 8192 byte reads', lineBuffer, data, 8192)
+    bench('LineBuffer, 65536 byte reads', lineBuffer, data, 65536)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+Times hostmask lookups and setUser on a large user database, comparing
+UsersDictionary.getUserId against the linear scan over every user's
+hostmasks it used to do on a cache miss.
+
+Usage: ircdb.py [number-of-users]
+"""
+
+import sys
+import time
+import random
+
+import supybot.ircdb as ircdb
+
+def makeUsers(users, n):
+    random.seed(0)
+    start = time.time()
+    for i in xrange(n):
+        u = users.newUser()
+        u.name = 'user%s' % i
+        r = random.random()
+        if r < 0.5:
+            u.addHostmask('*!*@host%s.example.net' % i)
+        elif r < 0.8:
+            u.addHostmask('*!*@*.isp%s.example.com' % i)
+            u.addHostmask('nick%s!*@*' % i)
+        else:
+            u.addHostmask('nick%s!~user%s@10.%s.%s.%s' %
+                          (i, i, i // 65536, (i // 256) % 256, i % 256))
+        users.setUser(u, flush=False)
+    elapsed = time.time() - start
+    print '%-30s %8.3fs' % ('setUser for %s users' % n, elapsed)
+
+def makeHostmasks(n, count):
+    random.seed(1)
+    L = []
+    for _ in xrange(count):
+        i = random.randrange(n * 2) # About half of them won't match.
+        L.append('nick%s!~user%s@host%s.example.net' % (i, i, i))
+    return L
+
+def linearGetUserId(users, s):
+    ids = {}
+    for (id, user) in users.users.iteritems():
+        x = user.checkHostmask(s)
+        if x:
+            ids[id] = x
+    if len(ids) == 1:
+        return ids.keys()[0]
+    raise KeyError, s
+
+def bench(label, f, users, hostmasks):
+    start = time.time()
+    for s in hostmasks:
+        try:
+            f(users, s)
+        except KeyError:
+            pass
+    elapsed = time.time() - start
+    print '%-30s %8.3fs %10.3fms/lookup' % (label, elapsed,
+                                           elapsed * 1000 / len(hostmasks))
+
+if __name__ == '__main__':
+    n = 20000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    users = ircdb.UsersDictionary()
+    users.noFlush = True
+    makeUsers(users, n)
+    hostmasks = makeHostmasks(n, 10000)
+    bench('linear getUserId', linearGetUserId, users, hostmasks[:5])
+    bench('indexed getUserId', ircdb.UsersDictionary.getUserId,
+          users, hostmasks)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""
+netsplit: Times a netsplit (a burst of QUITs) and a burst of NICK changes on a
+large IrcState, comparing the nick index IrcState keeps against going through
+every channel for each message, as doQuit and doNick used to.
+
+copy: Measures the time and memory taken by IrcState.copy on a large state
+(100 channels and 50000 users by default), against a deepcopy of it.
+
+history: Measures the memory taken by a history of 10000 messages (as tagged
+by Irc.feedMsg) and the time taken to find the last message to a quiet
+channel, with a MsgHistory and with a RingBuffer of IrcMsgs.
+
+Usage: irclib.py [netsplit|copy|history] [number-of-channels [number-of-users]]
+"""
+
+import gc
+import os
+import sys
+import copy
+import time
+import random
+
+import supybot.irclib as irclib
+import supybot.ircmsgs as ircmsgs
+import supybot.ircutils as ircutils
+from supybot.utils.structures import RingBuffer
+
+class FakeIrc(object):
+    nick = 'supybot'
+    prefix = 'supybot!supybot@example.net'
+
+def makeState(channels, users):
+    random.seed(0)
+    state = irclib.IrcState()
+    irc = FakeIrc()
+    for i in xrange(channels):
+        state.addMsg(irc, ircmsgs.join('#chan%s' % i, prefix=irc.prefix))
+    for i in xrange(users):
+        prefix = 'nick%s!user%s@host%s.example.net' % (i, i, i)
+        for j in random.sample(xrange(channels), random.randint(1, 5)):
+            state.addMsg(irc, ircmsgs.join('#chan%s' % j, prefix=prefix))
+    return (irc, state)
+
+def linearQuit(state, irc, msg):
+    for channel in state.channels.itervalues():
+        channel.removeUser(msg.nick)
+
+def linearNick(state, irc, msg):
+    for channel in state.channels.itervalues():
+        channel.replaceUser(msg.nick, msg.args[0])
+
+def rss():
+    # Only works on Linux, but that's good enough for a benchmark.
+    fd = file('/proc/self/statm')
+    try:
+        return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        fd.close()
+
+def benchCopy(label, f, state, touch=0):
+    gc.collect()
+    before = rss()
+    start = time.time()
+    copies = [f(state) for _ in xrange(10)]
+    for c in copies:
+        # Touching channels of the copies makes them copy those channels.
+        for (i, channel) in enumerate(c.channels.keys()[:touch]):
+            c.channels[channel].addUser('new%s' % i)
+    elapsed = time.time() - start
+    gc.collect()
+    print '%-30s %8.3fs/copy %8.1fMB/copy' % \
+          (label, elapsed / len(copies),
+           (rss() - before) / 1024.0 / 1024 / len(copies))
+    return copies
+
+def bench(label, f, state, irc, msgs):
+    start = time.time()
+    for msg in msgs:
+        f(state, irc, msg)
+    elapsed = time.time() - start
+    print '%-30s %8.3fs %10.3fms/msg' % (label, elapsed,
+                                        elapsed * 1000 / len(msgs))
+
+def netsplit(channels=400, users=20000):
+    nicks = [ircmsgs.IrcMsg(':nick%s!user%s@host%s.example.net NICK new%s' %
+                            (i, i, i, i)) for i in xrange(3000)]
+    quits = [ircmsgs.IrcMsg(':new%s!user%s@host%s.example.net QUIT :split' %
+                            (i, i, i)) for i in xrange(3000)]
+    (irc, state) = makeState(channels, users)
+    bench('linear NICK', linearNick, state, irc, nicks)
+    bench('linear QUIT', linearQuit, state, irc, quits)
+    (irc, state) = makeState(channels, users)
+    bench('indexed NICK', irclib.IrcState.doNick, state, irc, nicks)
+    bench('indexed QUIT', irclib.IrcState.doQuit, state, irc, quits)
+
+def copies(channels=100, users=50000):
+    gc.collect()
+    before = rss()
+    (irc, state) = makeState(channels, users)
+    gc.collect()
+    print '%-30s %8.1fMB' % ('state', (rss() - before) / 1024.0 / 1024)
+    # The copies are kept alive so the memory freed by one run isn't reused
+    # by the next one.
+    kept = benchCopy('copy', irclib.IrcState.copy, state)
+    kept += benchCopy('copy, 10 channels changed', irclib.IrcState.copy,
+                      state, touch=10)
+    kept += benchCopy('deepcopy', copy.deepcopy, state)
+
+def lastIn(history, channel):
+    for m in reversed(history):
+        if m.command == 'PRIVMSG' and ircutils.strEqual(m.args[0], channel):
+            return m
+
+def scanLastIn(history, channel):
+    for m in history.scan(command='PRIVMSG', channel=channel, reverse=True):
+        return m
+
+def histories(channels=100, users=1000, length=10000):
+    random.seed(0)
+    irc = FakeIrc()
+    msgs = []
+    for i in xrange(length):
+        nick = 'nick%s' % random.randrange(users)
+        prefix = '%s!user@%s.example.net' % (nick, nick)
+        text = 'x' * random.randint(10, 200)
+        if i == 0:
+            channel = '#quiet'
+        else:
+            channel = '#chan%s' % random.randrange(channels)
+        m = ircmsgs.IrcMsg(':%s PRIVMSG %s :%s\r\n' % (prefix, channel, text))
+        m.tag('receivedBy', irc)
+        m.tag('receivedOn', 'network')
+        m.tag('receivedAt', time.time())
+        msgs.append(m)
+    for (label, history, last) in (('RingBuffer', RingBuffer, lastIn),
+                                   ('MsgHistory', irclib.MsgHistory,
+                                    scanLastIn)):
+        gc.collect()
+        before = rss()
+        # Each message is made anew, as it would be when read from the
+        # network, so what's measured is what the history keeps.
+        h = history(length)
+        for m in msgs:
+            m1 = ircmsgs.IrcMsg(str(m))
+            m1.tags = m.tags.copy()
+            str(m1), repr(m1), hash(m1), m1.nick
+            h.append(m1)
+        gc.collect()
+        size = rss() - before
+        start = time.time()
+        for _ in xrange(10):
+            assert last(h, '#QUIET') is not None
+        elapsed = time.time() - start
+        print '%-15s %8.1fMB %10.3fms/last' % \
+              (label, size / 1024.0 / 1024, elapsed * 1000 / 10)
+        del h
+
+if __name__ == '__main__':
+    f = netsplit
+    args = sys.argv[1:]
+    if args and args[0] in ('netsplit', 'copy', 'history'):
+        f = {'netsplit': netsplit, 'copy': copies,
+             'history': histories}[args.pop(0)]
+    f(*map(int, args))
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+Compares the IrcMsg constructor against the old eager one (which split the
+prefix into nick/user/host and built a tags dictionary for every message) on
+a realistic mix of PRIVMSG, JOIN, MODE, and 353 lines.
+
+Usage: ircmsgs.py [number-of-lines]
+"""
+
+import sys
+import time
+import random
+
+import supybot.ircmsgs as ircmsgs
+import supybot.ircutils as ircutils
+
+class EagerIrcMsg(ircmsgs.IrcMsg):
+    """The parsing half of the IrcMsg constructor as it used to be."""
+    __slots__ = ()
+    def __init__(self, s):
+        self._str = None
+        self._repr = None
+        self._hash = None
+        self._len = None
+        self.tags = {}
+        originalString = s
+        try:
+            if not s.endswith('\n'):
+                s += '\n'
+            self._str = s
+            if s[0] == ':':
+                self.prefix, s = s[1:].split(None, 1)
+            else:
+                self.prefix = ''
+            if ' :' in s:
+                s, last = s.split(' :', 1)
+                self.args = s.split()
+                self.args.append(last.rstrip('\r\n'))
+            else:
+                self.args = s.split()
+            self.command = self.args.pop(0)
+        except (IndexError, ValueError):
+            raise ircmsgs.MalformedIrcMsg, repr(originalString)
+        self.args = tuple(self.args)
+        if ircutils.isUserHostmask(self.prefix):
+            (self.nick,self.user,self.host)=ircutils.splitHostmask(self.prefix)
+        else:
+            (self.nick, self.user, self.host) = (self.prefix,)*3
+
+def makeLines(n):
+    random.seed(0)
+    nicks = ['nick%s' % i for i in xrange(1000)]
+    L = []
+    for _ in xrange(n):
+        r = random.random()
+        nick = random.choice(nicks)
+        hostmask = '%s!~%s@host-%s.example.net' % (nick, nick,
+                                                   random.randint(0, 999))
+        if r < 0.6:
+            L.append(':%s PRIVMSG #chan :%s' %
+                     (hostmask, 'x' * random.randint(5, 200)))
+        elif r < 0.8:
+            L.append(':%s JOIN :#chan%s' % (hostmask, random.randint(0, 50)))
+        elif r < 0.9:
+            L.append(':%s MODE #chan +ov %s %s' % (hostmask, nick, nick))
+        else:
+            names = ' '.join(random.sample(nicks, 40))
+            L.append(':irc.example.net 353 bot = #chan :%s' % names)
+    return L
+
+def bench(name, f, lines):
+    start = time.time()
+    for line in lines:
+        f(line)
+    elapsed = time.time() - start
+    print '%-40s %8.3fs %10.0f msgs/s' % (name, elapsed, len(lines) / elapsed)
+
+def feedLike(cls):
+    # Roughly what Irc.feedMsg touches on every message.
+    def f(line):
+        msg = cls(line)
+        msg.tag('receivedAt', 0)
+        msg.nick
+    return f
+
+if __name__ == '__main__':
+    n = 200000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    lines = makeLines(n)
+    bench('eager constructor', EagerIrcMsg, lines)
+    bench('lazy constructor', ircmsgs.IrcMsg, lines)
+    bench('eager constructor, tag and nick', feedLike(EagerIrcMsg), lines)
+    bench('lazy constructor, tag and nick', feedLike(ircmsgs.IrcMsg), lines)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
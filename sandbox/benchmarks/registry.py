@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Compares PluginMixin.registryValue against the old uncached lookup (which
+walked conf.supybot.plugins down to the value, and to its channel child, on
+every call) for the kind of lookups a plugin's doPrivmsg does per message.
+
+Usage: registry.py [number-of-lookups]
+"""
+
+import sys
+import time
+import random
+
+import supybot.conf as conf
+import supybot.registry as registry
+import supybot.ircutils as ircutils
+import supybot.callbacks as callbacks
+
+conf.registerPlugin('Benchmark')
+conf.registerChannelValue(conf.supybot.plugins.Benchmark, 'enable',
+    registry.Boolean(True, 'help'))
+conf.registerGroup(conf.supybot.plugins.Benchmark, 'nested')
+conf.registerChannelValue(conf.supybot.plugins.Benchmark.nested, 'value',
+    registry.Integer(0, 'help'))
+conf.registerGlobalValue(conf.supybot.plugins.Benchmark, 'global',
+    registry.String('', 'help'))
+
+class Benchmark(callbacks.Plugin):
+    def uncachedRegistryValue(self, name, channel=None, value=True):
+        plugin = self.name()
+        group = conf.supybot.plugins.get(plugin)
+        names = registry.split(name)
+        for name in names:
+            group = group.get(name)
+        if channel is not None:
+            if ircutils.isChannel(channel):
+                group = group.get(channel)
+        if value:
+            return group()
+        else:
+            return group
+
+def makeLookups(n):
+    random.seed(0)
+    channels = ['#chan%s' % i for i in xrange(50)]
+    names = ['enable', 'nested.value', 'global']
+    L = []
+    for _ in xrange(n):
+        name = random.choice(names)
+        if name == 'global':
+            L.append((name, None))
+        else:
+            L.append((name, random.choice(channels)))
+    return L
+
+def bench(label, f, lookups):
+    start = time.time()
+    for (name, channel) in lookups:
+        f(name, channel)
+    elapsed = time.time() - start
+    print '%-30s %8.3fs %10.0f lookups/s' % (label, elapsed,
+                                            len(lookups) / elapsed)
+
+if __name__ == '__main__':
+    n = 500000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    lookups = makeLookups(n)
+    cb = Benchmark(None)
+    bench('uncached registryValue', cb.uncachedRegistryValue, lookups)
+    bench('cached registryValue', cb.registryValue, lookups)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
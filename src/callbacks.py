@@ -39,6 +39,7 @@ import shlex
 import getopt
 import inspect
 import operator
+import threading
 from cStringIO import StringIO
 
 from . import (conf, ircdb, irclib, ircmsgs, ircutils, log, registry, utils,
@@ -134,12 +135,7 @@ def addressed(nick, msg, **kwargs):
         msg.tag('addressed', payload)
         return payload
 
-def canonicalName(command):
-    """Turn a command into its canonical form.
-
-    Currently, this makes everything lowercase and removes all dashes and
-    underscores.
-    """
+def _canonicalName(command):
     if isinstance(command, unicode):
         command = command.encode('utf-8')
     special = '\t -_'
@@ -149,6 +145,15 @@ def canonicalName(command):
         command = command[:-1]
     return command.translate(utils.str.chars, special).lower() + reAppend
 
+_canonicalNames = utils.structures.MemoDict(_canonicalName)
+def canonicalName(command):
+    """Turn a command into its canonical form.
+
+    Currently, this makes everything lowercase and removes all dashes and
+    underscores.
+    """
+    return _canonicalNames[command]
+
 def reply(msg, s, prefixNick=None, private=None,
           notice=None, to=None, action=None, error=False):
     msg.tag('repliedTo')
@@ -565,6 +570,162 @@ class ReplyIrcProxy(RichReplyMethods):
 
 SimpleProxy = ReplyIrcProxy # Backwards-compatibility
 
+
+_commandsGeneration = 0
+def commandsChanged():
+    """Marks the commands of the loaded plugins as changed (a command was
+    disabled, enabled, renamed, or added or removed at run time), so the
+    CommandTrie is rebuilt."""
+    global _commandsGeneration
+    _commandsGeneration += 1
+
+class CommandTrie(object):
+    """The commands of a list of callbacks, in a trie keyed by the canonical
+    names of their words.  Finding the callbacks for some args is then a
+    single walk down the trie, rather than a call to the getCommand of every
+    callback.
+
+    The commands of each callback are taken from its listCommands, so
+    plugins with commands isCommandMethod doesn't find by itself must list
+    them there.  Callbacks with their own getCommand can't be indexed at all;
+    they're still asked for each lookup."""
+    def __init__(self, callbacks):
+        self.callbacks = callbacks
+        self.generation = (irclib._callbacksGeneration, _commandsGeneration)
+        # Each node is a (children, callbacks) pair, the callbacks being those
+        # for which the path to the node is a command, in their order in
+        # self.callbacks.
+        self.root = ({}, [])
+        self.order = {}
+        self.unindexed = []
+        # The (callback, commands) pairs of the callbacks, as their
+        # listCommands give them.
+        self.commands = []
+        self._answers = {}
+        self._answersGeneration = registry.generation
+        for (i, cb) in enumerate(callbacks):
+            if not hasattr(cb, 'getCommand'):
+                continue
+            self.order[cb] = i
+            if hasattr(cb, 'listCommands'):
+                self.commands.append((cb, cb.listCommands()))
+            if getattr(cb.__class__.getCommand, 'im_func', None) is not \
+               Commands.getCommand.im_func:
+                self.unindexed.append(cb)
+                continue
+            (_, commands) = self.commands[-1]
+            name = cb.canonicalName()
+            for command in commands:
+                words = map(canonicalName, command.split())
+                for path in (words, [name] + words):
+                    if cb.getCommand(path) == path:
+                        self._add(path, cb)
+
+    def _add(self, path, cb):
+        node = self.root
+        for word in path:
+            node = node[0].setdefault(word, ({}, []))
+        if cb not in node[1]:
+            node[1].append(cb)
+
+    def listCommands(self, cb):
+        """Returns the commands of cb, as its listCommands would."""
+        for (otherCb, commands) in self.commands:
+            if otherCb is cb:
+                return commands[:]
+        # It isn't one of our callbacks; perhaps it's nested in one of them.
+        return cb.listCommands()
+
+    def find(self, args):
+        """Returns a two-tuple of (command, callbacks): the longest prefix of
+        args (a list of canonical names) that's a command, and the callbacks
+        it's a command of."""
+        (maxL, cbs) = ([], [])
+        node = self.root
+        for (i, arg) in enumerate(args):
+            try:
+                node = node[0][arg]
+            except KeyError:
+                break
+            if node[1]:
+                (maxL, cbs) = (args[:i+1], node[1])
+        if self.unindexed:
+            for cb in self.unindexed:
+                L = cb.getCommand(args)
+                if not L:
+                    continue
+                assert utils.iter.startswith(L, args), \
+                       'getCommand must return a prefix of the args given.  ' \
+                       '(args given: %r, returned: %r)' % (args, L)
+                if len(L) > len(maxL):
+                    (maxL, cbs) = (L, [cb])
+                elif L == maxL:
+                    cbs = sorted(cbs + [cb], key=self.order.get)
+        if len(maxL) == 1 and len(cbs) > 1:
+            cbs = self._answer(maxL[0], cbs)
+        return (maxL, cbs[:])
+
+    def _answer(self, command, cbs):
+        """Returns the callbacks a single-word command is dispatched to when
+        it's a command of all the callbacks cbs.  The answers depend on the
+        registry, so they're kept until it changes."""
+        if self._answersGeneration != registry.generation:
+            self._answers = {}
+            self._answersGeneration = registry.generation
+        key = (command, tuple(cbs))
+        try:
+            return self._answers[key]
+        except KeyError:
+            answer = self._answers[key] = self._choose(command, cbs)
+            return answer
+
+    def _choose(self, command, cbs):
+        # In this case, we have to check, in order:
+        # 1. Whether the command is the same as the name of a callback.  This
+        #    callback would then win.
+        for cb in cbs:
+            if cb.canonicalName() == command:
+                return [cb]
+
+        # 2. Whether a defaultplugin is defined.
+        defaultPlugins = conf.supybot.commands.defaultPlugins
+        try:
+            defaultPlugin = defaultPlugins.get(command)()
+            log.debug('defaultPlugin: %r', defaultPlugin)
+            if defaultPlugin:
+                defaultPlugin = defaultPlugin.lower()
+                for cb in cbs:
+                    # There's a small possibility that a default plugin for
+                    # a command is configured to point to a plugin that
+                    # doesn't actually have that command.
+                    if cb.name().lower() == defaultPlugin:
+                        return [cb]
+        except registry.NonExistentRegistryEntry:
+            pass
+
+        # 3. Whether an importantPlugin is one of the responses.
+        important = defaultPlugins.importantPlugins()
+        important = map(canonicalName, important)
+        importants = []
+        for cb in cbs:
+            if cb.canonicalName() in important:
+                importants.append(cb)
+        if len(importants) == 1:
+            return importants
+        return cbs
+
+_commandTrie = None
+def getCommandTrie(callbacks):
+    """Returns the CommandTrie of the list of callbacks, building it again if
+    the callbacks or their commands changed since it was last built."""
+    global _commandTrie
+    trie = _commandTrie
+    if trie is None or trie.callbacks is not callbacks or \
+       trie.generation != (irclib._callbacksGeneration, _commandsGeneration):
+        trie = _commandTrie = CommandTrie(callbacks)
+    return trie
+
+
 class NestedCommandsIrcProxy(ReplyIrcProxy):
     "A proxy object to allow proper nesting of commands (even threaded ones)."
     _mores = ircutils.IrcDict()
@@ -653,7 +814,7 @@ class NestedCommandsIrcProxy(ReplyIrcProxy):
         for cb in self.irc.callbacks:
             if hasattr(cb, 'invalidCommand'):
                 cbs.append(cb)
-                threaded = threaded or cb.threaded
+                threaded = threaded or isThreaded(cb)
         def callInvalidCommands():
             self.repliedTo = False
             for cb in cbs:
@@ -670,10 +831,9 @@ class NestedCommandsIrcProxy(ReplyIrcProxy):
                     log.debug('Done calling invalidCommands: %s.',cb.name())
                     return
         if threaded:
-            name = 'Thread #%s (for invalidCommands)' % world.threadsSpawned
-            t = world.SupyThread(target=callInvalidCommands, name=name)
-            t.setDaemon(True)
-            t.start()
+            world.threads.submit(callInvalidCommands,
+                                 name='Thread for invalidCommands',
+                                 group='invalidCommands')
         else:
             callInvalidCommands()
 
@@ -682,58 +842,9 @@ class NestedCommandsIrcProxy(ReplyIrcProxy):
         (a list of strings) and the plugins for which it was a command."""
         assert isinstance(args, list)
         args = map(canonicalName, args)
-        cbs = []
-        maxL = []
-        for cb in self.irc.callbacks:
-            if not hasattr(cb, 'getCommand'):
-                continue
-            L = cb.getCommand(args)
-            #log.debug('%s.getCommand(%r) returned %r', cb.name(), args, L)
-            if L and L >= maxL:
-                maxL = L
-                cbs.append((cb, L))
-                assert isinstance(L, list), \
-                       'getCommand now returns a list, not a method.'
-                assert utils.iter.startswith(L, args), \
-                       'getCommand must return a prefix of the args given.  ' \
-                       '(args given: %r, returned: %r)' % (args, L)
+        (command, cbs) = getCommandTrie(self.irc.callbacks).find(args)
         log.debug('findCallbacksForArgs: %r', cbs)
-        cbs = [cb for (cb, L) in cbs if L == maxL]
-        if len(maxL) == 1:
-            # Special case: one arg determines the callback.  In this case, we
-            # have to check, in order:
-            # 1. Whether the arg is the same as the name of a callback.  This
-            #    callback would then win.
-            for cb in cbs:
-                if cb.canonicalName() == maxL[0]:
-                    return (maxL, [cb])
-
-            # 2. Whether a defaultplugin is defined.
-            defaultPlugins = conf.supybot.commands.defaultPlugins
-            try:
-                defaultPlugin = defaultPlugins.get(maxL[0])()
-                log.debug('defaultPlugin: %r', defaultPlugin)
-                if defaultPlugin:
-                    cb = self.irc.getCallback(defaultPlugin)
-                    if cb in cbs:
-                        # This is just a sanity check, but there's a small
-                        # possibility that a default plugin for a command
-                        # is configured to point to a plugin that doesn't
-                        # actually have that command.
-                        return (maxL, [cb])
-            except registry.NonExistentRegistryEntry:
-                pass
-
-            # 3. Whether an importantPlugin is one of the responses.
-            important = defaultPlugins.importantPlugins()
-            important = map(canonicalName, important)
-            importants = []
-            for cb in cbs:
-                if cb.canonicalName() in important:
-                    importants.append(cb)
-            if len(importants) == 1:
-                return (maxL, importants)
-        return (maxL, cbs)
+        return (command, cbs)
 
     def finalEval(self):
         # Now that we've already iterated through our args and made sure
@@ -771,10 +882,9 @@ class NestedCommandsIrcProxy(ReplyIrcProxy):
             cb = cbs[0]
             args = self.args[len(command):]
             if world.isMainThread() and \
-               (cb.threaded or conf.supybot.debug.threadAllCommands()):
-                t = CommandThread(target=cb._callCommand,
-                                  args=(command, self, self.msg, args))
-                t.start()
+               (isThreaded(cb) or conf.supybot.debug.threadAllCommands()):
+                threadCommand(target=cb._callCommand,
+                              args=(command, self, self.msg, args))
             else:
                 cb._callCommand(command, self, self.msg, args)
 
@@ -946,29 +1056,56 @@ class NestedCommandsIrcProxy(ReplyIrcProxy):
 
 IrcObjectProxy = NestedCommandsIrcProxy
 
-class CommandThread(world.SupyThread):
-    """Just does some extra logging and error-recovery for commands that need
-    to run in threads.
+_threadedLock = threading.Lock()
+def _countThreadedCommand(cb, n):
+    _threadedLock.acquire()
+    try:
+        cb.threadedCommands = getattr(cb, 'threadedCommands', 0) + n
+    finally:
+        _threadedLock.release()
+
+def isThreaded(cb):
+    """Returns whether cb's commands are run in threads: those of threaded
+    plugins always are, and those of the others are while one of their
+    commands is being run in a thread."""
+    return cb.threaded or getattr(cb, 'threadedCommands', 0) > 0
+
+def threadCommand(target, args=(), kwargs={}):
+    """Runs a command (target is a plugin's _callCommand, args its arguments)
+    in world.threads, with some extra logging and error-recovery.
     """
-    def __init__(self, target=None, args=(), kwargs={}):
-        self.command = args[0]
-        self.cb = target.im_self
-        threadName = 'Thread #%s (for %s.%s)' % (world.threadsSpawned,
-                                                 self.cb.name(),
-                                                 self.command)
-        log.debug('Spawning thread %s (args: %r)', threadName, args)
-        self.__parent = super(CommandThread, self)
-        self.__parent.__init__(target=target, name=threadName,
-                               args=args, kwargs=kwargs)
-        self.setDaemon(True)
-        self.originalThreaded = self.cb.threaded
-        self.cb.threaded = True
-
-    def run(self):
+    (command, irc) = args[:2]
+    cb = target.im_self
+    threadName = 'Thread for %s.%s' % (cb.name(), formatCommand(command))
+    log.debug('Queuing %s (args: %r)', threadName, args)
+    # Several of cb's commands may be queued or running at once, so we count
+    # them rather than set (and later restore) its threaded attribute.
+    _countThreadedCommand(cb, 1)
+    def run():
         try:
-            self.__parent.run()
+            target(*args, **kwargs)
         finally:
-            self.cb.threaded = self.originalThreaded
+            _countThreadedCommand(cb, -1)
+    if not world.threads.submit(run, name=threadName, group=cb.name()):
+        _countThreadedCommand(cb, -1)
+        irc.error('I\'m too busy to run that command right now.  Try again '
+                  'later.')
+
+class CommandThread(object):
+    """Kept for plugins that start their commands' threads themselves; the
+    command is queued to world.threads, as threadCommand does, when this is
+    start()ed.
+    """
+    def __init__(self, target=None, args=(), kwargs={}):
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+
+    def setDaemon(self, daemonic):
+        pass
+
+    def start(self):
+        threadCommand(self.target, self.args, self.kwargs)
 
 class CommandProcess(world.SupyProcess):
     """Just does some extra logging and error-recovery for commands that need
@@ -1033,6 +1170,7 @@ class DisabledCommands(object):
         return False
 
     def add(self, command, plugin=None):
+        commandsChanged()
         if plugin is None:
             self.d[command] = None
         else:
@@ -1043,6 +1181,7 @@ class DisabledCommands(object):
                 self.d[command] = CanonicalNameSet([plugin])
 
     def remove(self, command, plugin=None):
+        commandsChanged()
         if plugin is None:
             del self.d[command]
         else:
@@ -1230,10 +1369,44 @@ class Commands(BasePlugin):
         else:
             return format('The %q command has no help.',formatCommand(command))
 
+_registryGroups = {}
+_registryGroupsGeneration = None
+def getRegistryGroup(plugin, name, channel=None):
+    """Returns the registry node for plugin's value name (with its channel
+    child, if channel is a channel).
+
+    Lookups are cached, keyed by (plugin, name, channel); the cache is emptied
+    whenever the registry changes."""
+    global _registryGroups, _registryGroupsGeneration
+    if _registryGroupsGeneration != registry.generation:
+        _registryGroups = {}
+        _registryGroupsGeneration = registry.generation
+    key = (plugin, name, channel)
+    try:
+        return _registryGroups[key]
+    except KeyError:
+        generation = registry.generation
+        group = conf.supybot.plugins.get(plugin)
+        for name in registry.split(name):
+            group = group.get(name)
+        if channel is not None:
+            if ircutils.isChannel(channel):
+                group = group.get(channel)
+            else:
+                log.debug('registryValue got channel=%r', channel)
+        # Getting the channel child may well have registered it, so we only
+        # cache the group if nothing changed while we were looking it up.
+        if generation == registry.generation:
+            _registryGroups[key] = group
+        return group
+
 class PluginMixin(BasePlugin, irclib.IrcCallback):
+    # Our __call__ only checks ignores before dispatching.
+    __callDispatches__ = True
     public = True
     alwaysCall = ()
     threaded = False
+    threadedCommands = 0
     noIgnore = False
     classModule = None
     Proxy = NestedCommandsIrcProxy
@@ -1261,27 +1434,14 @@ class PluginMixin(BasePlugin, irclib.IrcCallback):
             self.__parent.__call__(irc, msg)
 
     def registryValue(self, name, channel=None, value=True):
-        plugin = self.name()
-        group = conf.supybot.plugins.get(plugin)
-        names = registry.split(name)
-        for name in names:
-            group = group.get(name)
-        if channel is not None:
-            if ircutils.isChannel(channel):
-                group = group.get(channel)
-            else:
-                self.log.debug('registryValue got channel=%r', channel)
+        group = getRegistryGroup(self.name(), name, channel)
         if value:
             return group()
         else:
             return group
 
     def setRegistryValue(self, name, value, channel=None):
-        plugin = self.name()
-        group = conf.supybot.plugins.get(plugin)
-        names = registry.split(name)
-        for name in names:
-            group = group.get(name)
+        group = getRegistryGroup(self.name(), name)
         if channel is None:
             group.setValue(value)
         else:
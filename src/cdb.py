@@ -34,17 +34,22 @@ the same as) DJB's CDB <http://cr.yp.to/cdb.html>.
 
 import os
 import sys
+import mmap
+import array
 import struct
 import os.path
+import threading
 import cPickle as pickle
 
 from . import utils
 
 def hash(s):
     """DJB's hash function for CDB."""
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
     h = 5381
-    for c in s:
-        h = ((h + (h << 5)) ^ ord(c)) & 0xFFFFFFFFL
+    for c in bytearray(s):
+        h = ((h + (h << 5)) ^ c) & 0xFFFFFFFF
     return h
 
 def unpack2Ints(s):
@@ -55,6 +60,13 @@ def pack2Ints(i, j):
     """Returns a packed binary string from the two ints."""
     return struct.pack('<LL', i, j)
 
+_uint32 = 'I'
+if array.array(_uint32).itemsize != 4:
+    _uint32 = 'L'
+
+_unpackInt = struct.Struct('<L').unpack_from
+_unpack2Ints = struct.Struct('<LL').unpack_from
+
 def dump(map, fd=sys.stdout):
     """Dumps a dictionary-structure in CDB format."""
     for (key, value) in map.iteritems():
@@ -129,24 +141,24 @@ def make(dbFilename, readFilename=None):
 class Maker(object):
     """Class for making CDB databases."""
     def __init__(self, filename):
-        self.fd = utils.file.AtomicFile(filename)
+        self.fd = utils.file.AtomicFile(filename, 'wb')
         self.filename = filename
         self.fd.seek(2048)
+        self.position = 2048
         self.hashPointers = [(0, 0)] * 256
-        #self.hashes = [[]] * 256 # Can't use this, [] stays the same...
-        self.hashes = []
-        for _ in xrange(256):
-            self.hashes.append([])
+        # The hash and position of each record, by the low byte of its hash.
+        # These are kept in flat arrays rather than lists of tuples, so even
+        # databases with millions of records don't take much memory to build.
+        self.hashes = [array.array(_uint32) for _ in xrange(256)]
 
     def add(self, key, data):
         """Adds a key->value pair to the database."""
         h = hash(key)
-        hashPointer = h % 256
-        startPosition = self.fd.tell()
-        self.fd.write(pack2Ints(len(key), len(data)))
-        self.fd.write(key)
-        self.fd.write(data)
-        self.hashes[hashPointer].append((h, startPosition))
+        hashes = self.hashes[h & 255]
+        hashes.append(h)
+        hashes.append(self.position)
+        self.fd.write(pack2Ints(len(key), len(data)) + key + data)
+        self.position += 8 + len(key) + len(data)
 
     def finish(self):
         """Finishes the current Maker object.
@@ -156,20 +168,31 @@ class Maker(object):
         for i in xrange(256):
             hash = self.hashes[i]
             self.hashPointers[i] = (self.fd.tell(), self._serializeHash(hash))
+            self.hashes[i] = None
         self._serializeHashPointers()
         self.fd.flush()
         self.fd.close()
 
+    def rollback(self):
+        """Abandons the database being made, leaving any existing file with
+        the same name untouched."""
+        self.fd.rollback()
+
     def _serializeHash(self, hash):
-        hashLen = len(hash) * 2
-        a = [(0, 0)] * hashLen
-        for (h, pos) in hash:
-            i = (h / 256) % hashLen
-            while a[i] != (0, 0):
-                i = (i + 1) % hashLen
-            a[i] = (h, pos)
-        for (h, pos) in a:
-            self.fd.write(pack2Ints(h, pos))
+        hashLen = len(hash)
+        a = array.array(_uint32, [0]) * (hashLen * 2)
+        for i in xrange(0, hashLen, 2):
+            (h, pos) = (hash[i], hash[i+1])
+            j = (h >> 8) % hashLen
+            # Positions are never 0 (the first record is at 2048), so an empty
+            # slot is one whose position is 0.
+            while a[2*j + 1]:
+                j = (j + 1) % hashLen
+            a[2*j] = h
+            a[2*j + 1] = pos
+        if sys.byteorder != 'little':
+            a.byteswap()
+        self.fd.write(a.tostring())
         return hashLen
 
     def _serializeHashPointers(self):
@@ -179,86 +202,74 @@ class Maker(object):
 
 
 class Reader(utils.IterableMap):
-    """Class for reading from a CDB database."""
+    """Class for reading from a CDB database.
+
+    The database is mapped into memory and every lookup works directly on the
+    mapped buffer, keeping its position in local variables rather than on the
+    instance, so a single Reader can safely be used by several threads at
+    once (and from within its own iteritems).
+    """
     def __init__(self, filename):
-        self.filename = filename
-        self.fd = file(filename, 'r')
-        self.loop = 0
-        self.khash = 0
-        self.kpos = 0
-        self.hpos = 0
-        self.hslots = 0
-        self.dpos = 0
-        self.dlen = 0
+        if hasattr(filename, 'fileno'):
+            self.fd = filename
+            self.filename = getattr(filename, 'name', None)
+        else:
+            self.filename = filename
+            self.fd = file(filename, 'rb')
+        self.map = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
 
     def close(self):
+        self.map.close()
         self.fd.close()
 
-    def _read(self, len, pos):
-        self.fd.seek(pos)
-        return self.fd.read(len)
-
-    def _match(self, key, pos):
-        return self._read(len(key), pos) == key
-
     def iteritems(self):
-        # uses loop/hslots in a strange, non-re-entrant manner.
-        (self.loop,) = struct.unpack('<i', self._read(4, 0))
-        self.hslots = 2048
-        while self.hslots < self.loop:
-            (klen, dlen) = unpack2Ints(self._read(8, self.hslots))
-            dpos = self.hslots + 8 + klen
-            ret = (self._read(klen, self.hslots+8), self._read(dlen, dpos))
-            self.hslots = dpos + dlen
-            yield ret
-        self.loop = 0
-        self.hslots = 0
-
-    def _findnext(self, key):
-        if not self.loop:
-            self.khash = hash(key)
-            (self.hpos, self.hslots) = unpack2Ints(self._read(8,
-                                                    (self.khash * 8) & 2047))
-            if not self.hslots:
-                return False
-            self.kpos = self.hpos + (((self.khash / 256) % self.hslots) * 8)
-        while self.loop < self.hslots:
-            (h, p) = unpack2Ints(self._read(8, self.kpos))
+        map = self.map
+        (end,) = _unpackInt(map, 0)
+        pos = 2048
+        while pos < end:
+            (klen, dlen) = _unpack2Ints(map, pos)
+            kpos = pos + 8
+            dpos = kpos + klen
+            pos = dpos + dlen
+            yield (map[kpos:dpos], map[dpos:pos])
+
+    def _lookup(self, key):
+        """Yields the (position, length) of the data of each record with the
+        given key, in the order they were added."""
+        map = self.map
+        khash = hash(key)
+        (hpos, hslots) = _unpack2Ints(map, (khash << 3) & 2047)
+        if not hslots:
+            return
+        klen = len(key)
+        hend = hpos + (hslots << 3)
+        kpos = hpos + (((khash >> 8) % hslots) << 3)
+        for _ in xrange(hslots):
+            (h, p) = _unpack2Ints(map, kpos)
             if p == 0:
-                return False
-            self.loop += 1
-            self.kpos += 8
-            if self.kpos == self.hpos + (self.hslots * 8):
-                self.kpos = self.hpos
-            if h == self.khash:
-                (u, self.dlen) = unpack2Ints(self._read(8, p))
-                if u == len(key):
-                    if self._match(key, p+8):
-                        self.dpos = p + 8 + u
-                        return True
-        return False
-
-    def _find(self, key, loop=0):
-        self.loop = loop
-        return self._findnext(key)
-
-    def _getCurrentData(self):
-        return self._read(self.dlen, self.dpos)
+                return
+            kpos += 8
+            if kpos == hend:
+                kpos = hpos
+            if h == khash:
+                (u, dlen) = _unpack2Ints(map, p)
+                if u == klen and map[p+8:p+8+klen] == key:
+                    yield (p + 8 + klen, dlen)
 
     def find(self, key, loop=0):
-        if self._find(key, loop=loop):
-            return self._getCurrentData()
-        else:
-            try:
-                return self.default
-            except AttributeError:
-                raise KeyError, key
+        """Returns the data of the loop'th record with the given key."""
+        for (pos, dlen) in self._lookup(key):
+            if not loop:
+                return self.map[pos:pos+dlen]
+            loop -= 1
+        try:
+            return self.default
+        except AttributeError:
+            raise KeyError, key
 
     def findall(self, key):
-        ret = []
-        while self._findnext(key):
-            ret.append(self._getCurrentData())
-        return ret
+        map = self.map
+        return [map[pos:pos+dlen] for (pos, dlen) in self._lookup(key)]
 
     def get(self, key, default=None):
         try:
@@ -266,38 +277,46 @@ class Reader(utils.IterableMap):
         except KeyError:
             return default
 
+    def has_key(self, key):
+        for _ in self._lookup(key):
+            return True
+        return False
+
     def __len__(self):
-        (start,) = struct.unpack('<i', self._read(4, 0))
-        self.fd.seek(0, 2)
-        return ((self.fd.tell() - start) / 16)
+        (start,) = _unpackInt(self.map, 0)
+        return (len(self.map) - start) / 16
 
-    has_key = _find
     __contains__ = has_key
     __getitem__ = find
 
 
 class ReaderWriter(utils.IterableMap):
-    """Uses a journal to pretend that a CDB is writable database."""
+    """Uses a journal to pretend that a CDB is writable database.
+
+    Modifications are kept in memory and written to the journal.  Once there
+    have been more than maxmods of them, the journal is compacted: it's set
+    aside (new modifications go to a fresh journal) and a background thread
+    streams the CDB into a new one, with the set-aside modifications applied,
+    before swapping it in.
+    """
     def __init__(self, filename, journalName=None, maxmods=0):
         if journalName is None:
             journalName = filename + '.journal'
         self.journalName = journalName
+        self.compactingName = journalName + '.compacting'
         self.maxmods = maxmods
         self.mods = 0
         self.filename = filename
-        self._readJournal()
-        self._openFiles()
+        self.lock = threading.RLock()
+        self.compactor = None
         self.adds = {}
         self.removals = set()
-
-    def _openFiles(self):
+        # The (adds, removals) being merged into the CDB by the compactor.
+        self.frozen = None
         self.cdb = Reader(self.filename)
+        self._readJournal()
         self.journal = file(self.journalName, 'w')
 
-    def _closeFiles(self):
-        self.cdb.close()
-        self.journal.close()
-
     def _journalRemoveKey(self, key):
         s = '-%s,%s:%s->%s\n' % (len(key), 0, key, '')
         self.journal.write(s)
@@ -311,119 +330,245 @@ class ReaderWriter(utils.IterableMap):
     def _readJournal(self):
         removals = set()
         adds = {}
-        try:
-            fd = file(self.journalName, 'r')
+        # A journal set aside by a compaction that didn't finish is older
+        # than the current one.
+        for filename in (self.compactingName, self.journalName):
+            try:
+                fd = file(filename, 'r')
+            except IOError:
+                continue
             while 1:
                 (initchar, key, value) = _readKeyValue(fd)
                 if initchar is None:
                     break
                 elif initchar == '+':
-                    if key in removals:
-                        removals.remove(key)
+                    removals.discard(key)
                     adds[key] = value
                 elif initchar == '-':
-                    if key in adds:
-                        del adds[key]
+                    adds.pop(key, None)
                     removals.add(key)
             fd.close()
-        except IOError:
-            pass
         if removals or adds:
+            self.frozen = (adds, removals)
+            self.compactor = threading.currentThread()
+            self._compact()
+        for filename in (self.compactingName, self.journalName):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _layers(self):
+        if self.frozen is None:
+            return ((self.adds, self.removals),)
+        else:
+            return ((self.adds, self.removals), self.frozen)
+
+    def _rotate(self):
+        self.journal.close()
+        os.rename(self.journalName, self.compactingName)
+        self.journal = file(self.journalName, 'w')
+        self.frozen = (self.adds, self.removals)
+        self.adds = {}
+        self.removals = set()
+        self.mods = 0
+
+    def _compact(self):
+        try:
+            (adds, removals) = self.frozen
             maker = Maker(self.filename)
-            cdb = Reader(self.filename)
-            for (key, value) in cdb.iteritems():
-                if key in removals:
-                    continue
-                elif key in adds:
-                    value = adds[key]
-                    if value is not None:
+            try:
+                # Nothing but us replaces self.cdb, so we can read it without
+                # holding the lock.
+                for (key, value) in self.cdb.iteritems():
+                    if key not in removals and key not in adds:
                         maker.add(key, value)
-                        adds[key] = None
-                else:
+                for (key, value) in adds.iteritems():
                     maker.add(key, value)
-            for (key, value) in adds.iteritems():
-                if value is not None:
+            except:
+                maker.rollback()
+                raise
+            self.lock.acquire()
+            try:
+                if os.name == 'nt':
+                    # Windows won't let us replace a file that's mapped.
+                    self.cdb.close()
+                maker.finish()
+                # The old Reader isn't closed here; lookups still using it
+                # in other threads can finish, and it'll be closed once
+                # they're done with it.
+                self.cdb = Reader(self.filename)
+                self.frozen = None
+                if os.path.exists(self.compactingName):
+                    os.remove(self.compactingName)
+            finally:
+                self.lock.release()
+        finally:
+            self.compactor = None
+
+    def compact(self, wait=True):
+        """Merges the modifications in the journal into the CDB.
+
+        If wait is False, the merge is done in a background thread; otherwise
+        this returns once every modification made so far has been merged.
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                compactor = self.compactor
+                if compactor is None:
+                    if self.frozen is None:
+                        if not (self.adds or self.removals):
+                            return
+                        self._rotate()
+                    if wait:
+                        self.compactor = threading.currentThread()
+                    else:
+                        self.compactor = threading.Thread(target=self._compact,
+                                                 name='Compacting %s' %
+                                                      self.filename)
+                        self.compactor.setDaemon(True)
+                        self.compactor.start()
+                        return
+            finally:
+                self.lock.release()
+            if compactor is None:
+                self._compact()
+            elif wait:
+                compactor.join()
+            else:
+                return
+
+    def load(self, items):
+        """Adds the (key, value) pairs from the iterable items, replacing any
+        records with the same keys.
+
+        Rather than going through the journal, this builds a new CDB from
+        items and the existing records in one pass, so it's the way to import
+        a large number of records.  The keys in items must be unique.
+        """
+        while True:
+            self.compact()
+            self.lock.acquire()
+            try:
+                if self.compactor is None and self.frozen is None and \
+                   not (self.adds or self.removals):
+                    self.compactor = threading.currentThread()
+                    break
+            finally:
+                self.lock.release()
+        try:
+            maker = Maker(self.filename)
+            try:
+                keys = None
+                if len(self.cdb):
+                    keys = set()
+                for (key, value) in items:
                     maker.add(key, value)
-            cdb.close()
-            maker.finish()
-        if os.path.exists(self.journalName):
-            os.remove(self.journalName)
+                    if keys is not None:
+                        keys.add(key)
+                if keys is not None:
+                    for (key, value) in self.cdb.iteritems():
+                        if key not in keys:
+                            maker.add(key, value)
+            except:
+                maker.rollback()
+                raise
+            self.lock.acquire()
+            try:
+                if os.name == 'nt':
+                    self.cdb.close()
+                maker.finish()
+                self.cdb = Reader(self.filename)
+            finally:
+                self.lock.release()
+        finally:
+            self.compactor = None
 
     def close(self):
         self.flush()
-        self._closeFiles()
+        self.cdb.close()
+        self.journal.close()
+        if os.path.exists(self.journalName):
+            os.remove(self.journalName)
 
     def flush(self):
-        self._closeFiles()
-        self._readJournal()
-        self._openFiles()
+        self.compact()
 
     def _flushIfOverLimit(self):
         if self.maxmods:
             if isinstance(self.maxmods, int):
                 if self.mods > self.maxmods:
-                    self.flush()
-                    self.mods = 0
+                    self.compact(wait=False)
             elif isinstance(self.maxmods, float):
                 assert 0 <= self.maxmods
-                if self.mods / max(len(self.cdb), 100) > self.maxmods:
-                    self.flush()
-                    self.mods = 0
+                if float(self.mods) / max(len(self.cdb), 100) > self.maxmods:
+                    self.compact(wait=False)
 
     def __getitem__(self, key):
-        if key in self.removals:
-            raise KeyError, key
-        else:
-            try:
-                return self.adds[key]
-            except KeyError:
-                return self.cdb[key] # If this raises KeyError, we lack key.
+        self.lock.acquire()
+        try:
+            for (adds, removals) in self._layers():
+                if key in removals:
+                    raise KeyError, key
+                elif key in adds:
+                    return adds[key]
+            return self.cdb[key] # If this raises KeyError, we lack key.
+        finally:
+            self.lock.release()
 
     def __delitem__(self, key):
-        if key in self.removals:
-            raise KeyError, key
-        else:
-            if key in self.adds and key in self.cdb:
-                self._journalRemoveKey(key)
-                del self.adds[key]
-                self.removals.add(key)
-            elif key in self.adds:
-                self._journalRemoveKey(key)
-                del self.adds[key]
-            elif key in self.cdb:
-                self._journalRemoveKey(key)
-            else:
+        self.lock.acquire()
+        try:
+            if key not in self:
                 raise KeyError, key
-        self.mods += 1
-        self._flushIfOverLimit()
+            self._journalRemoveKey(key)
+            self.adds.pop(key, None)
+            self.removals.add(key)
+            self.mods += 1
+            self._flushIfOverLimit()
+        finally:
+            self.lock.release()
 
     def __setitem__(self, key, value):
-        if key in self.removals:
-            self.removals.remove(key)
-        self._journalAddKey(key, value)
-        self.adds[key] = value
-        self.mods += 1
-        self._flushIfOverLimit()
+        self.lock.acquire()
+        try:
+            self._journalAddKey(key, value)
+            self.removals.discard(key)
+            self.adds[key] = value
+            self.mods += 1
+            self._flushIfOverLimit()
+        finally:
+            self.lock.release()
 
     def __contains__(self, key):
-        if key in self.removals:
-            return False
-        else:
-            return key in self.adds or key in self.cdb
+        self.lock.acquire()
+        try:
+            for (adds, removals) in self._layers():
+                if key in removals:
+                    return False
+                elif key in adds:
+                    return True
+            return key in self.cdb
+        finally:
+            self.lock.release()
 
     has_key = __contains__
 
     def iteritems(self):
+        self.lock.acquire()
+        try:
+            layers = [(dict(adds), set(removals))
+                      for (adds, removals) in self._layers()]
+            cdb = self.cdb
+        finally:
+            self.lock.release()
         already = set()
-        for (key, value) in self.cdb.iteritems():
-            if key in self.removals or key in already:
-                continue
-            elif key in self.adds:
-                already.add(key)
-                yield (key, self.adds[key])
-            else:
-                yield (key, value)
-        for (key, value) in self.adds.iteritems():
+        for (adds, removals) in layers:
+            for (key, value) in adds.iteritems():
+                if key not in already:
+                    already.add(key)
+                    yield (key, value)
+            already.update(removals)
+        for (key, value) in cdb.iteritems():
             if key not in already:
                 yield (key, value)
 
@@ -453,6 +598,10 @@ class Shelf(ReaderWriter):
         for (key, value) in ReaderWriter.iteritems(self):
             yield (key, pickle.loads(value))
 
+    def load(self, items):
+        ReaderWriter.load(self, ((key, pickle.dumps(value, True))
+                                 for (key, value) in items))
+
 
 if __name__ == '__main__':
     if sys.argv[0] == 'cdbdump':
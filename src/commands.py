@@ -36,6 +36,7 @@ import time
 import Queue
 import types
 import getopt
+import cPickle as pickle
 import inspect
 import threading
 import multiprocessing
@@ -54,9 +55,8 @@ def thread(f):
     def newf(self, irc, msg, args, *L, **kwargs):
         if world.isMainThread():
             targetArgs = (self.callingCommand, irc, msg, args) + tuple(L)
-            t = callbacks.CommandThread(target=self._callCommand,
-                                        args=targetArgs, kwargs=kwargs)
-            t.start()
+            callbacks.threadCommand(target=self._callCommand,
+                                    args=targetArgs, kwargs=kwargs)
         else:
             f(self, irc, msg, args, *L, **kwargs)
     return utils.python.changeFunctionName(newf, f.func_name, f.__doc__)
@@ -65,6 +65,167 @@ class ProcessTimeoutError(Exception):
     """Gets raised when a process is killed due to timeout."""
     pass
 
+def _poolWorker(conn):
+    """The main loop of a ProcessPool worker.  Each job is a function and a
+    list of argument tuples, pickled, along with the number of those tuples;
+    each result is sent back as soon as it's available, so the parent can
+    time the calls out one by one."""
+    try:
+        while True:
+            try:
+                (n, job) = conn.recv()
+            except EOFError:
+                return
+            try:
+                (f, argsList) = pickle.loads(job)
+            except Exception, e:
+                # The function may come from a module we don't have, such as
+                # a plugin loaded after we were forked.
+                e = Exception('Couldn\'t load the job: %s' %
+                              utils.exnToString(e))
+                for _ in xrange(n):
+                    conn.send(e)
+                continue
+            for args in argsList:
+                try:
+                    r = f(*args)
+                    conn.send(r)
+                except Exception, e:
+                    # Either from f or from pickling its result.
+                    conn.send(Exception(str(e)))
+    except KeyboardInterrupt:
+        pass
+
+class ProcessPool(object):
+    """A pool of worker processes that are kept around between jobs, for
+    running functions (such as user-supplied regexps) that may take too long
+    and have to be killed.  Functions and arguments given to the pool must be
+    picklable."""
+    def __init__(self, size=None):
+        self.size = size
+        self.busy = 0
+        self.idle = []
+        self.cond = threading.Condition()
+        # Workers from an older generation are retired instead of being
+        # reused; see recycle.
+        self.generation = 0
+
+    def _maxSize(self):
+        if self.size is None:
+            return conf.supybot.commands.processes()
+        return self.size
+
+    def _spawn(self):
+        (conn, child) = multiprocessing.Pipe()
+        p = world.SupyProcess(target=_poolWorker, args=(child,),
+                              name='Pool worker #%s' % world.processesSpawned)
+        p.daemon = True
+        p.start()
+        child.close()
+        return (p, conn, self.generation)
+
+    def _kill(self, worker):
+        (p, conn, _) = worker
+        conn.close()
+        p.terminate()
+        p.join()
+
+    def _acquire(self):
+        self.cond.acquire()
+        try:
+            while not self.idle and self.busy >= self._maxSize():
+                self.cond.wait()
+            self.busy += 1
+            if self.idle:
+                return self.idle.pop()
+        finally:
+            self.cond.release()
+        try:
+            return self._spawn()
+        except:
+            self._release(None)
+            raise
+
+    def _release(self, worker):
+        self.cond.acquire()
+        try:
+            self.busy -= 1
+            if worker is not None:
+                if worker[2] == self.generation and \
+                   self.busy + len(self.idle) < self._maxSize():
+                    self.idle.append(worker)
+                else:
+                    self._kill(worker)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def map(self, f, argsList, timeout=None, name='Job'):
+        """Calls <f> with each of the argument tuples in <argsList> in a
+        worker, and returns the list of the results.
+
+        Each call gets <timeout> seconds; if it takes longer, its worker is
+        killed and replaced, and its result is a ProcessTimeoutError.
+        Exceptions raised by <f> are returned as results too."""
+        argsList = list(argsList)
+        results = []
+        while len(results) < len(argsList):
+            worker = self._acquire()
+            try:
+                (p, conn, _) = worker
+                pending = argsList[len(results):]
+                job = pickle.dumps((f, pending), pickle.HIGHEST_PROTOCOL)
+                try:
+                    conn.send((len(pending), job))
+                except (EOFError, IOError):
+                    # The worker died while it was idle; try another one.
+                    self._kill(worker)
+                    worker = None
+                    continue
+                for args in pending:
+                    try:
+                        if not conn.poll(timeout):
+                            self._kill(worker)
+                            worker = None
+                            e = ProcessTimeoutError('%s aborted due to '
+                                                    'timeout.' % name)
+                            results.append(e)
+                            break
+                        results.append(conn.recv())
+                    except (EOFError, IOError), e:
+                        self._kill(worker)
+                        worker = None
+                        results.append(Exception('%s failed: its worker '
+                                                 'died.' % name))
+                        break
+            finally:
+                self._release(worker)
+        return results
+
+    def recycle(self):
+        """Replaces the workers, so the jobs given from now on are run by
+        processes forked from the bot as it is now (with the plugins loaded
+        since the old ones were forked, for instance).  Busy workers finish
+        their jobs first."""
+        self.cond.acquire()
+        try:
+            self.generation += 1
+            while self.idle:
+                self._kill(self.idle.pop())
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """Kills the idle workers."""
+        self.cond.acquire()
+        try:
+            while self.idle:
+                self._kill(self.idle.pop())
+        finally:
+            self.cond.release()
+
+pool = ProcessPool()
+
 def process(f, *args, **kwargs):
     """Runs a function <f> in a subprocess.
 
@@ -72,9 +233,28 @@ def process(f, *args, **kwargs):
     <pn>, the pluginname, and <cn>, the command name, are strings used to
     create the process name, for identification purposes.
     <timeout>, if supplied, limits the length of execution of target
-    function to <timeout> seconds."""
+    function to <timeout> seconds.
+
+    If <f> and its arguments can be pickled (and no other keyword arguments
+    are given), it's run by one of the pool's workers; otherwise, a new
+    process is forked for it."""
     timeout = kwargs.pop('timeout', None)
+    pn = kwargs.get('pn', 'Unknown')
+    cn = kwargs.get('cn', 'unknown')
+    if set(kwargs) <= set(['pn', 'cn']):
+        try:
+            [v] = pool.map(f, [args], timeout, name='%s.%s' % (pn, cn))
+        except (pickle.PicklingError, TypeError):
+            v = _forkProcess(f, timeout, args, kwargs)
+    else:
+        v = _forkProcess(f, timeout, args, kwargs)
+    if isinstance(v, ProcessTimeoutError):
+        raise v
+    if isinstance(v, Exception):
+        v = "Error: " + str(v)
+    return v
 
+def _forkProcess(f, timeout, args, kwargs):
     q = multiprocessing.Queue()
     def newf(f, q, *args, **kwargs):
         try:
@@ -89,47 +269,70 @@ def process(f, *args, **kwargs):
     p.join(timeout)
     if p.is_alive():
         p.terminate()
-        raise ProcessTimeoutError, "%s aborted due to timeout." % (p.name,)
+        return ProcessTimeoutError("%s aborted due to timeout." % (p.name,))
     try:
-        v = q.get(block=False)
+        return q.get(block=False)
     except Queue.Empty:
-        v = "Nothing returned."
-    if isinstance(v, Exception):
-        v = "Error: " + str(v)
-    return v
+        return "Nothing returned."
+
+def _re_bool(s, reobj):
+    """Since we can't send match objects back from the workers, we'll just
+    wrap the search to return bools."""
+    return reobj.search(s) is not None
+
+def regexp_match(reobj, s):
+    """Returns the part of <s> matched by <reobj>, or the empty string."""
+    m = reobj.search(s)
+    if m is None:
+        return ''
+    return m.group(0)
+
+def regexp_batch(strings, reobj, timeout, plugin_name, fcn_name):
+    """Searches each of <strings> for <reobj> in the worker processes, and
+    returns a list of bools.  The whole batch is sent to a worker as a single
+    job; <timeout> limits the search of each string, and a search that times
+    out counts as no match.
+
+    This is used because specially-crafted regexps can use exponential time
+    and hang the bot."""
+    argsList = [(s, reobj) for s in strings]
+    if not argsList:
+        return []
+    name = '%s.%s' % (plugin_name, fcn_name)
+    return [r is True for r in pool.map(_re_bool, argsList, timeout, name)]
 
 def regexp_wrapper(s, reobj, timeout, plugin_name, fcn_name):
     '''A convenient wrapper to stuff regexp search queries through a subprocess.
 
     This is used because specially-crafted regexps can use exponential time
     and hang the bot.'''
-    def re_bool(s, reobj):
-        """Since we can't enqueue match objects into the multiprocessing queue,
-        we'll just wrap the function to return bools."""
-        if reobj.search(s) is not None:
-            return True
-        else:
-            return False
-    try:
-        v = process(re_bool, s, reobj, timeout=timeout, pn=plugin_name, cn=fcn_name)
-        return v
-    except ProcessTimeoutError:
-        return False
-
-class UrlSnarfThread(world.SupyThread):
-    def __init__(self, *args, **kwargs):
-        assert 'url' in kwargs
-        kwargs['name'] = 'Thread #%s (for snarfing %s)' % \
-                         (world.threadsSpawned, kwargs.pop('url'))
-        super(UrlSnarfThread, self).__init__(*args, **kwargs)
-        self.setDaemon(True)
+    [v] = regexp_batch([s], reobj, timeout, plugin_name, fcn_name)
+    return v
+
+class UrlSnarfThread(object):
+    """Kept for plugins that start their snarfers' threads themselves; the
+    snarfer is queued to world.threads when this is start()ed."""
+    def __init__(self, target=None, args=(), kwargs={}, url=None, group=None):
+        assert url is not None
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.url = url
+        self.group = group
+
+    def setDaemon(self, daemonic):
+        pass
 
     def run(self):
         try:
-            super(UrlSnarfThread, self).run()
+            self.target(*self.args, **self.kwargs)
         except utils.web.Error, e:
             log.debug('Exception in urlSnarfer: %s', utils.exnToString(e))
 
+    def start(self):
+        name = 'Thread for snarfing %s' % self.url
+        world.threads.submit(self.run, name=name, group=self.group)
+
 class SnarfQueue(ircutils.FloodQueue):
     timeout = conf.supybot.snarfThrottle
     def key(self, channel):
@@ -178,14 +381,15 @@ def urlSnarfer(f):
                     self.log.debug('Not snarfing, msg is already repliedTo.')
                     return
                 f(self, irc, msg, match, *L, **kwargs)
+            except utils.web.Error, e:
+                log.debug('Exception in urlSnarfer: %s', utils.exnToString(e))
             finally:
                 _snarfLock.release()
         if threading.currentThread() is not world.mainThread:
             doSnarf()
         else:
             L = list(L)
-            t = UrlSnarfThread(target=doSnarf, url=url)
-            t.start()
+            UrlSnarfThread(target=doSnarf, url=url, group=self.name()).start()
     newf = utils.python.changeFunctionName(newf, f.func_name, f.__doc__)
     return newf
 
@@ -985,7 +1189,7 @@ __all__ = [
     # Decorators.
     'urlSnarfer', 'thread',
     # Functions.
-    'wrap', 'process', 'regexp_wrapper',
+    'wrap', 'process', 'regexp_wrapper', 'regexp_batch',
     # Stuff for testing.
     'Spec',
 ]
@@ -550,6 +550,10 @@ registerGlobalValue(supybot, 'flush',
     version over your modifications.  Do note that if you change this to False
     inside the bot, your changes won't be flushed.  To make this change
     permanent, you must edit the registry yourself."""))
+registerGlobalValue(supybot.flush, 'stagger',
+    registry.Boolean(True, """Determines whether the flushers will be spread
+    over the upkeep interval, rather than all run at once.  Either way, the
+    writing itself is done in a thread of its own where possible."""))
 
 
 ###
@@ -597,6 +601,11 @@ registerChannelValue(supybot.commands.nested, 'pipeSyntax',
     option will allow nested commands with a syntax similar to UNIX pipes, for
     example: 'bot: foo | bar'."""))
 
+registerGlobalValue(supybot.commands, 'processes',
+    registry.PositiveInteger(2, """Determines how many worker processes the
+    bot keeps around for running commands that may take too long and have to
+    be killed, such as searches with user-supplied regexps."""))
+
 registerGroup(supybot.commands, 'defaultPlugins',
     orderAlphabetically=True, help="""Determines what commands have default
     plugins set, and which plugins are set to be the default for each of those
@@ -660,13 +669,20 @@ registerGlobalValue(supybot.drivers, 'poll',
     driver should block waiting for input."""))
 
 class ValidDriverModule(registry.OnlySomeStrings):
-    validStrings = ('default', 'Socket', 'Twisted')
+    validStrings = ('default', 'Socket', 'Selector', 'Twisted')
 
 registerGlobalValue(supybot.drivers, 'module',
     ValidDriverModule('default', """Determines what driver module the bot will
     use.  Socket, a simple driver based on timeout sockets, is used by default
-    because it's simple and stable.  Twisted is very stable and simple, and if
-    you've got Twisted installed, is probably your best bet."""))
+    because it's simple and stable.  Selector waits on the sockets of all
+    networks at once with epoll (or poll, or select), so it scales better when
+    the bot is connected to many networks.  Twisted is very stable and simple,
+    and if you've got Twisted installed, is probably your best bet."""))
+
+registerGlobalValue(supybot.drivers, 'readSize',
+    registry.PositiveInteger(8192, """Determines how many bytes a driver will
+    try to read from the network at once.  Larger values mean fewer reads
+    during bursts of traffic (like netjoins or large NAMES replies)."""))
 
 registerGlobalValue(supybot.drivers, 'maxReconnectWait',
     registry.PositiveFloat(300.0, """Determines the maximum time the bot will
@@ -729,6 +745,10 @@ registerGlobalValue(supybot.directories.data, 'tmp',
     DataFilenameDirectory('tmp', """Determines what directory temporary files
     are put into."""))
 
+registerGlobalValue(supybot.directories.data, 'web',
+    DataFilenameDirectory('web', """Determines what directory cached web pages
+    are put into."""))
+
 utils.file.AtomicFile.default.tmpDir = supybot.directories.data.tmp
 utils.file.AtomicFile.default.backupDir = supybot.directories.backup
 
@@ -971,7 +991,7 @@ registerGlobalValue(supybot.protocols.irc, 'vhost',
     connecting to the IRC server."""))
 
 registerGlobalValue(supybot.protocols.irc, 'maxHistoryLength',
-    registry.Integer(1000, """Determines how many old messages the bot will
+    registry.Integer(10000, """Determines how many old messages the bot will
     keep around in its history.  Changing this variable will not take effect
     until the bot is restarted."""))
 
@@ -999,6 +1019,21 @@ registerGlobalValue(supybot.protocols.irc.queuing, 'duplicates',
     multiple times; most of the time it doesn't matter, unless you're doing
     certain kinds of plugin hacking."""))
 
+registerGlobalValue(supybot.protocols.irc.queuing, 'burst',
+    registry.PositiveInteger(1, """Determines how many messages' worth of
+    penalty the bot may build up before it has to wait for it to drain.  Each
+    message costs supybot.protocols.irc.throttleTime seconds of penalty (more
+    for some commands, if supybot.protocols.irc.queuing.penalties is on).
+    Servers usually allow a burst of about five messages before disconnecting
+    a client for excess flood; the default of 1 sends at most one message per
+    throttleTime, as the bot always has."""))
+registerGlobalValue(supybot.protocols.irc.queuing, 'penalties',
+    registry.Boolean(False, """Determines whether the commands that are
+    expensive for the server count for more than one message against
+    supybot.protocols.irc.queuing.burst: JOIN, WHO, WHOIS and NAMES count for
+    two, and LIST for three, much as servers count them for their own flood
+    protection."""))
+
 registerGroup(supybot.protocols.irc.queuing, 'rateLimit')
 registerGlobalValue(supybot.protocols.irc.queuing.rateLimit, 'join',
     registry.Float(0, """Determines how many seconds must elapse between JOINs
@@ -1019,6 +1054,17 @@ registerGlobalValue(supybot.protocols.http, 'proxy',
     through.  The value should be of the form 'host:port'."""))
 utils.web.proxy = supybot.protocols.http.proxy
 
+registerGlobalValue(supybot.protocols.http, 'cacheSize',
+    registry.NonNegativeInteger(10*1024*1024, """Determines how many bytes of
+    web pages the bot will keep cached in supybot.directories.data.web.  The
+    oldest pages are thrown away first."""))
+registerGlobalValue(supybot.protocols.http, 'cacheAge',
+    registry.PositiveInteger(7*86400, """Determines how many seconds a web page
+    cached in supybot.directories.data.web is kept for."""))
+utils.web.cache.directory = supybot.directories.data.web
+utils.web.cache.diskSize = supybot.protocols.http.cacheSize
+utils.web.cache.maxAge = supybot.protocols.http.cacheAge
+
 
 ###
 # Especially boring stuff.
@@ -1063,6 +1109,23 @@ registerGlobalValue(supybot, 'pidFile',
     the default) then no PID file will be written.  A restart is required for
     changes to this variable to take effect."""))
 
+###
+# supybot.threads.  For the pool of threads commands and snarfers run in.
+###
+registerGroup(supybot, 'threads')
+registerGlobalValue(supybot.threads, 'maximum',
+    registry.PositiveInteger(10, """Determines how many threads the bot will
+    use to run threaded commands, URL snarfers, and other things that shouldn't
+    block the main loop."""))
+registerGlobalValue(supybot.threads, 'perGroup',
+    registry.PositiveInteger(4, """Determines how many of those threads a
+    single plugin can use at once; other tasks of that plugin wait until one
+    of its tasks is finished."""))
+registerGlobalValue(supybot.threads, 'queueSize',
+    registry.PositiveInteger(100, """Determines how many tasks can wait for a
+    thread.  When that many are waiting, new ones are dropped (and the users
+    who called commands are told the bot is too busy)."""))
+
 ###
 # Debugging options.
 ###
@@ -34,6 +34,9 @@ Module for some slight database-independence for simple databases.
 import os
 import csv
 import math
+import zlib
+import random
+import threading
 
 from . import cdb, utils
 from .utils.iter import ilen
@@ -86,6 +89,14 @@ class MappingInterface(object):
         "Cleans up in the database, if possible.  Not required to do anything."
         pass
 
+    def __len__(self):
+        "Returns the number of records.  By default, this counts them."
+        return ilen(self)
+
+    def random(self):
+        "Returns a random (id, s) pair.  Raises IndexError if there's none."
+        return utils.iter.choice(self)
+
 
 class DirMapping(MappingInterface):
     def __init__(self, filename, **kwargs):
@@ -316,8 +327,340 @@ class CdbMapping(MappingInterface):
         self.db.close()
 
 
+class IndexedMapping(MappingInterface):
+    """A Mapping keeping its records in an append-only log file, with an
+    in-memory index of where each record is in it.
+
+    Each set or remove appends an entry to the log, so get, size and random
+    don't have to read the whole file, and a crash can only lose the entry
+    being written (which is detected by its length and checksum and
+    truncated away the next time the file is opened).  When more than half
+    of the file is old versions of records, it's compacted in a background
+    thread.
+
+    Opening a FlatfileMapping file with this Mapping converts it; the old file
+    is kept with a .flat extension.
+    """
+    # We don't bother compacting files with less dead space than this.
+    compactionThreshold = 64 * 1024
+    def __init__(self, filename, **kwargs):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.compactor = None
+        self.compactLock = threading.Lock()
+        backup = filename + '.flat'
+        if _isFlatfile(filename):
+            os.rename(filename, backup)
+        # filename only shows up again once the migration is done, so a
+        # .flat file without one next to it is a migration that didn't
+        # finish, and we start it over.
+        if os.path.exists(backup) and (not os.path.exists(filename) or
+                                       not os.path.getsize(filename)):
+            self._migrate(backup)
+        if not os.path.exists(filename) or not os.path.getsize(filename):
+            fd = file(filename, 'wb')
+            try:
+                fd.write(self._header(1))
+            finally:
+                fd.close()
+        self._open()
+
+    def _migrate(self, backup):
+        # The flat file's next id may be past its last record (if that was
+        # removed), and we mustn't give that id out again.
+        source = FlatfileMapping(backup)
+        try:
+            nextId = source.currentId
+        finally:
+            source.close()
+        # We migrate into a temporary file and rename it into place only
+        # when it's complete, so a crash partway through can't leave us a
+        # valid but truncated database.
+        tempFilename = self.filename + '.migrating'
+        fd = file(tempFilename, 'wb')
+        try:
+            fd.write(self._header(nextId))
+        finally:
+            fd.close()
+        migrate(backup, tempFilename, FlatfileMapping, IndexedMapping)
+        if os.path.exists(self.filename):
+            # Windows won't rename over an existing file.
+            os.remove(self.filename)
+        os.rename(tempFilename, self.filename)
+
+    def _header(self, nextId):
+        return '# IndexedMapping %s\n' % nextId
+
+    def _entry(self, id, s):
+        return '+%s %s %s\n%s\n' % (id, len(s), zlib.crc32(s) & 0xffffffff, s)
+
+    def _open(self):
+        self.fd = file(self.filename, 'r+b')
+        header = self.fd.readline().split()
+        if header[:2] != ['#', 'IndexedMapping'] or len(header) != 3 or \
+           not header[2].isdigit():
+            self.fd.close()
+            raise InvalidDBError, \
+                  'Invalid file for IndexedMapping: %s' % self.filename
+        self._reset(int(header[2]))
+        self._load(self.fd.tell())
+
+    def _reset(self, nextId):
+        # Maps ids to the (offset, length, size) of their records: where the
+        # record itself is, its length, and the size of its whole entry.
+        self.index = {}
+        # The ids, in no particular order, and the position of each in that
+        # list, so we can choose a random one and remove one in O(1).
+        self.ids = []
+        self.positions = {}
+        self.liveBytes = 0
+        self.nextId = nextId
+
+    def _index(self, id, offset, length, size):
+        if id in self.index:
+            self.liveBytes -= self.index[id][2]
+        else:
+            self.positions[id] = len(self.ids)
+            self.ids.append(id)
+        self.index[id] = (offset, length, size)
+        self.liveBytes += size
+        self.nextId = max(self.nextId, id + 1)
+
+    def _unindex(self, id):
+        self.nextId = max(self.nextId, id + 1)
+        if id not in self.index:
+            return
+        self.liveBytes -= self.index.pop(id)[2]
+        i = self.positions.pop(id)
+        last = self.ids.pop()
+        if last != id:
+            self.ids[i] = last
+            self.positions[last] = i
+
+    def _load(self, offset):
+        """Reads the entries from offset to the end of the file into the
+        index, truncating the file at the first incomplete or corrupt
+        entry."""
+        fd = self.fd
+        fd.seek(offset)
+        while True:
+            start = fd.tell()
+            line = fd.readline()
+            if not line:
+                break
+            try:
+                if not line.endswith('\n'):
+                    raise ValueError
+                if line.startswith('+'):
+                    (id, length, crc) = map(int, line[1:].split())
+                    s = fd.read(length + 1)
+                    if len(s) != length + 1 or not s.endswith('\n') or \
+                       zlib.crc32(s[:-1]) & 0xffffffff != crc:
+                        raise ValueError
+                    self._index(id, start + len(line), length,
+                                len(line) + length + 1)
+                elif line.startswith('-'):
+                    self._unindex(int(line[1:]))
+                else:
+                    raise ValueError
+            except ValueError:
+                fd.seek(start)
+                fd.truncate()
+                break
+        self.end = fd.tell()
+
+    def _append(self, entry):
+        self.fd.seek(self.end)
+        self.fd.write(entry)
+        self.fd.flush()
+        start = self.end
+        self.end += len(entry)
+        return start
+
+    def get(self, id):
+        self.lock.acquire()
+        try:
+            try:
+                (offset, length, _) = self.index[id]
+            except KeyError:
+                raise NoRecordError, id
+            self.fd.seek(offset)
+            return self.fd.read(length)
+        finally:
+            self.lock.release()
+
+    def set(self, id, s):
+        entry = self._entry(id, s)
+        self.lock.acquire()
+        try:
+            start = self._append(entry)
+            self._index(id, start + len(entry) - len(s) - 1, len(s),
+                        len(entry))
+            self._maybeCompact()
+        finally:
+            self.lock.release()
+
+    def add(self, s):
+        self.lock.acquire()
+        try:
+            id = self.nextId
+            self.set(id, s)
+            return id
+        finally:
+            self.lock.release()
+
+    def remove(self, id):
+        self.lock.acquire()
+        try:
+            if id not in self.index:
+                raise NoRecordError, id
+            self._append('-%s\n' % id)
+            self._unindex(id)
+            self._maybeCompact()
+        finally:
+            self.lock.release()
+
+    def __iter__(self):
+        self.lock.acquire()
+        try:
+            ids = sorted(self.ids)
+        finally:
+            self.lock.release()
+        for id in ids:
+            try:
+                yield (id, self.get(id))
+            except NoRecordError:
+                continue # Removed since we started.
+
+    def __len__(self):
+        return len(self.index)
+
+    def random(self):
+        self.lock.acquire()
+        try:
+            if not self.ids:
+                raise IndexError
+            id = random.choice(self.ids)
+            return (id, self.get(id))
+        finally:
+            self.lock.release()
+
+    def _maybeCompact(self):
+        dead = self.end - self.liveBytes
+        if dead > max(self.liveBytes, self.compactionThreshold) and \
+           self.compactor is None:
+            self.compactor = threading.Thread(target=self._compact,
+                                              name='Compacting %s' %
+                                                   self.filename)
+            self.compactor.setDaemon(True)
+            self.compactor.start()
+
+    def _compact(self):
+        self.compactLock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                snapshot = sorted(self.index.items())
+                snapshotEnd = self.end
+                nextId = self.nextId
+            finally:
+                self.lock.release()
+            # The file is only appended to, so we can copy what we have a
+            # snapshot of without holding the lock.
+            tmp = self.filename + '.compacting'
+            reader = file(self.filename, 'rb')
+            out = file(tmp, 'wb')
+            try:
+                out.write(self._header(nextId))
+                index = []
+                for (id, (offset, length, _)) in snapshot:
+                    reader.seek(offset)
+                    entry = self._entry(id, reader.read(length))
+                    size = len(entry)
+                    index.append((id, out.tell() + size - length - 1, length,
+                                  size))
+                    out.write(entry)
+            finally:
+                reader.close()
+            self.lock.acquire()
+            try:
+                # Then we copy whatever was appended in the meantime, and
+                # replay it on top of the snapshot.
+                self.fd.seek(snapshotEnd)
+                tail = self.fd.read(self.end - snapshotEnd)
+                tailStart = out.tell()
+                out.write(tail)
+                out.flush()
+                os.fsync(out.fileno())
+                out.close()
+                self.fd.close()
+                if os.name == 'nt':
+                    os.remove(self.filename)
+                os.rename(tmp, self.filename)
+                self.fd = file(self.filename, 'r+b')
+                self._reset(nextId)
+                for (id, offset, length, size) in index:
+                    self._index(id, offset, length, size)
+                self._load(tailStart)
+            finally:
+                self.lock.release()
+        finally:
+            if self.compactor is threading.currentThread():
+                self.compactor = None
+            self.compactLock.release()
+
+    def vacuum(self):
+        self._compact()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+        finally:
+            self.lock.release()
+
+    def close(self):
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+        self.lock.acquire()
+        try:
+            self.fd.close()
+        finally:
+            self.lock.release()
+
+def _isFlatfile(filename):
+    try:
+        fd = file(filename)
+    except EnvironmentError:
+        return False
+    try:
+        return fd.readline().rstrip('\r\n').isdigit()
+    finally:
+        fd.close()
+
+def migrate(filename, newFilename, From, To):
+    """Copies the records of the From Mapping in filename to a new To Mapping
+    in newFilename.  From and To are Mapping classes or names in Mappings."""
+    if isinstance(From, basestring):
+        From = Mappings[From]
+    if isinstance(To, basestring):
+        To = Mappings[To]
+    source = From(filename)
+    try:
+        destination = To(newFilename)
+        try:
+            for (id, s) in source:
+                destination.set(id, s)
+        finally:
+            destination.close()
+    finally:
+        source.close()
+
+
 class DB(object):
-    Mapping = 'flat' # This is a good, sane default.
+    Mapping = 'indexed' # This is a good, sane default.
     Record = None
     def __init__(self, filename, Mapping=None, Record=None):
         if Record is not None:
@@ -362,12 +705,12 @@ class DB(object):
 
     def random(self):
         try:
-            return self._newRecord(*utils.iter.choice(self.map))
+            return self._newRecord(*self.map.random())
         except IndexError:
             return None
 
     def size(self):
-        return ilen(self.map)
+        return len(self.map)
 
     def flush(self):
         self.map.flush()
@@ -381,6 +724,7 @@ class DB(object):
 Mappings = {
     'cdb': CdbMapping,
     'flat': FlatfileMapping,
+    'indexed': IndexedMapping,
     }
 
 
@@ -0,0 +1,327 @@
+###
+# Copyright (c) 2002-2004, Jeremiah Fincher
+# Copyright (c) 2010, James McCoy
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Contains a driver that multiplexes the sockets of every network through a
+single epoll/poll/select call.  Where the Socket driver blocks on each
+network's socket in turn, this one only wakes up when a socket is ready or
+when the next scheduled event is due.
+"""
+
+from __future__ import division
+
+import time
+import errno
+import select
+import socket
+
+from .. import conf, drivers, log, schedule
+from . import Socket
+
+ssl = Socket.ssl
+
+READ = getattr(select, 'POLLIN', 1)
+WRITE = getattr(select, 'POLLOUT', 4)
+ERROR = getattr(select, 'POLLERR', 8) | getattr(select, 'POLLHUP', 16)
+
+_wouldBlock = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+class EpollBackend(object):
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.register = self.epoll.register
+        self.modify = self.epoll.modify
+        self.unregister = self.epoll.unregister
+
+    def poll(self, timeout):
+        return self.epoll.poll(timeout)
+
+class PollBackend(object):
+    def __init__(self):
+        self.poller = select.poll()
+        self.register = self.poller.register
+        self.modify = self.poller.register
+        self.unregister = self.poller.unregister
+
+    def poll(self, timeout):
+        return self.poller.poll(timeout * 1000)
+
+class SelectBackend(object):
+    """Emulates the poll interface with select(), for platforms (Windows,
+    mostly) that have neither epoll nor poll."""
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, mask):
+        self.fds[fd] = mask
+    modify = register
+
+    def unregister(self, fd):
+        del self.fds[fd]
+
+    def poll(self, timeout):
+        readers = [fd for (fd, mask) in self.fds.iteritems() if mask & READ]
+        writers = [fd for (fd, mask) in self.fds.iteritems() if mask & WRITE]
+        (r, w, x) = select.select(readers, writers, readers, timeout)
+        events = dict.fromkeys(r, READ)
+        for fd in w:
+            events[fd] = events.get(fd, 0) | WRITE
+        for fd in x:
+            events[fd] = events.get(fd, 0) | ERROR
+        return events.items()
+
+def newBackend():
+    if hasattr(select, 'epoll'):
+        return EpollBackend()
+    elif hasattr(select, 'poll'):
+        return PollBackend()
+    else:
+        return SelectBackend()
+
+class Poller(drivers.IrcDriver):
+    """The single driver that waits on the sockets of all the networks.
+
+    Network drivers register their connected sockets here; this driver
+    blocks until one of them is ready, a reconnect or throttle deadline
+    passes, or the next event in the schedule is due, whichever comes first.
+    """
+    def __init__(self):
+        self.backend = newBackend()
+        self.fds = {}
+        self.networks = set()
+        self.dead = False
+        drivers.IrcDriver.__init__(self)
+
+    def name(self):
+        return self.__class__.__name__
+
+    def add(self, driver):
+        if self.dead:
+            # We were killed off with the rest of the drivers, but a new
+            # network has come along, so let's get back in the loop.
+            self.dead = False
+            drivers.add(self.name(), self)
+        self.networks.add(driver)
+
+    def remove(self, driver):
+        self.unregister(driver)
+        self.networks.discard(driver)
+
+    def register(self, driver, mask=READ):
+        fd = driver.conn.fileno()
+        if self.fds.get(fd) is driver:
+            self.backend.modify(fd, mask)
+        else:
+            self.unregister(driver)
+            try:
+                self.backend.register(fd, mask)
+            except (IOError, OSError), e:
+                if e.args[0] != errno.EEXIST:
+                    raise
+                self.backend.modify(fd, mask)
+            self.fds[fd] = driver
+        driver.registeredFd = fd
+        driver.registeredMask = mask
+
+    def modify(self, driver, mask):
+        if driver.registeredFd is not None and \
+           driver.registeredMask != mask:
+            self.backend.modify(driver.registeredFd, mask)
+            driver.registeredMask = mask
+
+    def unregister(self, driver):
+        fd = driver.registeredFd
+        if fd is None:
+            return
+        driver.registeredFd = None
+        driver.registeredMask = None
+        if self.fds.get(fd) is driver:
+            del self.fds[fd]
+            try:
+                self.backend.unregister(fd)
+            except (KeyError, ValueError, IOError, OSError):
+                # The socket was already closed out from under us; epoll
+                # forgets closed descriptors on its own.
+                pass
+
+    def getTimeout(self):
+        timeout = conf.supybot.drivers.poll()
+        now = time.time()
+        deadlines = []
+        if schedule.schedule.schedule:
+            deadlines.append(schedule.schedule.schedule[0][0])
+        for driver in self.networks:
+            deadlines.extend(driver.getDeadlines())
+        for deadline in deadlines:
+            timeout = min(timeout, deadline - now)
+        return max(timeout, 0)
+
+    def run(self):
+        timeout = self.getTimeout()
+        if not self.fds:
+            # Nothing to wait on; we sleep so we don't spin at 100% CPU while
+            # every network is disconnected.
+            time.sleep(timeout)
+            return
+        try:
+            events = self.backend.poll(timeout)
+        except (select.error, IOError, OSError), e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for (fd, event) in events:
+            driver = self.fds.get(fd)
+            if driver is None:
+                continue
+            if event & (READ | ERROR):
+                driver.handleRead()
+            if event & WRITE and driver.registeredFd == fd:
+                driver.handleWrite()
+
+    def die(self):
+        self.dead = True
+        drivers.IrcDriver.die(self)
+
+
+_poller = None
+def getPoller():
+    """Returns the Poller shared by all the SelectorDrivers.  It's only made
+    when the first of them is, so that merely importing this module doesn't
+    add a driver to the loop."""
+    global _poller
+    if _poller is None:
+        _poller = Poller()
+    return _poller
+
+class SelectorDriver(Socket.SocketDriver):
+    def __init__(self, irc, poller=None):
+        self.registeredFd = None
+        self.registeredMask = None
+        if poller is None:
+            poller = getPoller()
+        self.poller = poller
+        self.poller.add(self)
+        Socket.SocketDriver.__init__(self, irc)
+
+    def getDeadlines(self):
+        """Returns the times at which this driver wants to be run, regardless
+        of whether its socket becomes ready."""
+        L = []
+        if self.nextReconnectTime is not None:
+            L.append(self.nextReconnectTime)
+        if self.writeCheckTime is not None:
+            L.append(self.writeCheckTime)
+        if self.connected and not self.zombie:
+            if self.irc.fastqueue:
+                L.append(0)
+            elif self.irc.queue:
+                L.append(self.irc.queue.readyAt())
+        return L
+
+    def _handleSocketError(self, e):
+        if isinstance(e, socket.error) and e.args and \
+           e.args[0] in _wouldBlock:
+            return
+        if ssl and isinstance(e, ssl.SSLError) and \
+           e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+            return
+        self.poller.unregister(self)
+        Socket.SocketDriver._handleSocketError(self, e)
+
+    def _sendIfMsgs(self):
+        Socket.SocketDriver._sendIfMsgs(self)
+        if self.connected and self.registeredFd is not None:
+            if self.outbuffer:
+                self.poller.modify(self, READ | WRITE)
+            else:
+                self.poller.modify(self, READ)
+
+    def _register(self):
+        self.conn.setblocking(0)
+        self.poller.register(self)
+
+    def run(self):
+        now = time.time()
+        if self.nextReconnectTime is not None and now > self.nextReconnectTime:
+            self.reconnect()
+        elif self.writeCheckTime is not None and now > self.writeCheckTime:
+            self._checkAndWriteOrReconnect()
+        # Unlike the Socket driver, we don't sleep or block here; the poller
+        # does all the waiting for us.
+        if self.connected:
+            self._sendIfMsgs()
+
+    def handleRead(self):
+        if not self.connected:
+            return
+        try:
+            n = self.inbuffer.recvFrom(self.conn)
+            if n and ssl and isinstance(self.conn, ssl.SSLSocket):
+                # SSL buffers whole records, so there may be more decrypted
+                # data available than the socket itself will tell us about.
+                while self.conn.pending():
+                    self.inbuffer.recvFrom(self.conn)
+        except socket.error, e:
+            self._handleSocketError(e)
+            return
+        if not n:
+            self._handleSocketError(socket.error('Connection closed.'))
+            return
+        self.eagains = 0
+        for line in self.inbuffer.lines():
+            msg = drivers.parseMsg(line)
+            if msg is not None:
+                self.irc.feedMsg(msg)
+        if not self.irc.zombie:
+            self._sendIfMsgs()
+
+    def handleWrite(self):
+        if self.connected:
+            self._sendIfMsgs()
+
+    def reconnect(self, reset=True):
+        self.poller.unregister(self)
+        Socket.SocketDriver.reconnect(self, reset=reset)
+        if self.connected:
+            self._register()
+
+    def _checkAndWriteOrReconnect(self):
+        Socket.SocketDriver._checkAndWriteOrReconnect(self)
+        if self.connected:
+            self._register()
+
+    def _reallyDie(self):
+        self.poller.remove(self)
+        Socket.SocketDriver._reallyDie(self)
+
+
+Driver = SelectorDriver
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
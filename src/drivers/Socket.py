@@ -56,7 +56,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
         self.conn = None
         self.servers = ()
         self.eagains = 0
-        self.inbuffer = ''
+        self.inbuffer = drivers.LineBuffer()
         self.outbuffer = ''
         self.zombie = False
         self.connected = False
@@ -126,11 +126,9 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
             return
         self._sendIfMsgs()
         try:
-            self.inbuffer += self.conn.recv(1024)
+            self.inbuffer.recvFrom(self.conn)
             self.eagains = 0 # If we successfully recv'ed, we can reset this.
-            lines = self.inbuffer.split('\n')
-            self.inbuffer = lines.pop()
-            for line in lines:
+            for line in self.inbuffer.lines():
                 msg = drivers.parseMsg(line)
                 if msg is not None:
                     self.irc.feedMsg(msg)
@@ -157,6 +155,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
             drivers.log.reconnect(self.irc.network)
             self.conn.close()
             self.connected = False
+        self.inbuffer.reset()
         if reset:
             drivers.log.debug('Resetting %s.', self.irc)
             self.irc.reset()
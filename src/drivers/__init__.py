@@ -206,6 +206,77 @@ def newDriver(irc, moduleName=None):
     irc.driver = driver
     return driver
 
+class LineBuffer(object):
+    """A reusable buffer for framing inbound data into lines.
+
+    Data is received directly into a preallocated bytearray (with recv_into,
+    when reading from a socket) and complete lines are sliced out of it as
+    they arrive.  Consumed data is never copied; only the trailing partial
+    line is moved back to the start of the buffer, and only when there isn't
+    room left to read into.
+    """
+    __slots__ = ('buf', 'start', 'end', 'readSize')
+    def __init__(self, readSize=None):
+        if readSize is None:
+            readSize = conf.supybot.drivers.readSize()
+        self.readSize = readSize
+        self.buf = bytearray(readSize * 4)
+        self.reset()
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _makeRoom(self, size):
+        if len(self.buf) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if len(self.buf) - pending < size:
+            # A partial line longer than our buffer; let's grow it.
+            buf = bytearray(max(len(self.buf) * 2, pending + size))
+            buf[:pending] = self.buf[self.start:self.end]
+            self.buf = buf
+        elif pending:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def recvFrom(self, conn, size=None):
+        """Reads at most size bytes from the socket conn into the buffer.
+
+        Returns the number of bytes read, which is 0 if the connection was
+        closed.  Socket errors are propagated to the caller."""
+        if size is None:
+            size = self.readSize
+        self._makeRoom(size)
+        n = conn.recv_into(memoryview(self.buf)[self.end:], size)
+        self.end += n
+        return n
+
+    def feed(self, data):
+        """Adds the string data to the buffer."""
+        n = len(data)
+        self._makeRoom(n)
+        self.buf[self.end:self.end+n] = data
+        self.end += n
+
+    def lines(self):
+        """Yields each complete line in the buffer, consuming it."""
+        buf = self.buf
+        view = memoryview(buf)
+        while True:
+            i = buf.find('\n', self.start, self.end)
+            if i == -1:
+                break
+            line = view[self.start:i].tobytes()
+            self.start = i + 1
+            yield line
+        if self.start == self.end:
+            self.reset()
+
 def parseMsg(s):
     s = s.strip()
     if s:
@@ -31,6 +31,7 @@
 import os
 import time
 import operator
+from cStringIO import StringIO
 
 from . import conf, ircutils, log, registry, unpreserve, utils, world
 from .utils.iter import imap, ilen, ifilter
@@ -299,8 +300,6 @@ class IrcUser(object):
 
     def clearAuth(self):
         """Unsets a user's authenticated hostmask."""
-        for (when, hostmask) in self.auth:
-            users.invalidateCache(hostmask=hostmask)
         self.auth = []
 
     def preserve(self, fd, indent=''):
@@ -548,6 +547,20 @@ class IrcChannelCreator(Creator):
             IrcChannelCreator.name = None
 
 
+def _writer(filename, s):
+    def write():
+        fd = utils.file.AtomicFile(filename, fsync=True)
+        fd.write(s)
+        fd.close()
+    return write
+
+def _flush(write):
+    # We have to wait for any write of the same file already given to the
+    # flushWriter, lest it overwrite ours.
+    if write is not None:
+        world.flushWriter.wait()
+        write()
+
 class DuplicateHostmask(ValueError):
     pass
 
@@ -558,8 +571,13 @@ class UsersDictionary(utils.IterableMap):
         self.filename = None
         self.users = {}
         self.nextId = 0
-        self._nameCache = utils.structures.CacheDict(1000)
-        self._hostmaskCache = utils.structures.CacheDict(1000)
+        # The names and hostmasks of the users as of their last setUser, and
+        # the hostmasks they were authenticated from.  _indexed keeps what we
+        # indexed for each id, since users are modified in place.
+        self._names = {}
+        self._hostmasks = ircutils.HostmaskIndex()
+        self._auths = {}
+        self._indexed = {}
 
     # This is separate because the Creator has to access our instance.
     def open(self, filename):
@@ -583,8 +601,10 @@ class UsersDictionary(utils.IterableMap):
         """Reloads the database from its file."""
         self.nextId = 0
         self.users.clear()
-        self._nameCache.clear()
-        self._hostmaskCache.clear()
+        self._names.clear()
+        self._hostmasks.clear()
+        self._auths.clear()
+        self._indexed.clear()
         if self.filename is not None:
             try:
                 self.open(self.filename)
@@ -593,28 +613,37 @@ class UsersDictionary(utils.IterableMap):
         else:
             log.error('UsersDictionary.reload called with no filename.')
 
-    def flush(self):
-        """Flushes the database to its file."""
+    def snapshot(self):
+        """Returns a callable writing the database as it is now to its file;
+        for world.flushers."""
         if not self.noFlush:
             if self.filename is not None:
                 L = self.users.items()
                 L.sort()
-                fd = utils.file.AtomicFile(self.filename)
+                fd = StringIO()
                 for (id, u) in L:
                     fd.write('user %s' % id)
                     fd.write(os.linesep)
                     u.preserve(fd, indent='  ')
-                fd.close()
+                return _writer(self.filename, fd.getvalue())
             else:
                 log.error('UsersDictionary.flush called with no filename.')
         else:
             log.debug('Not flushing UsersDictionary because of noFlush.')
 
+    def flush(self):
+        """Flushes the database to its file."""
+        _flush(self.snapshot())
+
     def close(self):
         self.flush()
-        if self.flush in world.flushers:
-            world.flushers.remove(self.flush)
+        if self.snapshot in world.flushers:
+            world.flushers.remove(self.snapshot)
         self.users.clear()
+        self._names.clear()
+        self._hostmasks.clear()
+        self._auths.clear()
+        self._indexed.clear()
 
     def iteritems(self):
         return self.users.iteritems()
@@ -622,43 +651,25 @@ class UsersDictionary(utils.IterableMap):
     def getUserId(self, s):
         """Returns the user ID of a given name or hostmask."""
         if ircutils.isUserHostmask(s):
-            try:
-                return self._hostmaskCache[s]
-            except KeyError:
-                ids = {}
-                for (id, user) in self.users.iteritems():
-                    x = user.checkHostmask(s)
-                    if x:
-                        ids[id] = x
-                if len(ids) == 1:
-                    id = ids.keys()[0]
-                    self._hostmaskCache[s] = id
-                    try:
-                        self._hostmaskCache[id].add(s)
-                    except KeyError:
-                        self._hostmaskCache[id] = set([s])
-                    return id
-                elif len(ids) == 0:
-                    raise KeyError, s
-                else:
-                    log.error('Multiple matches found in user database.  '
-                              'Removing the offending hostmasks.')
-                    for (id, hostmask) in ids.iteritems():
-                        log.error('Removing %q from user %s.', hostmask, id)
-                        self.users[id].removeHostmask(hostmask)
-                    raise DuplicateHostmask, 'Ids %r matched.' % ids
+            ids = {}
+            for id in self._candidates(s):
+                x = self.users[id].checkHostmask(s)
+                if x:
+                    ids[id] = x
+            if len(ids) == 1:
+                return ids.keys()[0]
+            elif len(ids) == 0:
+                raise KeyError, s
+            else:
+                log.error('Multiple matches found in user database.  '
+                          'Removing the offending hostmasks.')
+                for (id, hostmask) in ids.iteritems():
+                    log.error('Removing %q from user %s.', hostmask, id)
+                    self.users[id].removeHostmask(hostmask)
+                    self._index(id, self.users[id])
+                raise DuplicateHostmask, 'Ids %r matched.' % ids
         else: # Not a hostmask, must be a name.
-            s = s.lower()
-            try:
-                return self._nameCache[s]
-            except KeyError:
-                for (id, user) in self.users.items():
-                    if s == user.name.lower():
-                        self._nameCache[s] = id
-                        self._nameCache[id] = s
-                        return id
-                else:
-                    raise KeyError, s
+            return self._names[s.lower()]
 
     def getUser(self, id):
         """Returns a user given its id, name, or hostmask."""
@@ -683,24 +694,37 @@ class UsersDictionary(utils.IterableMap):
     def numUsers(self):
         return len(self.users)
 
-    def invalidateCache(self, id=None, hostmask=None, name=None):
-        if hostmask is not None:
-            if hostmask in self._hostmaskCache:
-                id = self._hostmaskCache.pop(hostmask)
-                self._hostmaskCache[id].remove(hostmask)
-                if not self._hostmaskCache[id]:
-                    del self._hostmaskCache[id]
-        if name is not None:
-            del self._nameCache[self._nameCache[id]]
-            del self._nameCache[id]
-        if id is not None:
-            if id in self._nameCache:
-                del self._nameCache[self._nameCache[id]]
-                del self._nameCache[id]
-            if id in self._hostmaskCache:
-                for hostmask in self._hostmaskCache[id]:
-                    del self._hostmaskCache[hostmask]
-                del self._hostmaskCache[id]
+    def _candidates(self, hostmask):
+        """Returns the ids of the users who might match hostmask."""
+        ids = set(self._auths.get(hostmask, ()))
+        for (_, id) in self._hostmasks.match(hostmask):
+            ids.add(id)
+        return ids
+
+    def _unindex(self, id):
+        (name, hostmasks, auths) = self._indexed.pop(id, (None, (), ()))
+        if self._names.get(name) == id:
+            del self._names[name]
+        for hostmask in hostmasks:
+            self._hostmasks.remove(hostmask, id)
+        for hostmask in auths:
+            ids = self._auths[hostmask]
+            ids.discard(id)
+            if not ids:
+                del self._auths[hostmask]
+
+    def _index(self, id, user):
+        """Updates the indexes with user's current name and hostmasks."""
+        self._unindex(id)
+        name = user.name.lower()
+        self._names[name] = id
+        hostmasks = frozenset(user.hostmasks)
+        auths = frozenset([hostmask for (_, hostmask) in user.auth])
+        for hostmask in hostmasks:
+            self._hostmasks.add(hostmask, id)
+        for hostmask in auths:
+            self._auths.setdefault(hostmask, set()).add(id)
+        self._indexed[id] = (name, hostmasks, auths)
 
     def setUser(self, user, flush=True):
         """Sets a user (given its id) to the IrcUser given it."""
@@ -711,34 +735,28 @@ class UsersDictionary(utils.IterableMap):
         except KeyError:
             pass
         for hostmask in user.hostmasks:
-            for (i, u) in self.iteritems():
+            for i in self._candidates(hostmask):
                 if i == user.id:
                     continue
-                elif u.checkHostmask(hostmask):
+                elif self.users[i].checkHostmask(hostmask):
                     # We used to remove the hostmask here, but it's not
                     # appropriate for us both to remove the hostmask and to
                     # raise an exception.  So instead, we'll raise an
                     # exception, but be nice and give the offending hostmask
                     # back at the same time.
                     raise DuplicateHostmask, hostmask
-                for otherHostmask in u.hostmasks:
-                    if ircutils.hostmaskPatternEqual(hostmask, otherHostmask):
-                        raise DuplicateHostmask, hostmask
-        self.invalidateCache(user.id)
+            for (_, i) in self._hostmasks.matchedBy(hostmask):
+                if i != user.id:
+                    raise DuplicateHostmask, hostmask
         self.users[user.id] = user
+        self._index(user.id, user)
         if flush:
             self.flush()
 
     def delUser(self, id):
         """Removes a user from the database."""
         del self.users[id]
-        if id in self._nameCache:
-            del self._nameCache[self._nameCache[id]]
-            del self._nameCache[id]
-        if id in self._hostmaskCache:
-            for hostmask in self._hostmaskCache[id]:
-                del self._hostmaskCache[hostmask]
-            del self._hostmaskCache[id]
+        self._unindex(id)
         self.flush()
 
     def newUser(self):
@@ -776,25 +794,30 @@ class ChannelsDictionary(utils.IterableMap):
         finally:
             self.noFlush = False
 
-    def flush(self):
-        """Flushes the channel database to its file."""
+    def snapshot(self):
+        """Returns a callable writing the channel database as it is now to its
+        file; for world.flushers."""
         if not self.noFlush:
             if self.filename is not None:
-                fd = utils.file.AtomicFile(self.filename)
+                fd = StringIO()
                 for (channel, c) in self.channels.iteritems():
                     fd.write('channel %s' % channel)
                     fd.write(os.linesep)
                     c.preserve(fd, indent='  ')
-                fd.close()
+                return _writer(self.filename, fd.getvalue())
             else:
                 log.warning('ChannelsDictionary.flush without self.filename.')
         else:
             log.debug('Not flushing ChannelsDictionary because of noFlush.')
 
+    def flush(self):
+        """Flushes the channel database to its file."""
+        _flush(self.snapshot())
+
     def close(self):
         self.flush()
-        if self.flush in world.flushers:
-            world.flushers.remove(self.flush)
+        if self.snapshot in world.flushers:
+            world.flushers.remove(self.snapshot)
         self.channels.clear()
 
     def reload(self):
@@ -850,21 +873,22 @@ class IgnoresDB(object):
                 log.error('Invalid line in ignores database: %q', line)
         fd.close()
 
-    def flush(self):
+    def snapshot(self):
         if self.filename is not None:
-            fd = utils.file.AtomicFile(self.filename)
             now = time.time()
-            for (hostmask, expiration) in self.hostmasks.items():
-                if now < expiration or not expiration:
-                    fd.write('%s %s' % (hostmask, expiration))
-                    fd.write(os.linesep)
-            fd.close()
+            L = ['%s %s%s' % (hostmask, expiration, os.linesep)
+                 for (hostmask, expiration) in self.hostmasks.iteritems()
+                 if now < expiration or not expiration]
+            return _writer(self.filename, ''.join(L))
         else:
             log.warning('IgnoresDB.flush called without self.filename.')
 
+    def flush(self):
+        _flush(self.snapshot())
+
     def close(self):
-        if self.flush in world.flushers:
-            world.flushers.remove(self.flush)
+        if self.snapshot in world.flushers:
+            world.flushers.remove(self.snapshot)
         self.flush()
         self.hostmasks.clear()
 
@@ -924,9 +948,9 @@ except EnvironmentError, e:
     log.warning('Couldn\'t open ignore database: %s', e)
 
 
-world.flushers.append(users.flush)
-world.flushers.append(ignores.flush)
-world.flushers.append(channels.flush)
+world.flushers.append(users.snapshot)
+world.flushers.append(ignores.snapshot)
+world.flushers.append(channels.snapshot)
 
 
 ###
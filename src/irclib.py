@@ -31,11 +31,13 @@ import re
 import copy
 import time
 import random
+from array import array
+from collections import deque
 
 from . import conf, ircdb, ircmsgs, ircutils, log, utils, world
 from .utils.str import rsplit
-from .utils.iter import imap, chain, cycle
-from .utils.structures import queue, smallqueue, RingBuffer
+from .utils.iter import imap, izip, chain, cycle
+from .utils.structures import queue, smallqueue
 
 ###
 # The base class for a callback to be registered with an Irc object.  Shows
@@ -62,6 +64,17 @@ class IrcCallback(IrcCommandDispatcher):
     """
     callAfter = ()
     callBefore = ()
+    # The commands of the outgoing messages outFilter wants to see, or None
+    # for all of them.
+    outFilterCommands = None
+    # For plugins: the name of a channel value of the plugin's; outFilter
+    # isn't given messages to channels for which that value is False.
+    outFilterChannelValue = None
+    # A class whose __call__ does nothing more than (eventually) dispatch to
+    # its doCommand methods sets this in its own class body, so Irc knows it
+    # only has to call it for the commands it has a method for.  Any other
+    # __call__ is given every message.
+    __callDispatches__ = True
     __metaclass__ = log.MetaFirewall
     __firewalled__ = {'die': None,
                       'reset': None,
@@ -132,26 +145,95 @@ class IrcCallback(IrcCommandDispatcher):
         """Makes the callback die.  Called when the parent Irc object dies."""
         pass
 
+def _definingClass(cb, attr):
+    """Returns the class in cb's MRO that defines attr, or None."""
+    for cls in getattr(type(cb), '__mro__', ()):
+        if attr in cls.__dict__:
+            return cls
+    return None
+
+def _hasCustomInFilter(cb):
+    cls = _definingClass(cb, 'inFilter')
+    return cls is not None and cls is not IrcCallback
+
+def _hasCustomOutFilter(cb):
+    cls = _definingClass(cb, 'outFilter')
+    return cls is not None and cls is not IrcCallback
+
+def _callDispatches(cb):
+    cls = _definingClass(cb, '__call__')
+    return cls is not None and cls.__dict__.get('__callDispatches__', False)
+
 ###
-# Basic queue for IRC messages.  It doesn't presently (but should at some
-# later point) reorder messages based on priority or penalty calculations.
+# Basic queue for IRC messages.  Messages are sent in order of priority, with
+# the channels and nicks being messaged taking turns, and each message sent
+# costs a penalty, as servers count it for their flood protection.
 ###
 _high = frozenset(['MODE', 'KICK', 'PONG', 'NICK', 'PASS', 'CAPAB'])
 _low = frozenset(['PRIVMSG', 'PING', 'WHO', 'NOTICE', 'JOIN'])
-class IrcMsgQueue(object):
-    """Class for a queue of IrcMsgs.  Eventually, it should be smart.
+# Commands that are more expensive for the server, and hence cost more of
+# the server's flood allowance, than the single throttleTime every other
+# command costs.  They're only charged when
+# supybot.protocols.irc.queuing.penalties is on.
+_penalties = {'WHO': 2, 'WHOIS': 2, 'NAMES': 2, 'LIST': 3, 'JOIN': 2}
+# Commands whose messages are queued by their target, so one target can't
+# starve the others.
+_targeted = frozenset(['PRIVMSG', 'NOTICE'])
+
+class _TargetQueues(object):
+    """FIFO queues of messages by target, served round-robin."""
+    __slots__ = ('queues', 'targets', 'length')
+    def __init__(self):
+        self.queues = {}
+        self.targets = deque()
+        self.length = 0
 
-    Probably smarter than it is now, though it's gotten quite a bit smarter
-    than it originally was.  A method to "score" methods, and a heapq to
-    maintain a priority queue of the messages would be the ideal way to do
-    intelligent queuing.
+    def enqueue(self, target, msg):
+        try:
+            self.queues[target].append(msg)
+        except KeyError:
+            self.queues[target] = deque([msg])
+            self.targets.append(target)
+        self.length += 1
+
+    def dequeue(self):
+        target = self.targets.popleft()
+        q = self.queues[target]
+        msg = q.popleft()
+        if q:
+            self.targets.append(target)
+        else:
+            del self.queues[target]
+        self.length -= 1
+        return msg
 
-    As it stands, however, we simply keep track of 'high priority' messages,
-    'low priority' messages, and normal messages, and just make sure to return
-    the 'high priority' ones before the normal ones before the 'low priority'
-    ones.
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for target in self.targets:
+            for msg in self.queues[target]:
+                yield msg
+
+class IrcMsgQueue(object):
+    """Class for a queue of IrcMsgs.
+
+    Messages are returned by priority: 'high priority' messages before normal
+    ones before 'low priority' ones.  Within a priority, PRIVMSGs and NOTICEs
+    are queued separately for each target, and the targets take turns, so a
+    long reply to one channel doesn't hold up the others; messages to the
+    same target are still sent in the order they were queued.
+
+    The queue also keeps track of the penalty the messages it has given out
+    cost, in the manner of a token bucket: each message costs throttleTime
+    seconds (more for commands in _penalties, if
+    supybot.protocols.irc.queuing.penalties is on), and up to
+    supybot.protocols.irc.queuing.burst messages' worth of penalty may be
+    outstanding at once.  charge() adds the penalty for a message that was
+    sent, and readyAt() is when the next message may be sent.
     """
-    __slots__ = ('msgs', 'highpriority', 'normal', 'lowpriority', 'lastJoin')
+    __slots__ = ('msgs', 'highpriority', 'normal', 'lowpriority', 'lastJoin',
+                 'penalty')
     def __init__(self, iterable=()):
         self.reset()
         for msg in iterable:
@@ -160,24 +242,34 @@ class IrcMsgQueue(object):
     def reset(self):
         """Clears the queue."""
         self.lastJoin = 0
-        self.highpriority = smallqueue()
-        self.normal = smallqueue()
-        self.lowpriority = smallqueue()
+        self.penalty = 0
+        self.msgs = utils.structures.MultiSet()
+        self.highpriority = _TargetQueues()
+        self.normal = _TargetQueues()
+        self.lowpriority = _TargetQueues()
+
+    def _enqueue(self, msg):
+        if msg.command in _targeted and msg.args:
+            target = ircutils.toLower(msg.args[0])
+        else:
+            target = None
+        if msg.command in _high:
+            self.highpriority.enqueue(target, msg)
+        elif msg.command in _low:
+            self.lowpriority.enqueue(target, msg)
+        else:
+            self.normal.enqueue(target, msg)
 
     def enqueue(self, msg):
         """Enqueues a given message."""
-        if msg in self and \
+        if msg in self.msgs and \
            conf.supybot.protocols.irc.queuing.duplicates():
             s = str(msg).strip()
             log.info('Not adding message %q to queue, already added.', s)
             return False
         else:
-            if msg.command in _high:
-                self.highpriority.enqueue(msg)
-            elif msg.command in _low:
-                self.lowpriority.enqueue(msg)
-            else:
-                self.normal.enqueue(msg)
+            self.msgs.add(msg)
+            self._enqueue(msg)
             return True
 
     def dequeue(self):
@@ -195,14 +287,28 @@ class IrcMsgQueue(object):
                 if self.lastJoin + limit <= now:
                     self.lastJoin = now
                 else:
-                    self.lowpriority.enqueue(msg)
+                    self._enqueue(msg)
                     msg = None
+        if msg is not None:
+            self.msgs.remove(msg)
         return msg
 
+    def charge(self, msg):
+        """Adds the penalty for sending msg; Irc.takeMsg calls this for the
+        messages it actually sends."""
+        cost = conf.supybot.protocols.irc.throttleTime()
+        if conf.supybot.protocols.irc.queuing.penalties():
+            cost *= _penalties.get(msg.command, 1)
+        self.penalty = max(self.penalty, time.time()) + cost
+
+    def readyAt(self):
+        """Returns the time at which the next message may be sent."""
+        burst = conf.supybot.protocols.irc.queuing.burst()
+        throttle = conf.supybot.protocols.irc.throttleTime()
+        return self.penalty - (burst - 1) * throttle
+
     def __contains__(self, msg):
-        return msg in self.normal or \
-               msg in self.lowpriority or \
-               msg in self.highpriority
+        return msg in self.msgs
 
     def __nonzero__(self):
         return bool(self.highpriority or self.normal or self.lowpriority)
@@ -224,7 +330,12 @@ class IrcMsgQueue(object):
 ###
 class ChannelState(utils.python.Object):
     __slots__ = ('users', 'ops', 'halfops', 'bans',
-                 'voices', 'topic', 'modes', 'created')
+                 'voices', 'topic', 'modes', 'created',
+                 '_channels', '_name', '_shares')
+    # The slots that make up the state itself; the others are for the
+    # ChannelStates we're in, to keep track of our users and of how many
+    # copies of it share us.
+    _stateSlots = __slots__[:-3]
     def __init__(self):
         self.topic = ''
         self.created = 0
@@ -234,6 +345,19 @@ class ChannelState(utils.python.Object):
         self.voices = ircutils.IrcSet()
         self.halfops = ircutils.IrcSet()
         self.modes = {}
+        self._channels = None
+        self._name = None
+        self._shares = 1
+
+    def copy(self):
+        """Returns a copy of the state, sharing none of its sets."""
+        new = self.__class__()
+        new.topic = self.topic
+        new.created = self.created
+        new.modes = self.modes.copy()
+        for name in ('users', 'ops', 'halfops', 'bans', 'voices'):
+            setattr(new, name, getattr(self, name).copy())
+        return new
 
     def isOp(self, nick):
         return nick in self.ops
@@ -260,6 +384,8 @@ class ChannelState(utils.python.Object):
             elif marker == '+':
                 self.voices.add(nick)
         self.users.add(nick)
+        if self._channels is not None:
+            self._channels.addNick(nick, self._name)
 
     def replaceUser(self, oldNick, newNick):
         """Changes the user oldNick to newNick; used for NICK changes."""
@@ -270,6 +396,9 @@ class ChannelState(utils.python.Object):
             if oldNick in s:
                 s.remove(oldNick)
                 s.add(newNick)
+        if self._channels is not None and newNick in self.users:
+            self._channels.removeNick(oldNick, self._name)
+            self._channels.addNick(newNick, self._name)
 
     def removeUser(self, user):
         """Removes a given user from the channel."""
@@ -277,6 +406,8 @@ class ChannelState(utils.python.Object):
         self.ops.discard(user)
         self.halfops.discard(user)
         self.voices.discard(user)
+        if self._channels is not None:
+            self._channels.removeNick(user, self._name)
 
     def setMode(self, mode, value=None):
         assert mode not in 'ovhbeq'
@@ -316,19 +447,415 @@ class ChannelState(utils.python.Object):
                     self.unsetMode(modeChar)
 
     def __getstate__(self):
-        return [getattr(self, name) for name in self.__slots__]
+        return [getattr(self, name) for name in self._stateSlots]
 
     def __setstate__(self, t):
-        for (name, value) in zip(self.__slots__, t):
+        for (name, value) in zip(self._stateSlots, t):
             setattr(self, name, value)
+        self._channels = None
+        self._name = None
+        self._shares = 1
+
+    def setCasemapping(self, casemapping):
+        """Makes the nicks (and bans) be compared according to casemapping."""
+        for name in ('users', 'ops', 'halfops', 'bans', 'voices'):
+            s = ircutils.IrcSet(getattr(self, name), casemapping=casemapping)
+            setattr(self, name, s)
 
     def __eq__(self, other):
         ret = True
-        for name in self.__slots__:
+        for name in self._stateSlots:
             ret = ret and getattr(self, name) == getattr(other, name)
         return ret
 
 
+class ChannelStates(ircutils.IrcDict):
+    """The ChannelStates of an IrcState, by channel.
+
+    Keeps an index of the channels each nick is in, so the channels of a
+    nick that quits or changes nicks don't have to be found by looking
+    through every channel.  The index is kept up to date by the addUser,
+    removeUser, and replaceUser methods of the ChannelStates in it.
+
+    Copies share their ChannelStates with the original; a ChannelState is
+    only copied when it's first looked up in (or iterated over from) one of
+    them, so ChannelStates shouldn't be held on to across changes of the
+    state.  The index of a copy is only built when it's needed.
+    """
+    def __init__(self, dict=None, casemapping=None):
+        self._nicks = ircutils.IrcDict(casemapping=casemapping)
+        super(ChannelStates, self).__init__(dict, casemapping)
+
+    def _getNicks(self):
+        if self._nicks is None:
+            self._nicks = ircutils.IrcDict(casemapping=self.casemapping)
+            for (name, state) in self.data.itervalues():
+                if isinstance(state, ChannelState):
+                    for nick in state.users:
+                        self.addNick(nick, name)
+        return self._nicks
+    nicks = property(_getNicks)
+
+    def copy(self):
+        new = super(ChannelStates, self).copy()
+        new._nicks = None
+        for (_, state) in self.data.itervalues():
+            if isinstance(state, ChannelState):
+                state._shares += 1
+        return new
+
+    def _own(self, name, state):
+        # Makes sure the state is ours alone, and that it knows it's ours.
+        if state._shares > 1:
+            state._shares -= 1
+            state = state.copy()
+            if self._shared:
+                self._unshare()
+            self.data[self.key(name)] = (name, state)
+        state._channels = self
+        state._name = name
+        return state
+
+    def __getitem__(self, channel):
+        (name, state) = self.data[self.key(channel)]
+        if isinstance(state, ChannelState) and \
+           (state._shares > 1 or state._channels is not self):
+            state = self._own(name, state)
+        return state
+
+    def iteritems(self):
+        for (name, state) in self.data.values():
+            if isinstance(state, ChannelState) and \
+               (state._shares > 1 or state._channels is not self):
+                state = self._own(name, state)
+            yield (name, state)
+
+    def setCasemapping(self, casemapping):
+        super(ChannelStates, self).setCasemapping(casemapping)
+        if self._nicks is not None:
+            self._nicks.setCasemapping(casemapping)
+        for (_, state) in self.iteritems():
+            if isinstance(state, ChannelState):
+                state.setCasemapping(casemapping)
+
+    def __setitem__(self, channel, state):
+        if channel in self:
+            del self[channel]
+        super(ChannelStates, self).__setitem__(channel, state)
+        if isinstance(state, ChannelState):
+            if state.users.casemapping != self.casemapping:
+                state.setCasemapping(self.casemapping)
+            state._channels = self
+            state._name = channel
+            for nick in state.users:
+                self.addNick(nick, channel)
+
+    def _release(self, name, state):
+        if isinstance(state, ChannelState):
+            if state._channels is self:
+                state._channels = None
+                state._name = None
+            if state._shares > 1:
+                state._shares -= 1
+            for nick in state.users:
+                self.removeNick(nick, name)
+
+    def __delitem__(self, channel):
+        if self._shared:
+            self._unshare()
+        (name, state) = self.data.pop(self.key(channel))
+        self._release(name, state)
+
+    def clear(self):
+        for (name, state) in self.data.itervalues():
+            self._release(name, state)
+        super(ChannelStates, self).clear()
+        self._nicks = ircutils.IrcDict(casemapping=self.casemapping)
+
+    # While the index of a copy isn't built, there's nothing to keep up to
+    # date; it'll be built from the ChannelStates as they are.
+    def addNick(self, nick, channel):
+        if self._nicks is not None:
+            try:
+                self._nicks[nick].add(channel)
+            except KeyError:
+                self._nicks[nick] = set([channel])
+
+    def removeNick(self, nick, channel):
+        if self._nicks is not None:
+            channels = self._nicks.get(nick)
+            if channels is not None:
+                channels.discard(channel)
+                if not channels:
+                    del self._nicks[nick]
+
+    def channelsOf(self, nick):
+        """Returns the set of the channels nick is in.  Don't modify it."""
+        return self.nicks.get(nick, frozenset())
+
+
+class MsgHistory(object):
+    """The last maxSize messages of an IrcState.  It's used like a RingBuffer
+    of IrcMsgs, but is far more compact: the raw lines are kept end to end in
+    a single bytearray, with the command, channel, nick, network and time of
+    each message in parallel arrays, and IrcMsgs are only made again for the
+    messages that are looked at.  The only tags kept are receivedAt and
+    receivedOn.
+
+    Since the same history may be shared by the IrcStates of several networks
+    (see Owner), channels and nicks are always compared in rfc1459 case."""
+    __slots__ = ('maxSize', 'lines', 'head', 'start', 'count', 'ids', 'names',
+                 'offsets', 'lengths', 'times', 'commands', 'channels',
+                 'nicks', 'networks')
+    _arrays = (('offsets', 'l'), ('lengths', 'i'), ('times', 'd'),
+               ('commands', 'i'), ('channels', 'i'), ('nicks', 'i'),
+               ('networks', 'i'))
+    def __init__(self, maxSize, seq=()):
+        if maxSize <= 0:
+            raise ValueError, 'maxSize must be > 0.'
+        self.maxSize = maxSize
+        self.reset()
+        self.extend(seq)
+
+    def reset(self):
+        self.lines = bytearray()
+        self.head = 0 # Where the next line goes in self.lines.
+        # The slot of the oldest message in the arrays.  Until maxSize
+        # messages have been added, it's always 0.
+        self.start = 0
+        self.count = 0
+        # Commands, lowered channels and nicks, and networks are kept in the
+        # arrays as ids.
+        self.ids = {}
+        self.names = []
+        for (name, typecode) in self._arrays:
+            setattr(self, name, array(typecode))
+
+    def resize(self, maxSize):
+        self.maxSize = maxSize
+        self._rebuild(min(self.count, maxSize))
+
+    def _id(self, name):
+        if name is None:
+            return -1
+        try:
+            return self.ids[name]
+        except KeyError:
+            id = self.ids[name] = len(self.names)
+            self.names.append(name)
+            return id
+
+    def _place(self, n):
+        """Returns where in self.lines a line of n bytes can go without
+        overwriting any of our messages, or None if there's no room for it."""
+        size = len(self.lines)
+        if not self.count:
+            if n <= size:
+                return 0
+        else:
+            first = self.offsets[self.start]
+            if first < self.head:
+                if self.head + n <= size:
+                    return self.head
+                elif n <= first:
+                    return 0
+            elif self.head + n <= first:
+                return self.head
+        return None
+
+    def _rebuild(self, n, room=0):
+        """Keeps only the newest n messages, writing them to a new bytearray
+        with at least room bytes to spare, and dropping the ids no longer
+        used."""
+        (lines, names) = (self.lines, self.names)
+        def nameOf(id):
+            if id < 0:
+                return None
+            return names[id]
+        entries = []
+        # The ring is every slot of the arrays; when we're called from _add,
+        # the oldest message has just been dropped from count, but not from
+        # the arrays.
+        slots = len(self.offsets)
+        for k in xrange(self.count - n, self.count):
+            slot = (self.start + k) % slots
+            entries.append([getattr(self, name)[slot]
+                            for (name, _) in self._arrays])
+        size = sum([entry[1] for entry in entries])
+        self.reset()
+        self.lines = bytearray(max(3 * (size + room) // 2, 1024))
+        for (offset, length, t, command, channel, nick, network) in entries:
+            self._add(lines[offset:offset+length], t, names[command],
+                      nameOf(channel), nameOf(nick), nameOf(network))
+
+    def _add(self, line, t, command, channel, nick, network):
+        if self.count == self.maxSize:
+            # The oldest message makes room for the new one.
+            self.start = (self.start + 1) % self.count
+            self.count -= 1
+        n = len(line)
+        offset = self._place(n)
+        if offset is None:
+            self._rebuild(self.count, n)
+            offset = self.head
+        values = (offset, n, t, self._id(command), self._id(channel),
+                  self._id(nick), self._id(network))
+        if len(self.offsets) < self.maxSize:
+            for ((name, _), value) in zip(self._arrays, values):
+                getattr(self, name).append(value)
+        else:
+            slot = (self.start + self.count) % self.maxSize
+            for ((name, _), value) in zip(self._arrays, values):
+                getattr(self, name)[slot] = value
+        self.count += 1
+        self.lines[offset:offset+n] = line
+        self.head = offset + n
+
+    def append(self, msg):
+        # Each message adds at most four names; when most of them are the
+        # names of messages long gone, it's time to drop them.
+        if len(self.names) > 4 * self.maxSize + 1024:
+            self._rebuild(self.count)
+        line = str(msg).rstrip('\r\n')
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        if msg.args and ircutils.isChannel(msg.args[0]):
+            channel = ircutils.toLower(msg.args[0])
+        else:
+            channel = None
+        if msg.prefix:
+            nick = ircutils.toLower(msg.nick)
+        else:
+            nick = None
+        self._add(line, msg.receivedAt or 0.0, msg.command, channel, nick,
+                  msg.receivedOn)
+
+    def extend(self, seq):
+        for msg in seq:
+            self.append(msg)
+
+    def _line(self, slot):
+        offset = self.offsets[slot]
+        return str(self.lines[offset:offset+self.lengths[slot]])
+
+    def _msg(self, slot):
+        msg = ircmsgs.IrcMsg(self._line(slot) + '\r\n')
+        if self.times[slot]:
+            msg.tag('receivedAt', self.times[slot])
+        if self.networks[slot] >= 0:
+            msg.tag('receivedOn', self.names[self.networks[slot]])
+        return msg
+
+    def _slots(self, reverse=False):
+        """Returns the slots of the messages, oldest first, or newest first
+        if reverse."""
+        (start, count) = (self.start, self.count)
+        if reverse:
+            return chain(xrange(start - 1, -1, -1),
+                         xrange(count - 1, start - 1, -1))
+        else:
+            return chain(xrange(start, count), xrange(0, start))
+
+    def indexes(self, command=None, channel=None, nick=None, reverse=False):
+        """Yields the indexes of the messages with the given command (or any
+        of the given commands), channel and nick, oldest first or newest first
+        if reverse.  No message is parsed to find them."""
+        tests = []
+        if command is not None:
+            if isinstance(command, basestring):
+                command = (command,)
+            tests.append((self.commands, command))
+        if channel is not None:
+            tests.append((self.channels, (ircutils.toLower(channel),)))
+        if nick is not None:
+            tests.append((self.nicks, (ircutils.toLower(nick),)))
+        for (i, (values, names)) in enumerate(tests):
+            ids = frozenset([self.ids[name] for name in names
+                             if name in self.ids])
+            if not ids:
+                return
+            tests[i] = (values, ids)
+        if reverse:
+            ks = xrange(self.count - 1, -1, -1)
+        else:
+            ks = xrange(self.count)
+        for (k, slot) in izip(ks, self._slots(reverse)):
+            for (values, ids) in tests:
+                if values[slot] not in ids:
+                    break
+            else:
+                yield k
+
+    def scan(self, command=None, channel=None, nick=None, reverse=False):
+        """Yields the messages with the given command (or any of the given
+        commands), channel and nick, oldest first or newest first if
+        reverse."""
+        for i in self.indexes(command, channel, nick, reverse):
+            yield self[i]
+
+    def __len__(self):
+        return self.count
+
+    def __nonzero__(self):
+        return self.count > 0
+
+    def __iter__(self):
+        for slot in self._slots():
+            yield self._msg(slot)
+
+    def __reversed__(self):
+        for slot in self._slots(reverse=True):
+            yield self._msg(slot)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(self.count))]
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError, idx
+        return self._msg((self.start + idx) % self.count)
+
+    def __contains__(self, msg):
+        line = str(msg).rstrip('\r\n')
+        for slot in self._slots():
+            if self._line(slot) == line:
+                return True
+        return False
+
+    def __eq__(self, other):
+        return self.__class__ == other.__class__ and \
+               self.maxSize == other.maxSize and \
+               len(self) == len(other) and \
+               map(self._line, self._slots()) == \
+               map(other._line, other._slots())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'MsgHistory(%r, %r)' % (self.maxSize, list(self))
+
+    def copy(self):
+        new = self.__class__.__new__(self.__class__)
+        state = self.__getstate__()
+        new.__setstate__([state[0], bytearray(state[1])] +
+                         [x[:] for x in state[2:]])
+        return new
+
+    def __getstate__(self):
+        return [self.maxSize, self.lines, self.names,
+                [self.head, self.start, self.count]] + \
+               [getattr(self, name) for (name, _) in self._arrays]
+
+    def __setstate__(self, state):
+        (self.maxSize, self.lines, self.names,
+         (self.head, self.start, self.count)) = state[:4]
+        for ((name, _), value) in zip(self._arrays, state[4:]):
+            setattr(self, name, value)
+        self.ids = dict([(name, id) for (id, name) in enumerate(self.names)])
+
+
 class IrcState(IrcCommandDispatcher):
     """Maintains state of the Irc connection.  Should also become smarter.
     """
@@ -337,13 +864,15 @@ class IrcState(IrcCommandDispatcher):
     def __init__(self, history=None, supported=None,
                  nicksToHostmasks=None, channels=None):
         if history is None:
-            history = RingBuffer(conf.supybot.protocols.irc.maxHistoryLength())
+            history = MsgHistory(conf.supybot.protocols.irc.maxHistoryLength())
         if supported is None:
             supported = utils.InsensitivePreservingDict()
         if nicksToHostmasks is None:
             nicksToHostmasks = ircutils.IrcDict()
         if channels is None:
-            channels = ircutils.IrcDict()
+            channels = ChannelStates()
+        elif not isinstance(channels, ChannelStates):
+            channels = ChannelStates(channels)
         self.supported = supported
         self.history = history
         self.channels = channels
@@ -355,6 +884,7 @@ class IrcState(IrcCommandDispatcher):
         self.channels.clear()
         self.supported.clear()
         self.nicksToHostmasks.clear()
+        self.setCasemapping(None)
         self.history.resize(conf.supybot.protocols.irc.maxHistoryLength())
 
     def __reduce__(self):
@@ -371,21 +901,37 @@ class IrcState(IrcCommandDispatcher):
         return not self == other
 
     def copy(self):
-        ret = self.__class__()
-        ret.history = copy.deepcopy(self.history)
-        ret.nicksToHostmasks = copy.deepcopy(self.nicksToHostmasks)
-        ret.channels = copy.deepcopy(self.channels)
-        return ret
+        """Returns a copy of the state.  The copy shares its channels and
+        nicksToHostmasks with us until either of us changes them, and each
+        ChannelState is only copied when it's first used, so this is cheap
+        even for a large state."""
+        return self.__class__(history=self.history.copy(),
+                              supported=self.supported.copy(),
+                              nicksToHostmasks=self.nicksToHostmasks.copy(),
+                              channels=self.channels.copy())
 
     def addMsg(self, irc, msg):
-        """Updates the state based on the irc object and the message."""
+        """Updates the state based on the irc object and the message.
+
+        Since a QUIT or NICK message changes the state of every channel the
+        user is in, such messages are tagged with 'channels', the list of
+        those channels as they were before the message, so callbacks don't
+        have to keep their own copy of the state to find out."""
         self.history.append(msg)
-        if ircutils.isUserHostmask(msg.prefix) and not msg.command == 'NICK':
+        # msg.nick is only different from msg.prefix when the prefix is a
+        # user hostmask, and IrcMsg has already had to check that for us.
+        if msg.nick != msg.prefix and not msg.command == 'NICK':
             self.nicksToHostmasks[msg.nick] = msg.prefix
         method = self.dispatchCommand(msg.command)
         if method is not None:
             method(irc, msg)
 
+    def setCasemapping(self, casemapping):
+        """Makes the nicks and channels of the state be compared according to
+        casemapping, the CASEMAPPING the server gave in its 005."""
+        self.channels.setCasemapping(casemapping)
+        self.nicksToHostmasks.setCasemapping(casemapping)
+
     def getTopic(self, channel):
         """Returns the topic for a given channel."""
         return self.channels[channel].topic
@@ -394,6 +940,24 @@ class IrcState(IrcCommandDispatcher):
         """Returns the hostmask for a given nick."""
         return self.nicksToHostmasks[nick]
 
+    def nickToChannels(self, nick):
+        """Returns the list of the channels the given nick is in."""
+        return list(self.channels.channelsOf(nick))
+
+    def sharedChannels(self, nick, other):
+        """Returns the list of the channels both nick and other are in."""
+        return list(self.channels.channelsOf(nick) &
+                    self.channels.channelsOf(other))
+
+    def _tagChannels(self, msg):
+        # Only the first state to see the message knows the channels as they
+        # were; copies of it (or stale states) shouldn't overwrite them.
+        channels = msg.tagged('channels')
+        if channels is None:
+            channels = self.nickToChannels(msg.nick)
+            msg.tag('channels', channels)
+        return channels
+
     def do004(self, irc, msg):
         """Handles parsing the 004 reply
 
@@ -468,6 +1032,12 @@ class IrcState(IrcCommandDispatcher):
                 except Exception, e:
                     log.exception('Uncaught exception in 005 converter:')
                     log.error('Name: %s, Converter: %s', name, converter)
+                if name.lower() == 'casemapping':
+                    try:
+                        self.setCasemapping(value)
+                    except ValueError:
+                        log.warning('Unknown CASEMAPPING %s, using rfc1459.',
+                                    value)
             else:
                 self.supported[arg] = None
 
@@ -547,8 +1117,9 @@ class IrcState(IrcCommandDispatcher):
                 chan.removeUser(user)
 
     def doQuit(self, irc, msg):
-        for channel in self.channels.itervalues():
-            channel.removeUser(msg.nick)
+        self._tagChannels(msg)
+        for channel in self.nickToChannels(msg.nick):
+            self.channels[channel].removeUser(msg.nick)
         if msg.nick in self.nicksToHostmasks:
             # If we're quitting, it may not be.
             del self.nicksToHostmasks[msg.nick]
@@ -578,8 +1149,9 @@ class IrcState(IrcCommandDispatcher):
             del self.nicksToHostmasks[oldNick]
         except KeyError:
             pass
-        for channel in self.channels.itervalues():
-            channel.replaceUser(oldNick, newNick)
+        self._tagChannels(msg)
+        for channel in self.nickToChannels(oldNick):
+            self.channels[channel].replaceUser(oldNick, newNick)
 
 
 
@@ -589,6 +1161,9 @@ class IrcState(IrcCommandDispatcher):
 # 'queue', and 'state', in addition to the standard nick/user/ident attributes.
 ###
 _callbacks = []
+# Incremented whenever any callbacks list changes, so every Irc knows to
+# rebuild its dispatch index (the default callbacks list is shared).
+_callbacksGeneration = 0
 class Irc(IrcCommandDispatcher):
     """The base class for an IRC connection.
 
@@ -612,6 +1187,7 @@ class Irc(IrcCommandDispatcher):
         self.queue = IrcMsgQueue()
         self.fastqueue = smallqueue()
         self.driver = None # The driver should set this later.
+        self._callbacksGeneration = None
         self._setNonResettingVariables()
         self._queueConnectMessages()
         self.startedSync = ircutils.IrcDict()
@@ -632,10 +1208,69 @@ class Irc(IrcCommandDispatcher):
             kw['nicklen'] = self.state.supported['nicklen']
         return ircutils.isNick(s, **kw)
 
+    def _callbacksChanged(self):
+        global _callbacksGeneration
+        _callbacksGeneration += 1
+
+    def _indexCallbacks(self):
+        """Rebuilds the index of which callbacks are interested in which
+        commands."""
+        self._inFilterCallbacks = [cb for cb in self.callbacks if
+                                   cb is not None and _hasCustomInFilter(cb)]
+        self._commandCallbacks = {}
+        self._outFilterCallbacks = {}
+        self._callbacksGeneration = _callbacksGeneration
+
+    def getCallbacksFor(self, command):
+        """Returns the callbacks (in order) that need to be called for a
+        message with the given command: those with a custom __call__, and
+        those with a doCommand method for it."""
+        if self._callbacksGeneration != _callbacksGeneration:
+            self._indexCallbacks()
+        try:
+            return self._commandCallbacks[command]
+        except KeyError:
+            L = []
+            for cb in self.callbacks:
+                if cb is None:
+                    continue
+                if not _callDispatches(cb) or \
+                   cb.dispatchCommand(command) is not None:
+                    L.append(cb)
+            self._commandCallbacks[command] = L
+            return L
+
+    def getOutFilterCallbacks(self, command):
+        """Returns the (callback, channelValue) pairs, in the order their
+        outFilters are to be applied, for the callbacks that filter outgoing
+        messages with the given command.  channelValue is the callback's
+        outFilterChannelValue."""
+        if self._callbacksGeneration != _callbacksGeneration:
+            self._indexCallbacks()
+        try:
+            return self._outFilterCallbacks[command]
+        except KeyError:
+            L = []
+            for cb in reversed(self.callbacks):
+                if cb is None or not _hasCustomOutFilter(cb):
+                    continue
+                if cb.outFilterCommands is None or \
+                   command in cb.outFilterCommands:
+                    L.append((cb, cb.outFilterChannelValue))
+            self._outFilterCallbacks[command] = L
+            return L
+
+    def getInFilterCallbacks(self):
+        """Returns the callbacks (in order) that have their own inFilter."""
+        if self._callbacksGeneration != _callbacksGeneration:
+            self._indexCallbacks()
+        return self._inFilterCallbacks
+
     # This *isn't* threadsafe!
     def addCallback(self, callback):
         """Adds a callback to the callbacks list."""
         assert not self.getCallback(callback.name())
+        self._callbacksChanged()
         self.callbacks.append(callback)
         # This is the new list we're building, which will be tsorted.
         cbs = []
@@ -687,6 +1322,7 @@ class Irc(IrcCommandDispatcher):
             return cb.name().lower() == name
         (bad, good) = utils.iter.partition(nameMatches, self.callbacks)
         self.callbacks[:] = good
+        self._callbacksChanged()
         return bad
 
     def queueMsg(self, msg):
@@ -708,37 +1344,38 @@ class Irc(IrcCommandDispatcher):
         """Called by the IrcDriver; takes a message to be sent."""
         if not self.callbacks:
             log.critical('No callbacks in %s.', self)
-        now = time.time()
-        msg = None
-        if self.fastqueue:
-            msg = self.fastqueue.dequeue()
-        elif self.queue:
-            if now-self.lastTake <= conf.supybot.protocols.irc.throttleTime():
-                log.debug('Irc.takeMsg throttling.')
-            else:
-                self.lastTake = now
-                msg = self.queue.dequeue()
-        elif self.afterConnect and \
-             conf.supybot.protocols.irc.ping() and \
-             now > self.lastping + conf.supybot.protocols.irc.ping.interval():
-            if self.outstandingPing:
-                s = 'Ping sent at %s not replied to.' % \
-                    log.timestamp(self.lastping)
-                log.warning(s)
-                self.feedMsg(ircmsgs.error(s))
-                self.driver.reconnect()
-            elif not self.zombie:
-                self.lastping = now
-                now = str(int(now))
-                self.outstandingPing = True
-                self.queueMsg(ircmsgs.ping(now))
-        if msg:
-            for callback in reversed(self.callbacks):
-                msg = callback.outFilter(self, msg)
-                if msg is None:
-                    log.debug('%s.outFilter returned None.', callback.name())
-                    return self.takeMsg()
-                world.debugFlush()
+        while True:
+            now = time.time()
+            msg = None
+            queued = False
+            if self.fastqueue:
+                msg = self.fastqueue.dequeue()
+            elif self.queue:
+                if now < self.queue.readyAt():
+                    log.debug('Irc.takeMsg throttling.')
+                else:
+                    msg = self.queue.dequeue()
+                    queued = True
+            elif self.afterConnect and \
+                 conf.supybot.protocols.irc.ping() and \
+                 now > self.lastping+conf.supybot.protocols.irc.ping.interval():
+                if self.outstandingPing:
+                    s = 'Ping sent at %s not replied to.' % \
+                        log.timestamp(self.lastping)
+                    log.warning(s)
+                    self.feedMsg(ircmsgs.error(s))
+                    self.driver.reconnect()
+                elif not self.zombie:
+                    self.lastping = now
+                    self.outstandingPing = True
+                    self.queueMsg(ircmsgs.ping(str(int(now))))
+            if not msg:
+                break
+            msg = self._outFilter(msg)
+            if msg is None:
+                continue # It was filtered out; on to the next one.
+            if queued:
+                self.queue.charge(msg)
             if len(str(msg)) > 512:
                 # Yes, this violates the contract, but at this point it doesn't
                 # matter.  That's why we gotta go munging in private attributes
@@ -758,13 +1395,31 @@ class Irc(IrcCommandDispatcher):
                 self.state.addMsg(self, msg)
             log.debug('Outgoing message: %s', str(msg).rstrip('\r\n'))
             return msg
-        elif self.zombie:
+        if self.zombie:
             # We kill the driver here so it doesn't continue to try to
             # take messages from us.
             self.driver.die()
             self._reallyDie()
+        return None
+
+    def _outFilter(self, msg):
+        """Passes msg through the outFilters of the callbacks interested in
+        it, returning the filtered message, or None if it was dropped."""
+        if msg.args and self.isChannel(msg.args[0]):
+            channel = msg.args[0]
         else:
-            return None
+            channel = None
+        callbacks = self.getOutFilterCallbacks(msg.command)
+        for (callback, channelValue) in callbacks:
+            if channelValue is not None and channel is not None and \
+               not callback.registryValue(channelValue, channel):
+                continue
+            msg = callback.outFilter(self, msg)
+            if msg is None:
+                log.debug('%s.outFilter returned None.', callback.name())
+                return None
+            world.debugFlush()
+        return msg
 
     _numericErrorCommandRe = re.compile(r'^[45][0-9][0-9]$')
     def feedMsg(self, msg):
@@ -812,9 +1467,11 @@ class Irc(IrcCommandDispatcher):
         except:
             log.exception('Exception in update of IrcState object:')
 
-        # Now call the callbacks.
+        # Now call the callbacks.  Only the callbacks that define their own
+        # inFilter need to see the message here, and only those with a
+        # handler for its command (or their own __call__) after that.
         world.debugFlush()
-        for callback in self.callbacks:
+        for callback in self.getInFilterCallbacks():
             try:
                 m = callback.inFilter(self, msg)
                 if not m:
@@ -827,10 +1484,9 @@ class Irc(IrcCommandDispatcher):
         postInFilter = str(msg).rstrip('\r\n')
         if postInFilter != preInFilter:
             log.debug('Incoming message (post-inFilter): %s', postInFilter)
-        for callback in self.callbacks:
+        for callback in self.getCallbacksFor(msg.command):
             try:
-                if callback is not None:
-                    callback(self, msg)
+                callback(self, msg)
             except:
                 log.exception('Uncaught exception in callback:')
             world.debugFlush()
@@ -867,7 +1523,6 @@ class Irc(IrcCommandDispatcher):
         self.password = conf.supybot.networks.get(self.network).password()
         self.prefix = '%s!%s@%s' % (self.nick, self.ident, 'unset.domain')
         # The rest.
-        self.lastTake = 0
         self.server = 'unset'
         self.afterConnect = False
         self.lastping = time.time()
@@ -1017,6 +1672,7 @@ class Irc(IrcCommandDispatcher):
                 # hurt anybody.
                 log.debug('Last Irc, clearing callbacks.')
                 self.callbacks[:] = []
+                self._callbacksChanged()
         else:
             log.warning('Irc object killed twice: %s', utils.stackTrace())
 
@@ -78,8 +78,13 @@ class IrcMsg(object):
     # It's too useful to be able to tag IrcMsg objects with extra, unforeseen
     # data.  Goodbye, __slots__.
     # On second thought, let's use methods for tagging.
+    #
+    # The nick, user, and host slots aren't filled in by the constructor;
+    # they're computed from the prefix by __getattr__ the first time they're
+    # asked for, since most messages we parse never need them.  Likewise, the
+    # tags dictionary isn't made until a message is actually tagged.
     __slots__ = ('args', 'command', 'host', 'nick', 'prefix', 'user',
-                 '_hash', '_str', '_repr', '_len', 'tags')
+                 '_hash', '_str', '_repr', '_len', '_tags')
     def __init__(self, s='', command='', args=(), prefix='', msg=None):
         assert not (msg and s), 'IrcMsg.__init__ cannot accept both s and msg'
         if not s and not command and not msg:
@@ -88,7 +93,7 @@ class IrcMsg(object):
         self._repr = None
         self._hash = None
         self._len = None
-        self.tags = {}
+        self._tags = None
         if s:
             originalString = s
             try:
@@ -99,13 +104,13 @@ class IrcMsg(object):
                     self.prefix, s = s[1:].split(None, 1)
                 else:
                     self.prefix = ''
-                if ' :' in s: # Note the space: IPV6 addresses are bad w/o it.
-                    s, last = s.split(' :', 1)
-                    self.args = s.split()
-                    self.args.append(last.rstrip('\r\n'))
-                else:
-                    self.args = s.split()
-                self.command = self.args.pop(0)
+                # Note the space: IPV6 addresses are bad w/o it.
+                (s, sep, last) = s.rstrip('\r\n').partition(' :')
+                args = s.split()
+                if sep:
+                    args.append(last)
+                self.command = args[0]
+                self.args = tuple(args[1:])
             except (IndexError, ValueError):
                 raise MalformedIrcMsg, repr(originalString)
         else:
@@ -122,17 +127,35 @@ class IrcMsg(object):
                     self.args = args
                 else:
                     self.args = msg.args
-                self.tags = msg.tags.copy()
+                if msg._tags:
+                    self._tags = msg._tags.copy()
             else:
                 self.prefix = prefix
                 self.command = command
                 assert all(ircutils.isValidArgument, args)
                 self.args = args
-        self.args = tuple(self.args)
-        if isUserHostmask(self.prefix):
-            (self.nick,self.user,self.host)=ircutils.splitHostmask(self.prefix)
+            self.args = tuple(self.args)
+
+    def _splitPrefix(self):
+        prefix = self.prefix
+        if isUserHostmask(prefix):
+            # This is ircutils.splitHostmask, minus its redundant assert.
+            (nick, rest) = prefix.split('!', 1)
+            (user, host) = rest.split('@', 1)
+            (self.nick, self.user, self.host) = \
+                    (intern(nick), intern(user), intern(host))
         else:
-            (self.nick, self.user, self.host) = (self.prefix,)*3
+            (self.nick, self.user, self.host) = (prefix,)*3
+
+    def _getTags(self):
+        if self._tags is None:
+            self._tags = {}
+        return self._tags
+
+    def _setTags(self, tags):
+        self._tags = tags
+
+    tags = property(_getTags, _setTags)
 
     def __str__(self):
         if self._str is not None:
@@ -197,11 +220,18 @@ class IrcMsg(object):
         self.tags[tag] = value
 
     def tagged(self, tag):
-        return self.tags.get(tag) # Returns None if it's not there.
+        if self._tags is None:
+            return None
+        return self._tags.get(tag) # Returns None if it's not there.
 
     def __getattr__(self, attr):
+        if attr in _prefixAttrs:
+            self._splitPrefix()
+            return getattr(self, attr)
         return self.tagged(attr)
 
+_prefixAttrs = frozenset(['nick', 'user', 'host'])
+
 
 def isCtcp(msg):
     """Returns whether or not msg is a CTCP message."""
@@ -37,6 +37,7 @@ work in an IRC-case-insensitive fashion), and numerous other things.
 
 import re
 import time
+import bisect
 import random
 import string
 import textwrap
@@ -92,15 +93,52 @@ def joinHostmask(nick, ident, host):
 
 _rfc1459trans = string.maketrans(string.ascii_uppercase + r'\[]~',
                                  string.ascii_lowercase + r'|{}^')
+_strictRfc1459trans = string.maketrans(string.ascii_uppercase + r'\[]',
+                                       string.ascii_lowercase + r'|{}')
+def _lowerer(table):
+    def lower(s):
+        if s is not None:
+            if table is None:
+                s = s.lower()
+            else:
+                s = s.translate(table)
+            if type(s) is str:
+                # So the keys of every IrcDict share the same strings.
+                s = intern(s)
+        return s
+    return lower
+
+class _LowerCache(utils.structures.MemoDict):
+    def __missing__(self, s):
+        # IrcStrings compare according to their own casemapping, so they'd
+        # make lookups of plain strings go wrong; we don't keep them.
+        if type(s) is not str and type(s) is not unicode:
+            return self.f(s)
+        return utils.structures.MemoDict.__missing__(self, s)
+
+# Maps each casemapping to a dictionary of strings to their lowered form, so
+# each string is only lowered once.
+_lowerCaches = {
+    'rfc1459': _LowerCache(_lowerer(_rfc1459trans)),
+    'strict-rfc1459': _LowerCache(_lowerer(_strictRfc1459trans)),
+    'ascii': _LowerCache(_lowerer(None)), # freenode
+    }
+_lowerCaches[None] = _rfc1459Lowered = _lowerCaches['rfc1459']
+
+def lowerCache(casemapping=None):
+    """Returns the dictionary mapping strings to their lowered form according
+    to casemapping.  Its __getitem__ is the same as toLower, but faster."""
+    try:
+        return _lowerCaches[casemapping]
+    except KeyError:
+        raise ValueError, 'Invalid casemapping: %r' % casemapping
+
 def toLower(s, casemapping=None):
     """s => s
     Returns the string s lowered according to IRC case rules."""
-    if casemapping is None or casemapping == 'rfc1459':
-        return s.translate(_rfc1459trans)
-    elif casemapping == 'ascii': # freenode
-        return s.lower()
-    else:
-        raise ValueError, 'Invalid casemapping: %r' % casemapping
+    if casemapping is None:
+        return _rfc1459Lowered[s]
+    return lowerCache(casemapping)[s]
 
 def strEqual(nick1, nick2):
     """s1, s2 => bool
@@ -176,6 +214,130 @@ def hostmaskPatternEqual(pattern, hostmask):
         _hostmaskPatternEqualCache[(pattern, hostmask)] = b
         return b
 
+class HostmaskIndex(object):
+    """Indexes (pattern, value) pairs by hostmask pattern, so the patterns
+    matching a hostmask can be found without trying each of them.
+
+    Patterns without wildcards are kept in a dictionary keyed by their
+    IRC-lowercased form.  Wildcard patterns are bucketed by the longer of the
+    literal text before their first wildcard and after their last one; only
+    the buckets for the prefixes and suffixes of a hostmask (of lengths we
+    actually have) need to be checked.  The few patterns with neither are
+    checked one by one.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.exact = {}
+        self.prefixes = {}
+        self.suffixes = {}
+        self.prefixLengths = {}
+        self.suffixLengths = {}
+        self.others = set()
+        # Sorted lists of (key, pattern, value), keyed by the lowercased
+        # pattern and by its reverse, for matchedBy.
+        self.forwards = []
+        self.backwards = []
+
+    def __len__(self):
+        return len(self.forwards)
+
+    def _bucket(self, lowered):
+        wildcards = [i for (i, c) in enumerate(lowered) if c in '*?']
+        if not wildcards:
+            return (self.exact, None, lowered)
+        prefix = lowered[:wildcards[0]]
+        suffix = lowered[wildcards[-1]+1:]
+        if suffix and len(suffix) >= len(prefix):
+            return (self.suffixes, self.suffixLengths, suffix)
+        elif prefix:
+            return (self.prefixes, self.prefixLengths, prefix)
+        else:
+            return (None, None, None)
+
+    def add(self, pattern, value):
+        """Adds the given pattern, mapping to value, to the index."""
+        lowered = toLower(pattern)
+        entry = (pattern, value)
+        (buckets, lengths, key) = self._bucket(lowered)
+        if buckets is None:
+            if entry in self.others:
+                return
+            self.others.add(entry)
+        else:
+            bucket = buckets.setdefault(key, set())
+            if entry in bucket:
+                return
+            bucket.add(entry)
+            if lengths is not None:
+                lengths[len(key)] = lengths.get(len(key), 0) + 1
+        bisect.insort(self.forwards, (lowered, pattern, value))
+        bisect.insort(self.backwards, (lowered[::-1], pattern, value))
+
+    def remove(self, pattern, value):
+        """Removes the given pattern, mapping to value, from the index.
+
+        Raises KeyError if it isn't in the index."""
+        lowered = toLower(pattern)
+        entry = (pattern, value)
+        (buckets, lengths, key) = self._bucket(lowered)
+        if buckets is None:
+            self.others.remove(entry)
+        else:
+            bucket = buckets[key]
+            bucket.remove(entry)
+            if not bucket:
+                del buckets[key]
+            if lengths is not None:
+                n = len(key)
+                lengths[n] -= 1
+                if not lengths[n]:
+                    del lengths[n]
+        for (L, key) in ((self.forwards, lowered),
+                         (self.backwards, lowered[::-1])):
+            del L[bisect.bisect_left(L, (key, pattern, value))]
+
+    def match(self, hostmask):
+        """Returns the list of (pattern, value) pairs whose pattern matches
+        hostmask."""
+        lowered = toLower(hostmask)
+        L = list(self.exact.get(lowered, ()))
+        candidates = []
+        for n in self.prefixLengths:
+            candidates.extend(self.prefixes.get(lowered[:n], ()))
+        for n in self.suffixLengths:
+            candidates.extend(self.suffixes.get(lowered[-n:], ()))
+        candidates.extend(self.others)
+        for entry in candidates:
+            if hostmaskPatternEqual(entry[0], hostmask):
+                L.append(entry)
+        return L
+
+    def matchedBy(self, pattern):
+        """Returns the list of (pattern, value) pairs whose pattern, taken as
+        a hostmask, is matched by the given pattern."""
+        lowered = toLower(pattern)
+        wildcards = [i for (i, c) in enumerate(lowered) if c in '*?']
+        if not wildcards:
+            prefix = lowered
+            suffix = ''
+        else:
+            prefix = lowered[:wildcards[0]]
+            suffix = lowered[wildcards[-1]+1:]
+        if suffix and len(suffix) >= len(prefix):
+            (L, key) = (self.backwards, suffix[::-1])
+        else:
+            (L, key) = (self.forwards, prefix)
+        ret = []
+        for i in xrange(bisect.bisect_left(L, (key,)), len(L)):
+            (k, other, value) = L[i]
+            if not k.startswith(key):
+                break
+            if hostmaskPatternEqual(pattern, other):
+                ret.append((other, value))
+        return ret
+
 def banmask(hostmask):
     """Returns a properly generic banning hostmask for a hostmask.
 
@@ -487,14 +649,19 @@ def unDccIP(i):
 
 class IrcString(str):
     """This class does case-insensitive comparison and hashing of nicks."""
-    def __new__(cls, s=''):
+    casemapping = None
+    def __new__(cls, s='', casemapping=None):
         x = super(IrcString, cls).__new__(cls, s)
-        x.lowered = toLower(x)
+        x.lowered = toLower(str.__str__(x), casemapping)
+        if casemapping is not None:
+            x.casemapping = casemapping
         return x
 
     def __eq__(self, s):
+        if isinstance(s, IrcString):
+            return s.lowered == self.lowered
         try:
-            return toLower(s) == self.lowered
+            return toLower(s, self.casemapping) == self.lowered
         except:
             return False
 
@@ -505,12 +672,40 @@ class IrcString(str):
         return hash(self.lowered)
 
 
+def _plain(s):
+    # An IrcString would be looked up according to its own casemapping.
+    if isinstance(s, IrcString):
+        s = str.__str__(s)
+    return s
+
+# Maps each casemapping to a dictionary of strings to their IrcString, so
+# the IrcSets using it share a single IrcString for each nick.
+_ircStrings = dict([(casemapping, utils.structures.MemoDict(
+                        lambda s, casemapping=casemapping:
+                            IrcString(s, casemapping)))
+                    for casemapping in _lowerCaches])
+
 class IrcDict(utils.InsensitivePreservingDict):
-    """Subclass of dict to make key comparison IRC-case insensitive."""
-    def key(self, s):
-        if s is not None:
-            s = toLower(s)
-        return s
+    """Subclass of dict to make key comparison IRC-case insensitive.  The keys
+    are compared according to casemapping (rfc1459 by default), which can be
+    changed with setCasemapping."""
+    casemapping = None
+    key = _lowerCaches[None].__getitem__
+    def __init__(self, dict=None, casemapping=None):
+        if casemapping is not None:
+            self.key = lowerCache(casemapping).__getitem__
+            self.casemapping = casemapping
+        super(IrcDict, self).__init__(dict)
+
+    def setCasemapping(self, casemapping):
+        self.key = lowerCache(casemapping).__getitem__
+        self.casemapping = casemapping
+        self.data = dict([(self.key(_plain(k)), (k, v))
+                          for (k, v) in self.data.itervalues()])
+        self._shared = False
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self.data.values()), self.casemapping))
 
 class CallableValueIrcDict(IrcDict):
     def __getitem__(self, k):
@@ -521,11 +716,27 @@ class CallableValueIrcDict(IrcDict):
 
 class IrcSet(utils.NormalizingSet):
     """A sets.Set using IrcStrings instead of regular strings."""
+    casemapping = None
+    strings = _ircStrings[None]
+    def __init__(self, iterable=(), casemapping=None):
+        if casemapping is not None:
+            lowerCache(casemapping) # Raises ValueError if it's invalid.
+            self.strings = _ircStrings[casemapping]
+            self.casemapping = casemapping
+        super(IrcSet, self).__init__(iterable)
+
     def normalize(self, s):
-        return IrcString(s)
+        if type(s) is str:
+            return self.strings[s]
+        return IrcString(s, self.casemapping)
+
+    def copy(self):
+        s = self.__class__(casemapping=self.casemapping)
+        s.update(self) # Our elements are normalized already.
+        return s
 
     def __reduce__(self):
-        return (self.__class__, (list(self),))
+        return (self.__class__, (list(self), self.casemapping))
 
 
 class FloodQueue(object):
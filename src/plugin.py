@@ -34,7 +34,7 @@ import os.path
 import linecache
 import re
 
-from . import callbacks, conf, log, registry
+from . import callbacks, commands, conf, log, registry
 
 installDir = os.path.dirname(sys.modules[__name__].__file__)
 _pluginsDir = os.path.join(installDir, 'plugins')
@@ -75,6 +75,9 @@ def loadPluginModule(name, ignoreDeprecation=False):
     if module.__name__ in sys.modules:
         sys.modules[module.__name__] = module
     linecache.checkcache()
+    # The commands' worker processes were forked before this module was
+    # loaded, so they only have its old version, if any.
+    commands.pool.recycle()
     return module
 
 def loadPluginClass(irc, module, register=None):
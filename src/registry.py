@@ -61,6 +61,14 @@ class NonExistentRegistryEntry(RegistryException):
 
 _cache = utils.InsensitivePreservingDict()
 _lastModified = 0
+# Incremented whenever a node is registered, unregistered, or has its value
+# set, so anything caching lookups into the registry knows to drop them.
+generation = 0
+def changed():
+    """Marks the registry as changed, invalidating cached lookups."""
+    global generation
+    generation += 1
+
 def open(filename, clear=False):
     """Initializes the module by loading the registry file into memory."""
     global _lastModified
@@ -94,15 +102,49 @@ def open(filename, clear=False):
             raise InvalidRegistryFile, 'Error unpacking line %r' % acc
         _cache[key] = value
     _lastModified = time.time()
+    changed()
     _fd.close()
 
-def close(registry, filename, private=True):
-    first = True
-    fd = utils.file.AtomicFile(filename)
+def snapshot(registry, private=True):
+    """Returns a list of (name, help, default, value) tuples, the strings
+    writeSnapshot needs to write the registry to a file.  Any of help,
+    default, and value may be None, if it's not to be written."""
+    L = []
     for (name, value) in registry.getValues(getChildren=True):
-        help = value.help()
-        if help:
-            lines = textwrap.wrap(value._help)
+        help = default = s = None
+        if value.help():
+            help = value._help
+            if hasattr(value, 'value') and value._showDefault:
+                try:
+                    x = value.__class__(value._default, value._help)
+                except Exception, e:
+                    exception('Exception instantiating default for %s:' %
+                              value._name)
+                try:
+                    default = str(x)
+                except Exception, e:
+                    exception('Exception printing default value of %s:' %
+                              value._name)
+        if hasattr(value, 'value'): # This lets us print help for non-values.
+            try:
+                if private or not value._private:
+                    s = value.serialize()
+                else:
+                    s = 'CENSORED'
+            except Exception, e:
+                exception('Exception printing value:')
+        L.append((name, help, default, s))
+    return L
+
+def writeSnapshot(items, filename):
+    """Writes a registry, as returned by snapshot, to filename.  Unlike
+    snapshot, this doesn't touch the registry itself, so it can be done in
+    another thread."""
+    first = True
+    fd = utils.file.AtomicFile(filename, fsync=True)
+    for (name, help, default, s) in items:
+        if help is not None:
+            lines = textwrap.wrap(help)
             for (i, line) in enumerate(lines):
                 lines[i] = '# %s\n' % line
             lines.insert(0, '###\n')
@@ -110,32 +152,18 @@ def close(registry, filename, private=True):
                 first = False
             else:
                 lines.insert(0, '\n')
-            if hasattr(value, 'value'):
-                if value._showDefault:
-                    lines.append('#\n')
-                    try:
-                        x = value.__class__(value._default, value._help)
-                    except Exception, e:
-                        exception('Exception instantiating default for %s:' %
-                                  value._name)
-                    try:
-                        lines.append('# Default value: %s\n' % x)
-                    except Exception, e:
-                        exception('Exception printing default value of %s:' %
-                                  value._name)
+            if default is not None:
+                lines.append('#\n')
+                lines.append('# Default value: %s\n' % default)
             lines.append('###\n')
             fd.writelines(lines)
-        if hasattr(value, 'value'): # This lets us print help for non-values.
-            try:
-                if private or not value._private:
-                    s = value.serialize()
-                else:
-                    s = 'CENSORED'
-                fd.write('%s: %s\n' % (name, s))
-            except Exception, e:
-                exception('Exception printing value:')
+        if s is not None:
+            fd.write('%s: %s\n' % (name, s))
     fd.close()
 
+def close(registry, filename, private=True):
+    writeSnapshot(snapshot(registry, private), filename)
+
 def isValidRegistryName(name):
     # Now we can have . and : in names.  I'm still gonna call shenanigans on
     # anyone who tries to have spaces (though technically I can't see any
@@ -246,6 +274,7 @@ class Group(object):
         # For the longest time, we had an "Is this right?" comment here, but
         # from experience, we now know that it most definitely *is* right.
         if name not in self._children:
+            changed()
             self._children[name] = node
             self._added.append(name)
             names = split(self._name)
@@ -263,6 +292,7 @@ class Group(object):
         try:
             node = self._children[name]
             del self._children[name]
+            changed()
             # We do this because we need to remove case-insensitively.
             name = name.lower()
             for elt in reversed(self._added):
@@ -337,6 +367,7 @@ class Value(Group):
         own setValue."""
         self._lastModified = time.time()
         self.value = v
+        changed()
         if self._supplyDefault:
             for (name, v) in self._children.items():
                 if v.__class__ is self.X:
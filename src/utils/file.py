@@ -123,8 +123,10 @@ class AtomicFile(file):
         backupDir = None
         makeBackupIfSmaller = True
         allowEmptyOverwrite = True
+        fsync = False
     def __init__(self, filename, mode='w', allowEmptyOverwrite=None,
-                 makeBackupIfSmaller=None, tmpDir=None, backupDir=None):
+                 makeBackupIfSmaller=None, tmpDir=None, backupDir=None,
+                 fsync=None):
         if tmpDir is None:
             tmpDir = force(self.default.tmpDir)
         if backupDir is None:
@@ -133,11 +135,14 @@ class AtomicFile(file):
             makeBackupIfSmaller = force(self.default.makeBackupIfSmaller)
         if allowEmptyOverwrite is None:
             allowEmptyOverwrite = force(self.default.allowEmptyOverwrite)
+        if fsync is None:
+            fsync = force(self.default.fsync)
         if mode not in ('w', 'wb'):
             raise ValueError, format('Invalid mode: %q', mode)
         self.rolledback = False
         self.allowEmptyOverwrite = allowEmptyOverwrite
         self.makeBackupIfSmaller = makeBackupIfSmaller
+        self.fsync = fsync
         self.filename = filename
         self.backupDir = backupDir
         if tmpDir is None:
@@ -162,6 +167,11 @@ class AtomicFile(file):
 
     def close(self):
         if not self.rolledback:
+            if self.fsync and not self.closed:
+                # Make sure the data is on disk before the rename makes it
+                # the real file.
+                self.flush()
+                os.fsync(self.fileno())
             super(AtomicFile, self).close()
             # We don't mind writing an empty file if the file we're overwriting
             # doesn't exist.
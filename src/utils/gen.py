@@ -41,6 +41,7 @@ import traceback
 from . import crypt
 from .str import format
 from .file import mktemp
+from .structures import MemoDict
 from .iter import imap, all
 
 def abbrev(strings, d=None):
@@ -229,12 +230,17 @@ class IterableMap(object):
         return False
 
 
+def _lower(s):
+    if s is not None:
+        s = s.lower()
+    return s
+
 class InsensitivePreservingDict(UserDict.DictMixin, object):
-    def key(self, s):
-        """Override this if you wish."""
-        if s is not None:
-            s = s.lower()
-        return s
+    # Override this if you wish.  Each key is only lowered once.
+    key = MemoDict(_lower).__getitem__
+    # Whether self.data is shared with a copy, so it has to be copied before
+    # it's changed.
+    _shared = False
 
     def __init__(self, dict=None, key=None):
         if key is not None:
@@ -258,19 +264,46 @@ class InsensitivePreservingDict(UserDict.DictMixin, object):
         return self.data[self.key(k)][1]
 
     def __setitem__(self, k, v):
+        if self._shared:
+            self._unshare()
         self.data[self.key(k)] = (k, v)
 
     def __delitem__(self, k):
+        if self._shared:
+            self._unshare()
         del self.data[self.key(k)]
 
+    def clear(self):
+        self.data = {}
+        self._shared = False
+
+    def copy(self):
+        """Returns a copy of the dictionary.  The copy and the original share
+        their data until either of them is changed, so this is O(1)."""
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new._shared = self._shared = True
+        return new
+
+    def _unshare(self):
+        self.data = self.data.copy()
+        self._shared = False
+
+    def __contains__(self, k):
+        return self.key(k) in self.data
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self.data)
+
     def iteritems(self):
         return self.data.itervalues()
 
     def keys(self):
-        L = []
-        for (k, _) in self.iteritems():
-            L.append(k)
-        return L
+        return [k for (k, _) in self.data.itervalues()]
+
+    def __iter__(self):
+        return iter(self.keys())
 
     def __reduce__(self):
         return (self.__class__, (dict(self.data.values()),))
@@ -164,9 +164,25 @@ def perlReToPythonRe(s):
     except re.error, e:
         raise ValueError, str(e)
 
+class PerlReplacer(object):
+    """A callable doing the replacement of a Perl-style s/// regexp.  Unlike
+    a closure, it can be pickled and sent to another process."""
+    def __init__(self, regexp, replace, count=0):
+        self.regexp = regexp
+        self.replace = replace
+        self.count = count
+
+    def __call__(self, s):
+        return self.regexp.sub(self.replace, s, self.count)
+
+    def __repr__(self):
+        return '%s(%r, %r, %r)' % (self.__class__.__name__,
+                                   self.regexp.pattern,
+                                   self.replace, self.count)
+
 def perlReToReplacer(s):
     """Converts a string representation of a Perl regular expression (i.e.,
-    s/foo/bar/g or s/foo/bar/i) to a Python function doing the equivalent
+    s/foo/bar/g or s/foo/bar/i) to a PerlReplacer doing the equivalent
     replacement.
     """
     sep = _getSep(s)
@@ -187,9 +203,9 @@ def perlReToReplacer(s):
         flags = filter('g'.__ne__, flags)
     r = perlReToPythonRe(sep.join(('', regexp, flags)))
     if g:
-        return curry(r.sub, replace)
+        return PerlReplacer(r, replace)
     else:
-        return lambda s: r.sub(replace, s, 1)
+        return PerlReplacer(r, replace, 1)
 
 _perlVarSubstituteRe = re.compile(r'\$\{([^}]+)\}|\$([a-zA-Z][a-zA-Z0-9]*)')
 def perlVariableSubstitute(vars, text):
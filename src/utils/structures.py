@@ -33,6 +33,7 @@ Data structures for Python.
 
 import time
 import types
+import threading
 import UserDict
 from itertools import imap
 
@@ -147,6 +148,12 @@ class RingBuffer(object):
     def __repr__(self):
         return 'RingBuffer(%r, %r)' % (self.maxSize, list(self))
 
+    def copy(self):
+        """Returns a shallow copy of the RingBuffer."""
+        new = self.__class__.__new__(self.__class__)
+        new.__setstate__((self.maxSize, self.full, self.i, self.L[:]))
+        return new
+
     def __getstate__(self):
         return (self.maxSize, self.full, self.i, self.L)
 
@@ -419,29 +426,137 @@ class MultiSet(object):
 
 
 class CacheDict(UserDict.DictMixin):
+    """A dictionary holding at most max items, evicting the least recently
+    used item to make room for new ones.
+
+    The items are kept in a circular doubly-linked list, most recently used
+    last, so lookups, insertions, and evictions are all O(1).  The hits,
+    misses, and evictions attributes count what they say."""
     def __init__(self, max, **kwargs):
-        self.d = dict(**kwargs)
         self.max = max
+        # Maps keys to their links, which are [prev, next, key, value] lists.
+        # self.root is the sentinel link of the list.
+        self.d = {}
+        self.lock = threading.Lock()
+        self.root = []
+        self.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        for (key, value) in kwargs.iteritems():
+            self[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.d.clear()
+            self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.d)
+
+    def __contains__(self, key):
+        return key in self.d
+
+    has_key = __contains__
 
     def __getitem__(self, key):
-        return self.d[key]
+        with self.lock:
+            try:
+                link = self.d[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            # Move the link to the end of the list.
+            (prev, next) = (link[0], link[1])
+            prev[1] = next
+            next[0] = prev
+            last = self.root[0]
+            last[1] = self.root[0] = link
+            link[0] = last
+            link[1] = self.root
+            return link[3]
 
     def __setitem__(self, key, value):
-        if len(self.d) >= self.max:
-            self.d.clear()
-        self.d[key] = value
+        with self.lock:
+            link = self.d.get(key)
+            if link is not None:
+                link[3] = value
+                (prev, next) = (link[0], link[1])
+                prev[1] = next
+                next[0] = prev
+            else:
+                if len(self.d) >= self.max:
+                    # Evict the least recently used, at the front.
+                    oldest = self.root[1]
+                    self.root[1] = oldest[1]
+                    oldest[1][0] = self.root
+                    del self.d[oldest[2]]
+                    self.evictions += 1
+                link = [None, None, key, value]
+                self.d[key] = link
+            last = self.root[0]
+            last[1] = self.root[0] = link
+            link[0] = last
+            link[1] = self.root
 
     def __delitem__(self, key):
-        del self.d[key]
+        with self.lock:
+            (prev, next, _, _) = self.d.pop(key)
+            prev[1] = next
+            next[0] = prev
+
+    def stats(self):
+        """Returns a string describing the size and hit rate of the cache."""
+        total = self.hits + self.misses
+        if total:
+            rate = '%.1f%%' % (100.0 * self.hits / total)
+        else:
+            rate = 'n/a'
+        return '%s/%s items, %s hits, %s misses (%s hit rate), ' \
+               '%s evictions' % (len(self), self.max, self.hits, self.misses,
+                                 rate, self.evictions)
 
     def keys(self):
         return self.d.keys()
-    
+
     def iteritems(self):
-        return self.d.iteritems()
+        for (key, link) in self.d.items():
+            yield (key, link[3])
 
     def __iter__(self):
-        return iter(self.d)
+        return iter(self.d.keys())
+
+
+class MemoDict(dict):
+    """A dictionary mapping each key to f(key), which is only called the first
+    time the key is looked up.
+
+    Looking up a key that's already there never leaves C, which makes the
+    __getitem__ of a MemoDict a cheap key function.  Once it holds max items,
+    they're moved aside (dropping those moved aside the time before), and the
+    ones looked up again are moved back instead of being recomputed.  So it
+    holds at most twice max items, and only those that have gone unused for a
+    while are dropped."""
+    def __init__(self, f, max=100000):
+        self.f = f
+        self.max = max
+        self.old = {}
+
+    def __missing__(self, key):
+        try:
+            value = self.old.pop(key)
+        except KeyError:
+            value = self.f(key)
+        if len(self) >= self.max:
+            self.old = dict(self)
+            dict.clear(self)
+        self[key] = value
+        return value
+
+    def clear(self):
+        dict.clear(self)
+        self.old.clear()
 
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
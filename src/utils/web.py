@@ -28,9 +28,14 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
+import os
 import re
+import time
 import base64
 import socket
+import hashlib
+import threading
+import cPickle as pickle
 import urllib
 import urllib2
 import httplib
@@ -45,6 +50,7 @@ except AttributeError:
     pass
 
 from .str import normalizeWhitespace
+from .structures import CacheDict
 
 Request = urllib2.Request
 urlquote = urllib.quote
@@ -98,14 +104,404 @@ defaultHeaders = {
 # application-specific function.  Feel free to use a callable here.
 proxy = None
 
+maxRedirects = 5
+
+class ConnectionPool(object):
+    """Keeps idle HTTP(S) connections around, per host, so later requests to
+    the same host don't need a new TCP (and TLS) handshake."""
+    def __init__(self, maxIdle=4, idleTimeout=30):
+        self.maxIdle = maxIdle
+        self.idleTimeout = idleTimeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, host, timeout=None):
+        """Returns a (connection, reused) pair for the given host."""
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        now = time.time()
+        conn = None
+        self.lock.acquire()
+        try:
+            L = self.idle.get((scheme, host), [])
+            while L and conn is None:
+                (conn, since) = L.pop()
+                if now - since > self.idleTimeout:
+                    conn.close()
+                    conn = None
+        finally:
+            self.lock.release()
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return (conn, True)
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=timeout)
+        return (conn, False)
+
+    def put(self, scheme, host, conn):
+        """Gives back a connection whose response has been read entirely."""
+        self.lock.acquire()
+        try:
+            L = self.idle.setdefault((scheme, host), [])
+            if len(L) < self.maxIdle:
+                L.append((conn, time.time()))
+                conn = None
+        finally:
+            self.lock.release()
+        if conn is not None:
+            conn.close()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            for L in self.idle.itervalues():
+                for (conn, since) in L:
+                    conn.close()
+            self.idle.clear()
+        finally:
+            self.lock.release()
+
+connections = ConnectionPool()
+
+class HttpResponse(object):
+    """A file-like object reading the body of an HTTP response.  Its
+    connection goes back to the pool when it's closed, if the body has been
+    read entirely."""
+    def __init__(self, url, response, scheme, host, conn):
+        self.url = url
+        self.response = response
+        self.scheme = scheme
+        self.host = host
+        self.conn = conn
+        self.code = response.status
+        self.headers = response.msg
+        self.buffer = ''
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            (s, self.buffer) = (self.buffer + self.response.read(), '')
+            return s
+        if len(self.buffer) < size:
+            self.buffer += self.response.read(size - len(self.buffer))
+        (s, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return s
+
+    def readline(self):
+        while '\n' not in self.buffer:
+            s = self.response.read(1024)
+            if not s:
+                break
+            self.buffer += s
+        i = self.buffer.find('\n') + 1 or len(self.buffer)
+        (s, self.buffer) = (self.buffer[:i], self.buffer[i:])
+        return s
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def isComplete(self):
+        """Returns whether the whole body has been read from the server."""
+        return self.response.isclosed()
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            connections.put(self.scheme, self.host, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+def _send(scheme, host, method, selector, data, headers, timeout):
+    (conn, reused) = connections.get(scheme, host, timeout)
+    try:
+        conn.request(method, selector, data, headers)
+        return (conn, conn.getresponse())
+    except socket.timeout:
+        conn.close()
+        raise
+    except (httplib.HTTPException, socket.error):
+        conn.close()
+        if not reused or data is not None:
+            raise
+    # The server closed the idle connection in the meantime; try again on a
+    # new one.
+    (conn, reused) = connections.get(scheme, host, timeout)
+    try:
+        conn.request(method, selector, data, headers)
+        return (conn, conn.getresponse())
+    except:
+        conn.close()
+        raise
+
+def _open(url, headers, data, timeout):
+    for _ in xrange(maxRedirects + 1):
+        (scheme, loc, path, query, frag) = urlparse.urlsplit(url)
+        (user, host) = urllib.splituser(loc)
+        if not host:
+            raise httplib.InvalidURL, url
+        h = dict(headers)
+        if user:
+            h['Authorization'] = 'Basic %s' % base64.b64encode(user)
+        if data is None:
+            method = 'GET'
+        else:
+            method = 'POST'
+            h.setdefault('Content-type', 'application/x-www-form-urlencoded')
+        selector = urlparse.urlunsplit(('', '', path or '/', query, ''))
+        (conn, response) = _send(scheme.lower(), host, method, selector,
+                                 data, h, timeout)
+        fd = HttpResponse(url, response, scheme.lower(), host, conn)
+        location = response.getheader('location')
+        if response.status in (301, 302, 303, 307) and location:
+            fd.read()
+            fd.close()
+            url = urlparse.urljoin(url, location)
+            if response.status != 307:
+                data = None
+            continue
+        if response.status >= 400:
+            fd.close()
+            if response.status == 403:
+                raise Error, FORBIDDEN
+            raise Error, 'HTTP Error %s: %s' % (response.status,
+                                                 response.reason)
+        return fd
+    raise Error, 'Too many redirects.'
+
+def _pooled(url):
+    """Returns whether we can handle url ourselves, with pooled connections,
+    rather than going through urllib2."""
+    if isinstance(url, urllib2.Request) or force(proxy):
+        return False
+    return urlparse.urlsplit(url)[0].lower() in ('http', 'https')
+
+class ResponseCache(object):
+    """Caches the bodies of HTTP responses by URL, in memory and (when
+    directory is set) on disk, along with what's needed to revalidate them.
+
+    A body is cached even if only its beginning was read, and used for later
+    requests that don't want more of it than that.  Responses that vary on
+    request headers are only used for requests with the same values of those
+    headers.  Files older than maxAge seconds are thrown away, and the oldest
+    files are when there's more than diskSize bytes of them."""
+    def __init__(self, size=100, maxSize=1024*1024,
+                 diskSize=10*1024*1024, maxAge=7*86400):
+        self.memory = CacheDict(size)
+        self.maxSize = maxSize
+        # Like proxy, these may be callables.
+        self.directory = None
+        self.diskSize = diskSize
+        self.maxAge = maxAge
+        self.diskUsage = None
+        self.lock = threading.Lock()
+
+    def _filename(self, url):
+        directory = force(self.directory)
+        if directory:
+            return os.path.join(directory, hashlib.sha1(url).hexdigest())
+        return None
+
+    _filenameRe = re.compile(r'^[0-9a-f]{40}(\.\d+\.tmp)?$')
+    def _files(self):
+        """Returns the (mtime, size, filename) of each of our files."""
+        directory = force(self.directory)
+        L = []
+        if not directory or not os.path.isdir(directory):
+            return L
+        for name in os.listdir(directory):
+            if self._filenameRe.match(name):
+                filename = os.path.join(directory, name)
+                try:
+                    st = os.stat(filename)
+                except EnvironmentError:
+                    continue
+                L.append((st.st_mtime, st.st_size, filename))
+        return L
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except EnvironmentError:
+            pass
+
+    def prune(self):
+        """Removes the files that are too old, then the oldest files until
+        there's no more than diskSize bytes of them."""
+        self.lock.acquire()
+        try:
+            files = self._files()
+            files.sort()
+            cutoff = time.time() - force(self.maxAge)
+            usage = sum([size for (_, size, _) in files])
+            diskSize = force(self.diskSize)
+            for (mtime, size, filename) in files:
+                if mtime >= cutoff and usage <= diskSize:
+                    break
+                self._remove(filename)
+                usage -= size
+            self.diskUsage = usage
+        finally:
+            self.lock.release()
+
+    def _varying(self, vary, headers):
+        """Returns the values of the request headers named by vary."""
+        headers = dict([(k.lower(), v) for (k, v) in headers.iteritems()])
+        names = [s.strip().lower() for s in vary.split(',') if s.strip()]
+        names.sort()
+        return [(name, headers.get(name)) for name in names]
+
+    def get(self, url, headers=None):
+        """Returns the entry for url, if there's one that fits a request with
+        the given headers (by default, defaultHeaders)."""
+        if headers is None:
+            headers = defaultHeaders
+        entry = self._get(url)
+        if entry is not None and entry.get('vary') and \
+           entry['varying'] != self._varying(entry['vary'], headers):
+            return None
+        return entry
+
+    def _get(self, url):
+        try:
+            return self.memory[url]
+        except KeyError:
+            pass
+        filename = self._filename(url)
+        if filename is None:
+            return None
+        try:
+            if os.path.getmtime(filename) < time.time() - force(self.maxAge):
+                self._remove(filename)
+                return None
+            fd = open(filename, 'rb')
+            try:
+                entry = pickle.load(fd)
+            finally:
+                fd.close()
+        except EnvironmentError:
+            return None
+        except Exception: # Corrupt files can raise just about anything.
+            return None
+        if entry.get('url') != url:
+            return None
+        self.memory[url] = entry
+        return entry
+
+    def store(self, url, headers, body, complete, requestHeaders=None):
+        if requestHeaders is None:
+            requestHeaders = defaultHeaders
+        cacheControl = headers.get('cache-control', '').lower()
+        vary = headers.get('vary', '')
+        if 'no-store' in cacheControl or len(body) > self.maxSize or \
+           vary.strip() == '*':
+            return
+        m = self._maxAgeRe.search(cacheControl)
+        expires = time.time()
+        if m and 'no-cache' not in cacheControl:
+            expires += int(m.group(1))
+        entry = {'url': url, 'body': body, 'complete': complete,
+                 'headers': _contentHeaders(headers),
+                 'etag': headers.get('etag'),
+                 'lastModified': headers.get('last-modified'),
+                 'expires': expires, 'vary': vary,
+                 'varying': self._varying(vary, requestHeaders)}
+        if entry['etag'] or entry['lastModified'] or \
+           entry['expires'] > time.time():
+            self._write(entry)
+    _maxAgeRe = re.compile(r'max-age\s*=\s*(\d+)')
+
+    def refresh(self, entry, headers):
+        """Updates entry after the server says it hasn't changed."""
+        entry = entry.copy()
+        for (key, header) in (('etag', 'etag'),
+                              ('lastModified', 'last-modified')):
+            if headers.get(header):
+                entry[key] = headers.get(header)
+        m = self._maxAgeRe.search(headers.get('cache-control', '').lower())
+        entry['expires'] = time.time()
+        if m:
+            entry['expires'] += int(m.group(1))
+        self._write(entry)
+
+    def _write(self, entry):
+        self.memory[entry['url']] = entry
+        filename = self._filename(entry['url'])
+        if filename is None:
+            return
+        try:
+            try:
+                old = os.path.getsize(filename)
+            except EnvironmentError:
+                old = 0
+            tmp = '%s.%s.tmp' % (filename, threading.currentThread().ident)
+            fd = open(tmp, 'wb')
+            try:
+                pickle.dump(entry, fd, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            size = os.path.getsize(tmp)
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp, filename)
+        except EnvironmentError:
+            return
+        self.lock.acquire()
+        try:
+            if self.diskUsage is not None:
+                self.diskUsage += size - old
+            usage = self.diskUsage
+        finally:
+            self.lock.release()
+        # We don't know how much is on disk until we've looked once.
+        if usage is None or usage > force(self.diskSize):
+            self.prune()
+
+    def clear(self):
+        """Empties the cache, in memory and on disk."""
+        self.memory.clear()
+        self.lock.acquire()
+        try:
+            for (_, _, filename) in self._files():
+                self._remove(filename)
+            self.diskUsage = None
+        finally:
+            self.lock.release()
+
+cache = ResponseCache()
+
 def getUrlFd(url, headers=None, data=None, timeout=None):
-    """getUrlFd(url, headers=None, data=None)
+    """getUrlFd(url, headers=None, data=None, timeout=None)
 
     Opens the given url and returns a file object.  Headers and data are
-    a dict and string, respectively, as per urllib2.Request's arguments."""
+    a dict and string, respectively, as per urllib2.Request's arguments.
+
+    HTTP(S) urls are opened with a connection from the pool when possible;
+    close the file object when done to give it back."""
     if headers is None:
         headers = defaultHeaders
     try:
+        if _pooled(url):
+            return _open(url, headers, data, timeout)
         if not isinstance(url, urllib2.Request):
             (scheme, loc, path, query, frag) = urlparse.urlsplit(url)
             (user, host) = urllib.splituser(loc)
@@ -128,6 +524,8 @@ def getUrlFd(url, headers=None, data=None, timeout=None):
         raise Error, strError(e)
     except httplib.InvalidURL, e:
         raise Error, 'Invalid URL: %s' % e
+    except httplib.HTTPException, e:
+        raise Error, str(e) or e.__class__.__name__
     except urllib2.HTTPError, e:
         raise Error, strError(e)
     except urllib2.URLError, e:
@@ -136,22 +534,75 @@ def getUrlFd(url, headers=None, data=None, timeout=None):
     except ValueError, e:
         raise Error, strError(e)
 
-def getUrl(url, size=None, headers=None, data=None):
-    """getUrl(url, size=None, headers=None, data=None)
+def _contentHeaders(headers):
+    """Returns a dict of the Content-* headers that describe a page (rather
+    than the response it came in), with lowercase names."""
+    d = {}
+    for name in ('content-type', 'content-language', 'content-location'):
+        value = headers.get(name)
+        if value:
+            d[name] = value
+    return d
+
+def getUrl(url, size=None, headers=None, data=None, timeout=None):
+    """getUrl(url, size=None, headers=None, data=None, timeout=None)
 
     Gets a page.  Returns a string that is the page gotten.  Size is an integer
     number of bytes to read from the URL.  Headers and data are dicts as per
-    urllib2.Request's arguments."""
-    fd = getUrlFd(url, headers=headers, data=data)
+    urllib2.Request's arguments.
+
+    Pages gotten by plain GETs with the default headers are cached, and
+    revalidated with the server (using their ETag or Last-Modified headers)
+    when they're gotten again."""
+    return getUrlWithHeaders(url, size, headers, data, timeout)[0]
+
+def getUrlWithHeaders(url, size=None, headers=None, data=None, timeout=None):
+    """getUrlWithHeaders(url, size=None, headers=None, data=None,
+                         timeout=None)
+
+    Like getUrl, but returns a (text, headers) pair, headers being a dict of
+    the Content-Type, Content-Language and Content-Location of the page (those
+    it has), with lowercase names."""
+    entry = None
+    # The cache is keyed by URL only, so a request with its own headers (a
+    # cookie, say) might get a different page.
+    cacheable = data is None and headers is None and _pooled(url)
+    if cacheable:
+        entry = cache.get(url)
+        if entry is not None and not entry['complete'] and \
+           (size is None or len(entry['body']) < size):
+            entry = None
+    if entry is not None:
+        if entry['expires'] > time.time():
+            return (entry['body'][:size], dict(entry.get('headers', {})))
+        headers = dict(headers or defaultHeaders)
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['lastModified']:
+            headers['If-Modified-Since'] = entry['lastModified']
+    fd = getUrlFd(url, headers=headers, data=data, timeout=timeout)
     try:
-        if size is None:
-            text = fd.read()
-        else:
-            text = fd.read(size)
-    except socket.timeout, e:
-        raise Error, TIMED_OUT
-    fd.close()
-    return text
+        if entry is not None and fd.getcode() == 304:
+            fd.read()
+            cache.refresh(entry, fd.headers)
+            return (entry['body'][:size], dict(entry.get('headers', {})))
+        try:
+            if size is None:
+                text = fd.read()
+            else:
+                text = fd.read(size)
+        except socket.timeout, e:
+            raise Error, TIMED_OUT
+        except sockerrors, e:
+            raise Error, strError(e)
+        except httplib.HTTPException, e:
+            raise Error, str(e) or e.__class__.__name__
+        if cacheable and isinstance(fd, HttpResponse) and fd.getcode() == 200:
+            complete = size is None or fd.isComplete() or len(text) < size
+            cache.store(url, fd.headers, text, complete)
+        return (text, _contentHeaders(fd.headers))
+    finally:
+        fd.close()
 
 def getDomain(url):
     return urlparse.urlparse(url)[1]
@@ -35,9 +35,11 @@ import gc
 import os
 import sys
 import time
+import Queue
 import atexit
 import threading
 import multiprocessing
+from collections import deque
 
 if sys.version_info >= (2, 5, 0):
     import re as sre
@@ -64,6 +66,142 @@ class SupyThread(threading.Thread):
         super(SupyThread, self).__init__(*args, **kwargs)
         log.debug('Spawning thread %q.', self.getName())
 
+class ThreadPool(object):
+    """A bounded pool of worker threads, which threaded commands, URL snarfers
+    and the like are queued to instead of spawning a thread each.
+
+    The pool has at most supybot.threads.maximum threads, and runs at most
+    supybot.threads.perGroup tasks of the same group (usually a plugin name)
+    at once.  When supybot.threads.queueSize tasks are already waiting, new
+    tasks are refused.
+    """
+    def __init__(self, maximum=None, perGroup=None, queueSize=None):
+        self.maximum = maximum
+        self.perGroup = perGroup
+        self.queueSize = queueSize
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.running = {}
+        self.threads = 0
+        self.idle = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.waited = 0.0
+        self.maxWaited = 0.0
+        self.ran = 0.0
+
+    def _limit(self, attr):
+        value = getattr(self, attr)
+        if value is None:
+            return getattr(conf.supybot.threads, attr)()
+        return value
+
+    def submit(self, f, args=(), kwargs={}, name=None, group=None):
+        """Queues f(*args, **kwargs) to be run in one of the pool's threads.
+
+        <name> is given to the thread while it runs the task, and <group> is
+        the key the per-group limit applies to.  Returns False, without
+        queuing the task, if too many tasks are already waiting."""
+        global threadsSpawned
+        if name is None:
+            name = getattr(f, '__name__', repr(f))
+        self.cond.acquire()
+        try:
+            if len(self.queue) >= self._limit('queueSize'):
+                self.rejected += 1
+                log.warning('Too many tasks waiting for a thread, '
+                            'not running %s.', name)
+                return False
+            self.queue.append((f, args, kwargs, name, group, time.time()))
+            self.submitted += 1
+            if len(self.queue) > self.idle and \
+               self.threads < self._limit('maximum'):
+                self.threads += 1
+                threadsSpawned += 1
+                t = threading.Thread(target=self._work,
+                                     name='Pool thread #%s' % threadsSpawned)
+                t.setDaemon(True)
+                t.start()
+            self.cond.notifyAll()
+            return True
+        finally:
+            self.cond.release()
+
+    def _take(self):
+        perGroup = self._limit('perGroup')
+        for (i, task) in enumerate(self.queue):
+            group = task[4]
+            if group is None or self.running.get(group, 0) < perGroup:
+                del self.queue[i]
+                if group is not None:
+                    self.running[group] = self.running.get(group, 0) + 1
+                return task
+        return None
+
+    def _run(self, task):
+        (f, args, kwargs, name, group, queuedAt) = task
+        thread = threading.currentThread()
+        poolName = thread.getName()
+        thread.setName(name)
+        started = time.time()
+        try:
+            f(*args, **kwargs)
+        except Exception:
+            log.exception('Uncaught exception in %s:', name)
+        thread.setName(poolName)
+        return (started - queuedAt, time.time() - started)
+
+    def _work(self):
+        self.cond.acquire()
+        try:
+            while True:
+                task = self._take()
+                if task is None:
+                    if self.threads > self._limit('maximum'):
+                        break
+                    self.idle += 1
+                    self.cond.wait()
+                    self.idle -= 1
+                    continue
+                self.cond.release()
+                try:
+                    (waited, ran) = self._run(task)
+                finally:
+                    self.cond.acquire()
+                group = task[4]
+                if group is not None:
+                    self.running[group] -= 1
+                    if not self.running[group]:
+                        del self.running[group]
+                self.completed += 1
+                self.waited += waited
+                self.maxWaited = max(self.maxWaited, waited)
+                self.ran += ran
+                self.cond.notifyAll()
+        finally:
+            self.threads -= 1
+            self.cond.release()
+
+    def stats(self):
+        """Returns a string describing the pool's load and timings."""
+        self.cond.acquire()
+        try:
+            if self.completed:
+                wait = '%.3fs' % (self.waited / self.completed)
+                run = '%.3fs' % (self.ran / self.completed)
+            else:
+                wait = run = 'n/a'
+            return '%s threads (%s idle), %s queued, %s submitted, ' \
+                   '%s completed, %s rejected, %s average wait ' \
+                   '(%.3fs max), %s average run' % \
+                   (self.threads, self.idle, len(self.queue), self.submitted,
+                    self.completed, self.rejected, wait, self.maxWaited, run)
+        finally:
+            self.cond.release()
+
+threads = ThreadPool()
+
 processesSpawned = 1 # Starts at one for the initial process.
 class SupyProcess(multiprocessing.Process):
     def __init__(self, *args, **kwargs):
@@ -87,19 +225,166 @@ def getIrc(network):
 def _flushUserData():
     userdataFilename = os.path.join(conf.supybot.directories.conf(),
                                     'userdata.conf')
-    registry.close(conf.users, userdataFilename)
+    items = registry.snapshot(conf.users)
+    return lambda: registry.writeSnapshot(items, userdataFilename)
 
-flushers = [_flushUserData] # A periodic function will flush all these.
+# A periodic function will flush all these.  Flushers are called in the main
+# thread; a flusher may return a callable rather than writing its data itself,
+# in which case it should cheaply copy what it needs to write, and the
+# callable will be run by the flushWriter thread to do the writing.
+flushers = [_flushUserData]
 
 registryFilename = None
 
+class FlushTimes(object):
+    """Keeps track of how long each flusher takes, both in the main thread and
+    in the flushWriter, so slow flushers can be found."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+
+    def record(self, name, flushed=None, written=0.0):
+        self.lock.acquire()
+        try:
+            if name not in self.times:
+                # runs, total flush, max flush, total write, max write.
+                self.times[name] = [0, 0.0, 0.0, 0.0, 0.0]
+            L = self.times[name]
+            if flushed is not None:
+                L[0] += 1
+                L[1] += flushed
+                L[2] = max(L[2], flushed)
+            L[3] += written
+            L[4] = max(L[4], written)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.times.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Returns a string describing the time taken by each flusher, the
+        flushers blocking the main thread the longest first."""
+        self.lock.acquire()
+        try:
+            L = sorted(self.times.iteritems(), key=lambda t: -t[1][2])
+            return '; '.join(['%s: %s runs, %.3fs max (%.3fs average), '
+                              '%.3fs max writing' %
+                              (name, runs, maxFlush, flush / (runs or 1),
+                               maxWrite)
+                              for (name, (runs, flush, maxFlush, write,
+                                          maxWrite)) in L]) or 'n/a'
+        finally:
+            self.lock.release()
+
+flushTimes = FlushTimes()
+
+class FlushWriter(object):
+    """Runs the callables returned by flushers in a thread of its own.
+
+    The callables are run one at a time, in the order they were given, so the
+    writes of one flusher can never overtake one another.
+    """
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, name, f):
+        self.lock.acquire()
+        try:
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = SupyThread(target=self._run,
+                                         name='Flush writer')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        self.queue.put((name, f))
+
+    def wait(self):
+        """Waits for all the writes submitted so far to be done."""
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            (name, f) = self.queue.get()
+            start = time.time()
+            try:
+                try:
+                    f()
+                except Exception, e:
+                    log.exception('Uncaught exception writing for flusher '
+                                  '%s:', name)
+            finally:
+                elapsed = time.time() - start
+                flushTimes.record(name, written=elapsed)
+                log.debug('Flusher %s took %.3fs writing.', name, elapsed)
+                self.queue.task_done()
+
+flushWriter = FlushWriter()
+
+def flusherName(f):
+    """Returns a name for the flusher f, for use in logs and statistics."""
+    name = getattr(f, '__name__', None) or repr(f)
+    obj = getattr(f, 'im_self', None)
+    if obj is not None:
+        name = '%s.%s' % (obj.__class__.__name__, name)
+        filename = getattr(obj, 'filename', None)
+        if isinstance(filename, basestring):
+            name = '%s (%s)' % (name, os.path.basename(filename))
+    return name
+
+def runFlusher(f):
+    """Runs the flusher f, timing it and handing whatever it returns to the
+    flushWriter."""
+    name = flusherName(f)
+    start = time.time()
+    try:
+        write = f()
+    except Exception, e:
+        log.exception('Uncaught exception in flusher %s:', name)
+        write = None
+    elapsed = time.time() - start
+    flushTimes.record(name, flushed=elapsed)
+    log.debug('Flusher %s took %.3fs.', name, elapsed)
+    if callable(write):
+        flushWriter.submit(name, write)
+
 def flush():
-    """Flushes all the registered flushers."""
-    for (i, f) in enumerate(flushers):
+    """Flushes all the registered flushers, and waits for their data to be
+    written."""
+    for f in flushers[:]:
+        runFlusher(f)
+    flushWriter.wait()
+
+_scheduledFlushes = []
+def scheduleFlushes(interval=None):
+    """Schedules the registered flushers to run one by one, spread over the
+    next interval seconds (supybot.upkeepInterval, by default), rather than
+    all at once."""
+    from . import schedule # schedule imports us.
+    if interval is None:
+        interval = conf.supybot.upkeepInterval()
+    # Any flushers left over from the last time will be run with these.
+    while _scheduledFlushes:
         try:
-            f()
-        except Exception, e:
-            log.exception('Uncaught exception in flusher #%s (%s):', i, f)
+            schedule.removeEvent(_scheduledFlushes.pop())
+        except KeyError:
+            pass
+    L = flushers[:]
+    now = time.time()
+    for (i, f) in enumerate(L):
+        def run(f=f):
+            # It might've been removed (if its plugin was unloaded) since.
+            if f in flushers:
+                runFlusher(f)
+        when = now + float(interval) * i / len(L)
+        _scheduledFlushes.append(schedule.addEvent(run, when))
 
 def debugFlush(s=''):
     if conf.supybot.debug.flushVeryOften():
@@ -142,19 +427,27 @@ def upkeep():
             sys.stderr.reset() # Seeks to 0.
             sys.stderr.truncate() # Truncates to current offset.
     doFlush = conf.supybot.flush() and not starting
+    stagger = not dying and conf.supybot.flush.stagger()
     if doFlush:
-        flush()
+        if stagger:
+            scheduleFlushes()
+        else:
+            flush()
         # This is so registry._cache gets filled.
         # This seems dumb, so we'll try not doing it anymore.
         #if registryFilename is not None:
         #    registry.open(registryFilename)
     if not dying:
         log.debug('Regexp cache size: %s', len(sre._cache))
-        log.debug('Pattern cache size: %s', len(ircutils._patternCache))
-        log.debug('HostmaskPatternEqual cache size: %s',
-                  len(ircutils._hostmaskPatternEqualCache))
+        log.debug('Thread pool: %s', threads.stats())
+        log.debug('Flushers: %s', flushTimes.stats())
+        log.debug('Pattern cache: %s', ircutils._patternCache.stats())
+        log.debug('HostmaskPatternEqual cache: %s',
+                  ircutils._hostmaskPatternEqualCache.stats())
         #timestamp = log.timestamp()
-        if doFlush:
+        if doFlush and stagger:
+            log.info('Flushers scheduled and garbage collected.')
+        elif doFlush:
             log.info('Flushers flushed and garbage collected.')
         else:
             log.info('Garbage collected.')
@@ -30,8 +30,10 @@
 from supybot.test import *
 
 import supybot.conf as conf
+import supybot.world as world
 import supybot.utils as utils
 import supybot.ircmsgs as ircmsgs
+import supybot.registry as registry
 import supybot.callbacks as callbacks
 
 tokenize = callbacks.tokenize
@@ -276,6 +278,66 @@ class AmbiguityTestCase(PluginTestCase):
         self.irc.addCallback(self.Bar(self.irc))
         self.assertResponse('bar', 'bar.bar')
 
+class CommandTrieTestCase(PluginTestCase):
+    plugins = ('Misc',)
+    class Foo(callbacks.Plugin):
+        def bar(self, irc, msg, args):
+            irc.reply('foo.bar')
+    class Baz(callbacks.Plugin):
+        def bar(self, irc, msg, args):
+            irc.reply('baz.bar')
+    class Qux(callbacks.Plugin):
+        def getCommand(self, args):
+            if args[0].startswith('qux'):
+                return args[:1]
+            return []
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.irc.addCallback(self.Foo(self.irc))
+        self.irc.addCallback(self.Baz(self.irc))
+
+    def find(self, *args):
+        trie = callbacks.getCommandTrie(self.irc.callbacks)
+        (command, cbs) = trie.find(list(args))
+        return (command, sorted([cb.name() for cb in cbs]))
+
+    def testFind(self):
+        self.assertEqual(self.find('bar', 'x'), (['bar'], ['Baz', 'Foo']))
+        self.assertEqual(self.find('foo', 'bar', 'x'),
+                         (['foo', 'bar'], ['Foo']))
+        self.assertEqual(self.find('foo'), ([], []))
+        self.assertEqual(self.find('quxx'), ([], []))
+        self.irc.addCallback(self.Qux(self.irc))
+        self.assertEqual(self.find('quxx', 'x'), (['quxx'], ['Qux']))
+        self.assertEqual(self.find('bar'), (['bar'], ['Baz', 'Foo']))
+        self.irc.removeCallback('Baz')
+        self.assertEqual(self.find('bar'), (['bar'], ['Foo']))
+
+    def testDefaultPlugin(self):
+        defaultPlugins = conf.supybot.commands.defaultPlugins
+        conf.registerGlobalValue(defaultPlugins, 'bar',
+                                 registry.String('Baz', ''))
+        try:
+            self.assertEqual(self.find('bar'), (['bar'], ['Baz']))
+            self.assertResponse('bar', 'baz.bar')
+            defaultPlugins.bar.setValue('Foo')
+            self.assertEqual(self.find('bar'), (['bar'], ['Foo']))
+        finally:
+            defaultPlugins.unregister('bar')
+        self.assertEqual(self.find('bar'), (['bar'], ['Baz', 'Foo']))
+
+    def testDisabled(self):
+        callbacks.Commands._disabled.add('bar', 'Foo')
+        try:
+            self.assertEqual(self.find('bar'), (['bar'], ['Baz']))
+            self.assertEqual(self.find('foo', 'bar'), ([], []))
+            self.assertResponse('bar', 'baz.bar')
+        finally:
+            callbacks.Commands._disabled.remove('bar', 'Foo')
+        self.assertEqual(self.find('bar'), (['bar'], ['Baz', 'Foo']))
+
+
 class ProperStringificationOfReplyArgs(PluginTestCase):
     plugins = ('Misc',) # Same as above.
     class NonString(callbacks.Plugin):
@@ -689,7 +751,96 @@ class ProxyTestCase(SupyTestCase):
         self.failUnless(d[irc] == 'foo')
         self.failUnless(d[proxy] == 'foo')
 
+class RegistryValueTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        conf.registerPlugin('RegistryValueTest')
+        group = conf.supybot.plugins.RegistryValueTest
+        conf.registerChannelValue(group, 'foo',
+            registry.Boolean(True, 'help'))
+        conf.registerGroup(group, 'bar')
+        conf.registerGlobalValue(group.bar, 'baz',
+            registry.Integer(1, 'help'))
+        class RegistryValueTest(callbacks.Plugin):
+            pass
+        self.cb = RegistryValueTest(None)
 
+    def tearDown(self):
+        conf.supybot.plugins.unregister('RegistryValueTest')
+        SupyTestCase.tearDown(self)
+
+    def testRegistryValue(self):
+        cb = self.cb
+        self.assertEqual(cb.registryValue('bar.baz'), 1)
+        self.failUnless(cb.registryValue('foo', '#foo'))
+        self.failUnless(cb.registryValue('foo', '#foo'))
+        self.failUnless(cb.registryValue('foo', 'notachannel'))
+        self.failUnless(cb.registryValue('bar.baz', value=False) is
+                        conf.supybot.plugins.RegistryValueTest.bar.baz)
+
+    def testCachedLookupsSeeChanges(self):
+        cb = self.cb
+        for _ in range(2):
+            self.assertEqual(cb.registryValue('bar.baz'), 1)
+            self.failUnless(cb.registryValue('foo', '#foo'))
+        cb.setRegistryValue('bar.baz', 2)
+        self.assertEqual(cb.registryValue('bar.baz'), 2)
+        cb.setRegistryValue('foo', False, '#foo')
+        self.failIf(cb.registryValue('foo', '#foo'))
+        self.failUnless(cb.registryValue('foo', '#bar'))
+        # Setting the global value replaces the defaulted channel values.
+        cb.setRegistryValue('foo', False)
+        self.failIf(cb.registryValue('foo', '#bar'))
+        cb.setRegistryValue('foo', True, '#foo')
+        self.failUnless(cb.registryValue('foo', '#foo'))
+        conf.supybot.plugins.RegistryValueTest.unregister('bar')
+        self.assertRaises(registry.NonExistentRegistryEntry,
+                          cb.registryValue, 'bar.baz')
+
+class FakePool(object):
+    def __init__(self, size):
+        self.size = size
+        self.tasks = []
+
+    def submit(self, f, args=(), kwargs={}, name=None, group=None):
+        if len(self.tasks) >= self.size:
+            return False
+        self.tasks.append(f)
+        return True
+
+class ThreadCommandTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        class ThreadCommandTest(callbacks.Plugin):
+            def _callCommand(self, command, irc, msg, args):
+                pass
+        self.cb = ThreadCommandTest(None)
+        self.originalThreads = world.threads
+        world.threads = FakePool(2)
+
+    def tearDown(self):
+        world.threads = self.originalThreads
+        SupyTestCase.tearDown(self)
+
+    def testOverlappingCommands(self):
+        cb = self.cb
+        errors = []
+        class Irc(object):
+            def error(self, s):
+                errors.append(s)
+        args = (['foo'], Irc(), None, [])
+        for _ in range(3):
+            callbacks.threadCommand(cb._callCommand, args)
+        self.assertEqual(len(errors), 1)
+        self.failUnless(callbacks.isThreaded(cb))
+        (first, second) = world.threads.tasks
+        # The first one queued finishes first; the plugin mustn't stay
+        # threaded once the second is done.
+        first()
+        self.failUnless(callbacks.isThreaded(cb))
+        second()
+        self.failIf(callbacks.isThreaded(cb))
+        self.failIf(cb.threaded)
 
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,199 @@
+###
+# Copyright (c) 2002-2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+
+from supybot.test import *
+
+import os
+import threading
+
+import supybot.cdb as cdb
+
+class ReaderTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize('test.cdb')
+        maker = cdb.Maker(self.filename)
+        for i in xrange(1000):
+            maker.add('key%s' % i, 'value%s' % i)
+        maker.add('dup', 'first')
+        maker.add('dup', 'second')
+        maker.finish()
+        self.reader = cdb.Reader(self.filename)
+
+    def tearDown(self):
+        self.reader.close()
+        os.remove(self.filename)
+        SupyTestCase.tearDown(self)
+
+    def testLookup(self):
+        r = self.reader
+        self.assertEqual(len(r), 1002)
+        self.assertEqual(r['key0'], 'value0')
+        self.assertEqual(r['key999'], 'value999')
+        self.assertRaises(KeyError, r.__getitem__, 'key1000')
+        self.failUnless('key500' in r)
+        self.failIf('key1000' in r)
+        self.assertEqual(r.get('key1000', 'x'), 'x')
+
+    def testDuplicateKeys(self):
+        r = self.reader
+        self.assertEqual(r['dup'], 'first')
+        self.assertEqual(r.find('dup', loop=1), 'second')
+        self.assertRaises(KeyError, r.find, 'dup', loop=2)
+        self.assertEqual(r.findall('dup'), ['first', 'second'])
+        self.assertEqual(r.findall('key1000'), [])
+
+    def testEmpty(self):
+        filename = self.filename + '.empty'
+        cdb.Maker(filename).finish()
+        r = cdb.Reader(filename)
+        try:
+            self.assertEqual(len(r), 0)
+            self.assertEqual(list(r.iteritems()), [])
+            self.failIf('foo' in r)
+        finally:
+            r.close()
+            os.remove(filename)
+
+    def testReentrantIteration(self):
+        r = self.reader
+        n = 0
+        for (key, value) in r.iteritems():
+            self.assertEqual(r[key], r.findall(key)[0])
+            for (key2, _) in r.iteritems():
+                break
+            n += 1
+        self.assertEqual(n, 1002)
+
+    def testConcurrentLookups(self):
+        r = self.reader
+        errors = []
+        def lookup(offset):
+            for i in xrange(offset, 1000, 7):
+                if r['key%s' % i] != 'value%s' % i:
+                    errors.append(i)
+        threads = [threading.Thread(target=lookup, args=(i,))
+                   for i in xrange(7)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+
+class ReaderWriterTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize('test.cdb')
+        self.removeFiles()
+
+    def tearDown(self):
+        self.removeFiles()
+        SupyTestCase.tearDown(self)
+
+    def removeFiles(self):
+        for filename in (self.filename, self.filename + '.journal',
+                         self.filename + '.journal.compacting'):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def testReadWrite(self):
+        db = cdb.open(self.filename, 'c')
+        db['foo'] = 'bar'
+        db['baz'] = 'qux'
+        del db['foo']
+        self.failIf('foo' in db)
+        self.assertRaises(KeyError, db.__delitem__, 'foo')
+        db.flush()
+        db['foo'] = 'again'
+        self.assertEqual(db['foo'], 'again')
+        self.assertEqual(sorted(db.items()), [('baz', 'qux'), ('foo', 'again')])
+        db.close()
+        db = cdb.open(self.filename, 'r')
+        self.assertEqual(db['foo'], 'again')
+        self.assertEqual(db['baz'], 'qux')
+        db.close()
+        self.failIf(os.path.exists(self.filename + '.journal'))
+
+    def testJournalReplay(self):
+        db = cdb.open(self.filename, 'c')
+        db['foo'] = 'bar'
+        db['baz'] = 'qux'
+        db.flush()
+        del db['baz']
+        # As if a compaction had been interrupted, with more changes made
+        # after it started.
+        db.journal.close()
+        os.rename(db.journalName, db.compactingName)
+        fd = file(db.journalName, 'w')
+        fd.write('+3,1:foo->x\n+3,1:baz->y\n')
+        fd.close()
+        db = cdb.open(self.filename, 'c')
+        self.assertEqual(db['foo'], 'x')
+        self.assertEqual(db['baz'], 'y')
+        self.failIf(os.path.exists(db.compactingName))
+        db.close()
+
+    def testBackgroundCompaction(self):
+        db = cdb.open(self.filename, 'c', maxmods=10)
+        for i in xrange(100):
+            db['key%s' % i] = str(i)
+            if i % 3 == 0:
+                del db['key%s' % i]
+        compactor = db.compactor
+        if compactor is not None:
+            compactor.join()
+        self.failIf(db.frozen)
+        self.assertEqual(len(db), 66)
+        self.failIf('key0' in db)
+        self.assertEqual(db['key1'], '1')
+        db.close()
+        db = cdb.open(self.filename, 'r')
+        self.assertEqual(len(db), 66)
+        db.close()
+
+    def testLoad(self):
+        db = cdb.shelf(self.filename)
+        db['foo'] = 1
+        db['key5'] = 'old'
+        db.load(('key%s' % i, i) for i in xrange(10000))
+        db['bar'] = 2
+        self.assertEqual(len(db), 10002)
+        self.assertEqual(db['key5'], 5)
+        self.assertEqual(db['key9999'], 9999)
+        self.assertEqual(db['foo'], 1)
+        db.close()
+        db = cdb.shelf(self.filename)
+        self.assertEqual(db['bar'], 2)
+        self.assertEqual(len(db), 10002)
+        db.close()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -27,9 +27,15 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
+import re
+import new
+import sys
+import time
+
 from supybot.test import *
 
 from supybot.commands import *
+import supybot.commands as commands
 import supybot.conf as conf
 import supybot.irclib as irclib
 import supybot.ircmsgs as ircmsgs
@@ -180,5 +186,84 @@ class FirstTestCase(CommandsTestCase):
         self.assertStateErrored([first('int', 'something')], ['words'],
                                 errored=False)
 
+class ProcessPoolTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.pool = commands.ProcessPool(1)
+
+    def tearDown(self):
+        self.pool.close()
+        SupyTestCase.tearDown(self)
+
+    def testMap(self):
+        self.assertEqual(self.pool.map(len, [('foo',), ('',)]), [3, 0])
+        self.assertEqual(len(self.pool.idle), 1)
+        [e] = self.pool.map(int, [('foo',)])
+        self.failUnless(isinstance(e, Exception))
+
+    def testTimeoutReplacesWorker(self):
+        self.pool.map(len, [('',)])
+        [(p, conn, _)] = self.pool.idle
+        results = self.pool.map(time.sleep, [(0,), (10,), (0,)], timeout=1)
+        self.assertEqual(results[0], None)
+        self.failUnless(isinstance(results[1], commands.ProcessTimeoutError))
+        self.assertEqual(results[2], None)
+        self.failIf(p.is_alive())
+        self.assertEqual(len(self.pool.idle), 1)
+
+    def testUnloadableJob(self):
+        self.pool.map(len, [('',)])
+        # The worker was forked before this module existed, so it can't
+        # unpickle its functions.
+        module = new.module('supybotLateModule')
+        exec 'def double(s):\n    return s + s\n' in module.__dict__
+        sys.modules[module.__name__] = module
+        try:
+            results = self.pool.map(module.double, [('foo',), ('bar',)])
+            self.assertEqual(len(results), 2)
+            for e in results:
+                self.failUnless(isinstance(e, Exception))
+                self.failUnless('supybotLateModule' in str(e), e)
+            # The worker survives that.
+            self.assertEqual(self.pool.map(len, [('foo',)]), [3])
+            self.pool.recycle()
+            self.assertEqual(self.pool.idle, [])
+            self.assertEqual(self.pool.map(module.double, [('foo',)]),
+                             ['foofoo'])
+        finally:
+            del sys.modules[module.__name__]
+
+    def testRegexpBatch(self):
+        r = re.compile('fo+')
+        self.assertEqual(regexp_batch(['foo', 'bar', 'xfo'], r, 1, 'Foo',
+                                      'bar'),
+                         [True, False, True])
+        self.assertEqual(regexp_batch([], r, 1, 'Foo', 'bar'), [])
+        self.failUnless(regexp_wrapper('foo', r, 1, 'Foo', 'bar'))
+
+    def testProcess(self):
+        r = utils.str.perlReToReplacer('s/o/0/g')
+        self.assertEqual(process(r, 'foo', timeout=1), 'f00')
+        # Closures can't be pickled, so they still get their own process.
+        self.assertEqual(process(lambda s: s + s, 'foo', timeout=1),
+                         'foofoo')
+
+class UrlSnarfThreadTestCase(SupyTestCase):
+    def testStartQueuesToThePool(self):
+        import threading
+        import supybot.utils as utils
+        done = threading.Event()
+        L = []
+        def snarf(x):
+            L.append((x, threading.currentThread().getName()))
+            done.set()
+            raise utils.web.Error, 'Oops.'
+        t = commands.UrlSnarfThread(target=snarf, args=(1,),
+                                    url='http://example.com/')
+        t.setDaemon(True)
+        t.start()
+        done.wait(5)
+        self.assertEqual(L, [(1, 'Thread for snarfing http://example.com/')])
+
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
 
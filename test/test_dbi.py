@@ -0,0 +1,173 @@
+###
+# Copyright (c) 2002-2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+from supybot.test import *
+
+import os
+
+import supybot.dbi as dbi
+
+class IndexedMappingTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize('indexed.db')
+        self.removeFiles()
+
+    def tearDown(self):
+        self.removeFiles()
+        SupyTestCase.tearDown(self)
+
+    def removeFiles(self):
+        for suffix in ('', '.flat', '.migrating'):
+            filename = self.filename + suffix
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def testMapping(self):
+        m = dbi.IndexedMapping(self.filename)
+        self.assertEqual(m.add('foo'), 1)
+        self.assertEqual(m.add('bar'), 2)
+        self.assertEqual(m.add('baz'), 3)
+        m.set(2, 'qux')
+        m.remove(1)
+        self.assertRaises(dbi.NoRecordError, m.get, 1)
+        self.assertRaises(dbi.NoRecordError, m.remove, 1)
+        self.assertEqual(m.get(2), 'qux')
+        self.assertEqual(len(m), 2)
+        self.assertEqual(list(m), [(2, 'qux'), (3, 'baz')])
+        self.failUnless(m.random() in [(2, 'qux'), (3, 'baz')])
+        m.close()
+        m = dbi.IndexedMapping(self.filename)
+        self.assertEqual(list(m), [(2, 'qux'), (3, 'baz')])
+        # Ids aren't given out twice.
+        self.assertEqual(m.add('foo'), 4)
+        m.remove(4)
+        m.vacuum()
+        self.assertEqual(m.add('foo'), 5)
+        m.close()
+
+    def testTruncatedEntry(self):
+        m = dbi.IndexedMapping(self.filename)
+        m.add('foo')
+        m.add('bar')
+        m.close()
+        fd = file(self.filename, 'r+b')
+        fd.seek(-2, 2)
+        fd.truncate()
+        fd.close()
+        m = dbi.IndexedMapping(self.filename)
+        self.assertEqual(list(m), [(1, 'foo')])
+        self.assertEqual(m.add('baz'), 2)
+        m.close()
+        m = dbi.IndexedMapping(self.filename)
+        self.assertEqual(list(m), [(1, 'foo'), (2, 'baz')])
+        m.close()
+
+    def testCompaction(self):
+        m = dbi.IndexedMapping(self.filename)
+        m.compactionThreshold = 0
+        m.add('foo')
+        for i in xrange(100):
+            m.set(1, str(i))
+            m.add('x' * 10)
+            m.remove(i + 2)
+        m.close()
+        self.failUnless(os.path.getsize(self.filename) < 1000)
+        m = dbi.IndexedMapping(self.filename)
+        self.assertEqual(list(m), [(1, '99')])
+        self.assertEqual(m.add('bar'), 102)
+        m.close()
+
+    def testMigration(self):
+        flat = dbi.FlatfileMapping(self.filename)
+        flat.add('foo')
+        flat.add('bar')
+        flat.remove(1)
+        m = dbi.IndexedMapping(self.filename)
+        self.assertEqual(list(m), [(2, 'bar')])
+        m.close()
+        self.failUnless(os.path.exists(self.filename + '.flat'))
+
+    def testMigrationKeepsNextId(self):
+        flat = dbi.FlatfileMapping(self.filename)
+        for s in ('foo', 'bar', 'baz'):
+            flat.add(s)
+        flat.remove(3)
+        self.assertEqual(flat.currentId, 4)
+        m = dbi.IndexedMapping(self.filename)
+        self.assertEqual(m.add('qux'), 4)
+        m.close()
+        m = dbi.IndexedMapping(self.filename)
+        self.assertEqual(m.add('quux'), 5)
+        m.close()
+
+    def testInterruptedMigration(self):
+        flat = dbi.FlatfileMapping(self.filename)
+        for s in ('foo', 'bar', 'baz'):
+            flat.add(s)
+        def brokenMigrate(filename, newFilename, From, To):
+            destination = To(newFilename)
+            destination.set(1, 'foo')
+            destination.close()
+            raise KeyboardInterrupt
+        originalMigrate = dbi.migrate
+        dbi.migrate = brokenMigrate
+        try:
+            self.assertRaises(KeyboardInterrupt,
+                              dbi.IndexedMapping, self.filename)
+        finally:
+            dbi.migrate = originalMigrate
+        self.failIf(os.path.exists(self.filename))
+        m = dbi.IndexedMapping(self.filename)
+        self.assertEqual(list(m), [(1, 'foo'), (2, 'bar'), (3, 'baz')])
+        self.assertEqual(m.add('qux'), 4)
+        m.close()
+        self.failIf(os.path.exists(self.filename + '.migrating'))
+
+class DBTestCase(SupyTestCase):
+    class Record(dbi.Record):
+        __fields__ = ['text']
+
+    def testSizeAndRandom(self):
+        filename = conf.supybot.directories.data.dirize('records.db')
+        if os.path.exists(filename):
+            os.remove(filename)
+        db = dbi.DB(filename, Record=self.Record)
+        try:
+            self.assertEqual(db.random(), None)
+            for s in ('foo', 'bar'):
+                db.add(self.Record(text=s))
+            self.assertEqual(db.size(), 2)
+            self.failUnless(db.random().text in ('foo', 'bar'))
+        finally:
+            db.close()
+            os.remove(filename)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
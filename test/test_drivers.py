@@ -0,0 +1,287 @@
+###
+# Copyright (c) 2002-2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+
+from supybot.test import *
+
+import time
+import select
+import socket
+
+import supybot.conf as conf
+import supybot.drivers as drivers
+import supybot.ircmsgs as ircmsgs
+import supybot.drivers.Selector as Selector
+
+class FakeConn(object):
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buf, size):
+        if not self.chunks:
+            return 0
+        s = self.chunks.pop(0)[:size]
+        buf[:len(s)] = s
+        return len(s)
+
+class LineBufferTestCase(SupyTestCase):
+    def testFeed(self):
+        b = drivers.LineBuffer(16)
+        b.feed('foo\r\nbar')
+        self.assertEqual(list(b.lines()), ['foo\r'])
+        self.assertEqual(len(b), 3)
+        b.feed('\nbaz\n')
+        self.assertEqual(list(b.lines()), ['bar', 'baz'])
+        self.assertEqual(len(b), 0)
+        self.assertEqual(list(b.lines()), [])
+
+    def testRecvFrom(self):
+        conn = FakeConn('PING :foo\r\nPI', 'NG :bar\r\n')
+        b = drivers.LineBuffer(16)
+        self.assertEqual(b.recvFrom(conn), 13)
+        self.assertEqual(list(b.lines()), ['PING :foo\r'])
+        self.assertEqual(b.recvFrom(conn), 9)
+        self.assertEqual(list(b.lines()), ['PING :bar\r'])
+        self.assertEqual(b.recvFrom(conn), 0)
+
+    def testLongLinesGrowBuffer(self):
+        b = drivers.LineBuffer(4)
+        line = 'x' * 100
+        for c in line:
+            b.feed(c)
+            self.assertEqual(list(b.lines()), [])
+        b.feed('\n')
+        self.assertEqual(list(b.lines()), [line])
+
+    def testManyLines(self):
+        b = drivers.LineBuffer(8)
+        lines = ['line %s' % i for i in range(1000)]
+        data = '\n'.join(lines) + '\n'
+        received = []
+        for i in range(0, len(data), 7):
+            b.feed(data[i:i+7])
+            received.extend(b.lines())
+        self.assertEqual(received, lines)
+
+class BackendTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        (self.a, self.b) = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        SupyTestCase.tearDown(self)
+
+    def checkBackend(self, backend):
+        fd = self.a.fileno()
+        backend.register(fd, Selector.READ)
+        self.assertEqual(backend.poll(0), [])
+        self.b.send('foo')
+        events = backend.poll(0.1)
+        self.assertEqual([fd for (fd, event) in events], [fd])
+        self.failUnless(events[0][1] & Selector.READ)
+        self.assertEqual(self.a.recv(3), 'foo')
+        backend.modify(fd, Selector.READ | Selector.WRITE)
+        events = backend.poll(0)
+        self.assertEqual([fd for (fd, event) in events], [fd])
+        self.failUnless(events[0][1] & Selector.WRITE)
+        self.failIf(events[0][1] & Selector.READ)
+        backend.unregister(fd)
+        self.b.send('bar')
+        self.assertEqual(backend.poll(0), [])
+
+    if hasattr(select, 'epoll'):
+        def testEpollBackend(self):
+            self.checkBackend(Selector.EpollBackend())
+
+    if hasattr(select, 'poll'):
+        def testPollBackend(self):
+            self.checkBackend(Selector.PollBackend())
+
+    def testSelectBackend(self):
+        self.checkBackend(Selector.SelectBackend())
+
+    def testNewBackendFallsBack(self):
+        saved = {}
+        for name in ('epoll', 'poll'):
+            if hasattr(select, name):
+                saved[name] = getattr(select, name)
+        try:
+            if 'epoll' in saved:
+                self.failUnless(isinstance(Selector.newBackend(),
+                                           Selector.EpollBackend))
+                del select.epoll
+            if 'poll' in saved:
+                self.failUnless(isinstance(Selector.newBackend(),
+                                           Selector.PollBackend))
+                del select.poll
+            self.failUnless(isinstance(Selector.newBackend(),
+                                       Selector.SelectBackend))
+        finally:
+            for (name, f) in saved.iteritems():
+                setattr(select, name, f)
+
+
+class FakeIrc(object):
+    def __init__(self, network):
+        self.network = network
+        self.zombie = False
+        self.fastqueue = []
+        self.queue = []
+        self.msgs = []
+        self.resets = 0
+
+    def reset(self):
+        self.resets += 1
+
+    def feedMsg(self, msg):
+        self.msgs.append(msg)
+
+    def takeMsg(self):
+        if self.fastqueue:
+            return self.fastqueue.pop(0)
+
+class FakeDriver(object):
+    def __init__(self, *deadlines):
+        self.deadlines = list(deadlines)
+
+    def getDeadlines(self):
+        return self.deadlines
+
+class SelectorTestCase(SupyTestCase):
+    network = 'selectortest'
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        group = conf.registerNetwork(self.network)
+        port = self.listener.getsockname()[1]
+        group.servers.setValue(['127.0.0.1:%s' % port])
+        self.poller = Selector.Poller()
+        self.drivers = [self.poller]
+        self.conns = []
+
+    def tearDown(self):
+        for driver in self.drivers:
+            if getattr(driver, 'conn', None) is not None:
+                driver.conn.close()
+        # Nothing made here should end up in the real driver loop.
+        drivers._newDrivers[:] = [(name, driver)
+                                  for (name, driver) in drivers._newDrivers
+                                  if driver not in self.drivers]
+        for conn in self.conns:
+            conn.close()
+        self.listener.close()
+        SupyTestCase.tearDown(self)
+
+    def newDriver(self):
+        irc = FakeIrc(self.network)
+        driver = Selector.SelectorDriver(irc, poller=self.poller)
+        self.drivers.append(driver)
+        (conn, _) = self.listener.accept()
+        self.conns.append(conn)
+        return (driver, conn)
+
+    def testNoPollerMadeOnImport(self):
+        self.failIf(hasattr(Selector, 'poller'))
+
+    def testReadAndWrite(self):
+        (driver, conn) = self.newDriver()
+        self.failUnless(driver.connected)
+        self.assertEqual(self.poller.fds, {driver.conn.fileno(): driver})
+        self.assertEqual(driver.registeredMask, Selector.READ)
+        conn.send('PING :foo\r\n')
+        self.poller.run()
+        self.assertEqual(driver.irc.msgs, [ircmsgs.ping('foo')])
+        driver.irc.fastqueue.append(ircmsgs.pong('foo'))
+        driver.run()
+        self.assertEqual(conn.recv(100), 'PONG :foo\r\n')
+        self.assertEqual(driver.registeredMask, Selector.READ)
+
+    def testWriteReadiness(self):
+        (driver, conn) = self.newDriver()
+        # Fill the socket up so we have to wait for it to be writable.
+        driver.outbuffer = 'x' * (1 << 22)
+        driver._sendIfMsgs()
+        self.failUnless(driver.outbuffer)
+        self.assertEqual(driver.registeredMask,
+                         Selector.READ | Selector.WRITE)
+        left = len(driver.outbuffer)
+        conn.setblocking(0)
+        try:
+            while True:
+                conn.recv(1 << 16)
+        except socket.error:
+            pass
+        self.poller.run()
+        self.failUnless(len(driver.outbuffer) < left)
+
+    def testDisconnectAndReconnect(self):
+        (driver, conn) = self.newDriver()
+        fd = driver.conn.fileno()
+        conn.close()
+        self.poller.run()
+        self.failIf(driver.connected)
+        self.failIf(fd in self.poller.fds)
+        self.assertEqual(driver.registeredFd, None)
+        self.failUnless(driver.nextReconnectTime > time.time())
+        self.failUnless(driver.nextReconnectTime in driver.getDeadlines())
+        driver.nextReconnectTime = time.time() - 1
+        driver.run()
+        (conn, _) = self.listener.accept()
+        self.conns.append(conn)
+        self.failUnless(driver.connected)
+        self.assertEqual(driver.nextReconnectTime, None)
+        self.assertEqual(driver.irc.resets, 1)
+        self.assertEqual(self.poller.fds, {driver.conn.fileno(): driver})
+
+    def testTimeout(self):
+        timeout = conf.supybot.drivers.poll()
+        self.failUnless(self.poller.getTimeout() <= timeout)
+        self.poller.networks.add(FakeDriver(time.time() + timeout / 2))
+        self.failUnless(self.poller.getTimeout() <= timeout / 2)
+        self.poller.networks.add(FakeDriver(time.time() - 10))
+        self.assertEqual(self.poller.getTimeout(), 0)
+
+    def testReadyQueueIsADeadline(self):
+        (driver, conn) = self.newDriver()
+        self.assertEqual(driver.getDeadlines(), [])
+        driver.irc.fastqueue.append(ircmsgs.ping('foo'))
+        self.assertEqual(driver.getDeadlines(), [0])
+
+    def testReallyDie(self):
+        (driver, conn) = self.newDriver()
+        driver._reallyDie()
+        self.assertEqual(self.poller.fds, {})
+        self.failIf(driver in self.poller.networks)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -397,6 +397,32 @@ class UsersDictionaryTestCase(IrcdbTestCase):
         u2.addHostmask('*!xyzzy@baz.domain.c?m')
         self.assertRaises(ValueError, self.users.setUser, u2)
 
+    def testHostmaskChanges(self):
+        u = self.users.newUser()
+        u.name = 'foo'
+        u.addHostmask('*!*@*.domain.com')
+        self.users.setUser(u)
+        self.assertEqual(self.users.getUserId('a!b@c.domain.com'), u.id)
+        u.removeHostmask('*!*@*.domain.com')
+        u.addHostmask('*!*@*.domain.net')
+        self.users.setUser(u)
+        self.assertRaises(KeyError, self.users.getUserId, 'a!b@c.domain.com')
+        self.assertEqual(self.users.getUserId('a!b@c.domain.net'), u.id)
+        u.addAuth('a!b@c.domain.org')
+        self.users.setUser(u)
+        self.assertEqual(self.users.getUserId('a!b@c.domain.org'), u.id)
+        u.clearAuth()
+        self.users.setUser(u)
+        self.assertRaises(KeyError, self.users.getUserId, 'a!b@c.domain.org')
+        u2 = self.users.newUser()
+        u2.name = 'bar'
+        u2.addHostmask('*!b@c.domain.net')
+        self.assertRaises(ValueError, self.users.setUser, u2)
+        self.users.delUser(u.id)
+        self.assertRaises(KeyError, self.users.getUserId, 'a!b@c.domain.net')
+        self.users.setUser(u2)
+        self.assertEqual(self.users.getUserId('x!b@c.domain.net'), u2.id)
+
 
 class CheckCapabilityTestCase(IrcdbTestCase):
     filename = os.path.join(conf.supybot.directories.conf(),
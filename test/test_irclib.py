@@ -181,6 +181,66 @@ class IrcMsgQueueTestCase(SupyTestCase):
         self.assertEqual(self.mode, q.dequeue())
         self.assertEqual(self.msg, q.dequeue())
 
+    def testTargetsTakeTurns(self):
+        q = irclib.IrcMsgQueue()
+        for msg in self.msgs[:3]:
+            q.enqueue(msg)
+        others = [ircmsgs.privmsg('#BAR', str(i)) for i in range(2)]
+        notice = ircmsgs.notice('#bar', 'baz')
+        for msg in others + [notice]:
+            q.enqueue(msg)
+        self.assertEqual([q.dequeue() for _ in range(len(q))],
+                         [self.msgs[0], others[0], self.msgs[1], others[1],
+                          self.msgs[2], notice])
+        self.failIf(q)
+
+    def testPenalty(self):
+        throttle = conf.supybot.protocols.irc.throttleTime
+        burst = conf.supybot.protocols.irc.queuing.burst
+        penalties = conf.supybot.protocols.irc.queuing.penalties
+        (originalThrottle, originalBurst) = (throttle(), burst())
+        originalPenalties = penalties()
+        try:
+            throttle.setValue(10.0)
+            burst.setValue(3)
+            penalties.setValue(True)
+            q = irclib.IrcMsgQueue()
+            now = time.time()
+            self.failUnless(q.readyAt() <= now)
+            q.enqueue(self.msg)
+            q.enqueue(self.who)
+            q.enqueue(self.notice)
+            q.charge(q.dequeue())
+            # One message costs 10 seconds, and we're allowed 30.
+            self.failUnless(q.readyAt() <= time.time())
+            q.charge(q.dequeue())
+            # A WHO costs twice as much.
+            self.failUnless(q.readyAt() > time.time())
+            self.failUnless(q.readyAt() < now + 20)
+            q.reset()
+            self.failUnless(q.readyAt() <= time.time())
+        finally:
+            throttle.setValue(originalThrottle)
+            burst.setValue(originalBurst)
+            penalties.setValue(originalPenalties)
+
+    def testNoPenaltiesByDefault(self):
+        throttle = conf.supybot.protocols.irc.throttleTime
+        originalThrottle = throttle()
+        try:
+            throttle.setValue(10.0)
+            q = irclib.IrcMsgQueue()
+            now = time.time()
+            q.charge(self.who)
+            # A WHO costs no more than any other message, so the next one can
+            # go out a single throttleTime later.
+            self.failUnless(q.readyAt() < now + 11)
+            q.reset()
+            q.charge(self.msg)
+            self.failUnless(q.readyAt() > time.time())
+        finally:
+            throttle.setValue(originalThrottle)
+
 
 class ChannelStateTestCase(SupyTestCase):
     def testPickleCopy(self):
@@ -225,6 +285,106 @@ class ChannelStateTestCase(SupyTestCase):
         self.failIf('quuz' in c.voices)
 
 
+class MsgHistoryTestCase(SupyTestCase):
+    def msgs(self, n, length=10):
+        L = []
+        for i in xrange(n):
+            m = ircmsgs.privmsg('#Chan%s' % (i % 3), str(i) * length,
+                                prefix='nick%s!user@host' % (i % 2))
+            m.tag('receivedAt', float(i))
+            m.tag('receivedOn', 'net%s' % (i % 2))
+            L.append(m)
+        return L
+
+    def testRing(self):
+        msgs = self.msgs(50)
+        h = irclib.MsgHistory(10)
+        self.failIf(h)
+        for (i, m) in enumerate(msgs):
+            h.append(m)
+            self.assertEqual(len(h), min(i + 1, 10))
+            self.assertEqual(h[-1], m)
+        self.assertEqual(list(h), msgs[-10:])
+        self.assertEqual(list(reversed(h)), msgs[:-11:-1])
+        self.assertEqual(h[0], msgs[40])
+        self.assertEqual(h[2:4], msgs[42:44])
+        self.assertRaises(IndexError, h.__getitem__, 10)
+        self.assertRaises(IndexError, h.__getitem__, -11)
+        self.failUnless(msgs[-1] in h)
+        self.failIf(msgs[0] in h)
+
+    def testRebuildAfterWrapping(self):
+        # Each message is longer than the ones before, so adding one once the
+        # history is full has to rebuild it.
+        msgs = []
+        h = irclib.MsgHistory(3)
+        for i in xrange(1, 8):
+            m = ircmsgs.privmsg('#foo', str(i) * (300 * i))
+            msgs.append(m)
+            h.append(m)
+            self.assertEqual(list(h), msgs[-3:])
+
+    def testTags(self):
+        h = irclib.MsgHistory(10, self.msgs(2))
+        self.assertEqual(h[1].receivedAt, 1.0)
+        self.assertEqual(h[1].receivedOn, 'net1')
+        h.append(ircmsgs.join('#foo'))
+        self.assertEqual(h[-1].receivedAt, None)
+        self.assertEqual(h[-1].receivedOn, None)
+
+    def testLongLines(self):
+        msgs = self.msgs(20, length=400)
+        h = irclib.MsgHistory(5)
+        for m in msgs:
+            h.append(m)
+            self.failIf(len(h.lines) > 5 * 2 * len(str(m)) + 1024)
+        self.assertEqual(list(h), msgs[-5:])
+
+    def testIndexes(self):
+        h = irclib.MsgHistory(10, self.msgs(20))
+        self.assertEqual(list(h.indexes(channel='#chan1')), [0, 3, 6, 9])
+        self.assertEqual(list(h.indexes(channel='#CHAN1', nick='NICK1')),
+                         [3, 9])
+        self.assertEqual(list(h.indexes(channel='#chan1', reverse=True)),
+                         [9, 6, 3, 0])
+        self.assertEqual(list(h.indexes(command=('JOIN', 'PRIVMSG'))),
+                         range(10))
+        self.failIf(list(h.indexes(command='JOIN')))
+        self.failIf(list(h.indexes(nick='nick2')))
+        self.assertEqual([m.args[1] for m in h.scan(nick='nick0')],
+                         [str(i) * 10 for i in xrange(10, 20, 2)])
+
+    def testNamesAreDropped(self):
+        h = irclib.MsgHistory(10)
+        for i in xrange(5000):
+            h.append(ircmsgs.IrcMsg(':nick%s!u@h JOIN #chan%s' % (i, i)))
+        self.failIf(len(h.names) > 4 * 10 + 1024)
+        self.assertEqual(list(h.indexes(nick='nick4999')), [9])
+        self.assertEqual(list(h.indexes(channel='#chan4990')), [0])
+
+    def testResize(self):
+        msgs = self.msgs(20)
+        h = irclib.MsgHistory(10, msgs)
+        h.resize(5)
+        self.assertEqual(list(h), msgs[-5:])
+        h.resize(15)
+        h.extend(msgs)
+        self.assertEqual(list(h), msgs[-15:])
+
+    def testCopyAndPickle(self):
+        msgs = self.msgs(20)
+        h = irclib.MsgHistory(10, msgs)
+        h1 = h.copy()
+        self.assertEqual(h, h1)
+        h1.append(ircmsgs.join('#foo'))
+        self.assertNotEqual(h, h1)
+        self.assertEqual(list(h), msgs[-10:])
+        h1 = pickle.loads(pickle.dumps(h))
+        self.assertEqual(h, h1)
+        self.assertEqual(list(h1.indexes(nick='nick1')),
+                         list(h.indexes(nick='nick1')))
+
+
 class IrcStateTestCase(SupyTestCase):
     class FakeIrc:
         nick = 'nick'
@@ -257,6 +417,69 @@ class IrcStateTestCase(SupyTestCase):
         self.failUnless('baz' in st.channels['#foo'].users)
         self.failUnless(st.channels['#foo'].isOp('baz'))
 
+    def testQuitAndNickTaggedWithChannels(self):
+        st = irclib.IrcState()
+        for channel in ('#foo', '#bar', '#baz'):
+            st.channels[channel] = irclib.ChannelState()
+        st.channels['#foo'].addUser('bar')
+        st.channels['#bar'].addUser('@bar')
+        self.assertEqual(sorted(st.nickToChannels('bar')), ['#bar', '#foo'])
+        m = ircmsgs.IrcMsg(':bar!asfd@asdf.com NICK baz')
+        st.addMsg(self.irc, m)
+        self.assertEqual(sorted(m.tagged('channels')), ['#bar', '#foo'])
+        m = ircmsgs.IrcMsg(':baz!asfd@asdf.com QUIT :bye')
+        st.addMsg(self.irc, m)
+        self.assertEqual(sorted(m.tagged('channels')), ['#bar', '#foo'])
+        self.assertEqual(st.nickToChannels('baz'), [])
+        # A state that sees the message later doesn't overwrite the tag.
+        irclib.IrcState().addMsg(self.irc, m)
+        self.assertEqual(sorted(m.tagged('channels')), ['#bar', '#foo'])
+
+    def testNickToChannels(self):
+        st = irclib.IrcState()
+        prefix = 'bar!user@host'
+        for channel in ('#foo', '#bar', '#baz'):
+            st.addMsg(self.irc, ircmsgs.join(channel, prefix=self.irc.prefix))
+        st.addMsg(self.irc, ircmsgs.IrcMsg(command='353',
+                  args=(self.irc.nick, '=', '#foo', '@bar +baz qux')))
+        st.addMsg(self.irc, ircmsgs.join('#BAR', prefix=prefix))
+        st.addMsg(self.irc, ircmsgs.join('#baz', prefix='qux!user@host'))
+        self.assertEqual(sorted(st.nickToChannels('BAR')), ['#bar', '#foo'])
+        self.assertEqual(sorted(st.nickToChannels(self.irc.nick)),
+                         ['#bar', '#baz', '#foo'])
+        self.assertEqual(sorted(st.sharedChannels('bar', 'qux')), ['#foo'])
+        st.addMsg(self.irc, ircmsgs.part('#bar', prefix=prefix))
+        self.assertEqual(st.nickToChannels('bar'), ['#foo'])
+        st.addMsg(self.irc, ircmsgs.kick('#foo', 'bar',
+                                         prefix=self.irc.prefix))
+        self.assertEqual(st.nickToChannels('bar'), [])
+        st.addMsg(self.irc, ircmsgs.IrcMsg(':qux!user@host NICK quux'))
+        self.assertEqual(st.nickToChannels('qux'), [])
+        self.assertEqual(sorted(st.nickToChannels('quux')), ['#baz', '#foo'])
+        self.failUnless('quux' in st.channels['#baz'].users)
+        # Our own part (or kick) takes the channel out of the index.
+        st.addMsg(self.irc, ircmsgs.part('#baz', prefix=self.irc.prefix))
+        self.assertEqual(st.nickToChannels('quux'), ['#foo'])
+        st.addMsg(self.irc, ircmsgs.kick('#foo', self.irc.nick,
+                                         prefix=self.irc.prefix))
+        self.assertEqual(st.nickToChannels('quux'), [])
+        self.assertEqual(st.nickToChannels(self.irc.nick), ['#bar'])
+
+    def testNickToChannelsCopies(self):
+        st = irclib.IrcState()
+        st.channels['#foo'] = irclib.ChannelState()
+        st.channels['#foo'].addUser('bar')
+        for st1 in (st.copy(), pickle.loads(pickle.dumps(st))):
+            self.assertEqual(st1.nickToChannels('bar'), ['#foo'])
+            st1.channels['#foo'].removeUser('bar')
+            self.assertEqual(st1.nickToChannels('bar'), [])
+            self.assertEqual(st.nickToChannels('bar'), ['#foo'])
+        # Replacing a channel's state replaces its users.
+        st.channels['#FOO'] = irclib.ChannelState()
+        self.assertEqual(st.nickToChannels('bar'), [])
+        st.reset()
+        self.assertEqual(st.channels.nicks, {})
+
     def testHistory(self):
         if len(msgs) < 10:
             return
@@ -284,6 +507,28 @@ class IrcStateTestCase(SupyTestCase):
         self.assertEqual(state.supported['prefix']['o'], '@')
         self.assertEqual(state.supported['prefix']['v'], '+')
 
+    def testCasemapping005(self):
+        state = irclib.IrcState()
+        state.addMsg(self.irc, ircmsgs.join('#foo[]', prefix=self.irc.prefix))
+        state.addMsg(self.irc, ircmsgs.join('#foo[]', prefix='Bar[]!u@h'))
+        self.failUnless('#FOO{}' in state.channels)
+        self.failUnless('bar{}' in state.nicksToHostmasks)
+        state.addMsg(self.irc, ircmsgs.IrcMsg(':irc.example.net 005 nick CASEMAPPING=ascii :are supported by this server'))
+        self.assertEqual(state.supported['casemapping'], 'ascii')
+        self.failIf('#FOO{}' in state.channels)
+        self.failUnless('#FOO[]' in state.channels)
+        self.failIf('bar{}' in state.nicksToHostmasks)
+        self.failIf('bar{}' in state.channels['#foo[]'].users)
+        self.failUnless('BAR[]' in state.channels['#foo[]'].users)
+        self.assertEqual(state.nickToChannels('bar{}'), [])
+        self.assertEqual(state.nickToChannels('BAR[]'), ['#foo[]'])
+        state.addMsg(self.irc, ircmsgs.join('#new', prefix=self.irc.prefix))
+        self.failIf('nick' not in state.channels['#new'].users)
+        self.assertEqual(state.channels['#new'].users.casemapping, 'ascii')
+        state.reset()
+        state.channels['#foo[]'] = irclib.ChannelState()
+        self.failUnless('#FOO{}' in state.channels)
+
     def testIRCNet005(self):
         state = irclib.IrcState()
         # Testing IRCNet's misuse of MAXBANS
@@ -321,6 +566,35 @@ class IrcStateTestCase(SupyTestCase):
                 pass
         self.assertEqual(state, state.copy())
 
+    def testCopyOnWrite(self):
+        st = irclib.IrcState()
+        for channel in ('#foo', '#bar'):
+            st.addMsg(self.irc, ircmsgs.join(channel, prefix=self.irc.prefix))
+            st.addMsg(self.irc, ircmsgs.join(channel, prefix='foo!u@h'))
+        st1 = st.copy()
+        # Nothing is copied until it's used.
+        self.failUnless(st1.channels.data is st.channels.data)
+        self.failUnless(st1.nicksToHostmasks.data is
+                        st.nicksToHostmasks.data)
+        st.addMsg(self.irc, ircmsgs.part('#foo', prefix='foo!u@h'))
+        self.failIf('foo' in st.channels['#foo'].users)
+        self.failUnless('foo' in st1.channels['#foo'].users)
+        # #bar hasn't been touched, so it's still shared.
+        self.failUnless(st.channels.data['#bar'][1] is
+                        st1.channels.data['#bar'][1])
+        self.assertEqual(st.nickToChannels('foo'), ['#bar'])
+        self.assertEqual(sorted(st1.nickToChannels('foo')), ['#bar', '#foo'])
+        st1.addMsg(self.irc, ircmsgs.quit(prefix='foo!u@h'))
+        self.assertEqual(st1.nickToChannels('foo'), [])
+        self.failIf('foo' in st1.nicksToHostmasks)
+        self.failUnless('foo' in st.nicksToHostmasks)
+        self.failUnless('foo' in st.channels['#bar'].users)
+        self.assertEqual(st.nickToChannels('foo'), ['#bar'])
+        st1.addMsg(self.irc, ircmsgs.join('#bar', prefix='bar!u@h'))
+        self.failIf('bar' in st.channels['#bar'].users)
+        self.assertEqual(st.nickToChannels('bar'), [])
+        self.assertEqual(st1.nickToChannels('bar'), ['#bar'])
+
     def testCopyCopiesChannels(self):
         state = irclib.IrcState()
         stateCopy = state.copy()
@@ -440,6 +714,77 @@ class IrcTestCase(SupyTestCase):
         self.irc.feedMsg(msg2)
         self.assertEqual(list(self.irc.state.history), [msg1, msg2])
 
+    def testCallbacksOnlyCalledForTheirCommands(self):
+        calls = []
+        class Joins(irclib.IrcCallback):
+            def doJoin(self, irc, msg):
+                calls.append(('Joins', msg.command))
+        class Everything(irclib.IrcCallback):
+            def __call__(self, irc, msg):
+                calls.append(('Everything', msg.command))
+        class Filter(irclib.IrcCallback):
+            def inFilter(self, irc, msg):
+                calls.append(('Filter', msg.command))
+                return msg
+        irc = irclib.Irc('test', callbacks=[])
+        try:
+            irc.addCallback(Joins())
+            irc.addCallback(Everything())
+            irc.addCallback(Filter())
+            self.assertEqual(sorted([cb.name()
+                                     for cb in irc.getCallbacksFor('JOIN')]),
+                             ['Everything', 'Joins'])
+            self.assertEqual([cb.name() for cb in irc.getCallbacksFor('PING')],
+                             ['Everything'])
+            irc.feedMsg(ircmsgs.IrcMsg('PING :foo'))
+            self.assertEqual(calls, [('Filter', 'PING'), ('Everything', 'PING')])
+            irc.removeCallback('Everything')
+            del calls[:]
+            irc.feedMsg(ircmsgs.IrcMsg(':foo!bar@baz JOIN #foo'))
+            self.assertEqual(calls, [('Filter', 'JOIN'), ('Joins', 'JOIN')])
+        finally:
+            irc._reallyDie()
+
+    def testOutFilters(self):
+        seen = []
+        class Everything(irclib.IrcCallback):
+            def outFilter(self, irc, msg):
+                seen.append(('Everything', msg.command))
+                return msg
+        class Privmsgs(irclib.IrcCallback):
+            outFilterCommands = ('PRIVMSG',)
+            outFilterChannelValue = 'enabled'
+            def registryValue(self, name, channel=None):
+                return channel != '#disabled'
+            def outFilter(self, irc, msg):
+                seen.append(('Privmsgs', msg.args[0]))
+                if msg.args[1] == 'drop':
+                    return None
+                return msg
+        irc = irclib.Irc('test', callbacks=[])
+        try:
+            irc.addCallback(Everything())
+            irc.addCallback(Privmsgs())
+            self.assertEqual(len(irc.getOutFilterCallbacks('PRIVMSG')), 2)
+            self.assertEqual(len(irc.getOutFilterCallbacks('JOIN')), 1)
+            irc.sendMsg(ircmsgs.join('#foo'))
+            irc.sendMsg(ircmsgs.privmsg('#disabled', 'foo'))
+            irc.sendMsg(ircmsgs.privmsg('#foo', 'foo'))
+            for msg in [irc.takeMsg() for _ in range(3)]:
+                self.failIf(msg is None)
+            self.assertEqual(sorted(seen),
+                             [('Everything', 'JOIN'),
+                              ('Everything', 'PRIVMSG'),
+                              ('Everything', 'PRIVMSG'),
+                              ('Privmsgs', '#foo')])
+            # Dropping lots of messages in a row shouldn't recurse.
+            for _ in xrange(sys.getrecursionlimit() * 2):
+                irc.sendMsg(ircmsgs.privmsg('#foo', 'drop'))
+            irc.sendMsg(ircmsgs.privmsg('#foo', 'bar'))
+            self.assertEqual(irc.takeMsg().args[1], 'bar')
+        finally:
+            irc._reallyDie()
+
 
 class IrcCallbackTestCase(SupyTestCase):
     class FakeIrc:
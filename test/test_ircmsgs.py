@@ -127,6 +127,32 @@ class IrcMsgTestCase(SupyTestCase):
         m.tag('repliedTo', 12)
         self.assertEqual(m.repliedTo, 12)
 
+    def testTagsCopiedWithMsg(self):
+        m = ircmsgs.privmsg('foo', 'bar')
+        self.assertEqual(ircmsgs.IrcMsg(msg=m).tags, {})
+        m.tag('repliedTo')
+        m2 = ircmsgs.IrcMsg(msg=m, command='NOTICE')
+        self.failUnless(m2.repliedTo)
+        m2.tag('repliedTo', False)
+        self.failUnless(m.repliedTo)
+
+    def testParse(self):
+        m = ircmsgs.IrcMsg(':nick!~user@2001:db8::1 PRIVMSG #foo :bar baz\r\n')
+        self.assertEqual(m.prefix, 'nick!~user@2001:db8::1')
+        self.assertEqual(m.command, 'PRIVMSG')
+        self.assertEqual(m.args, ('#foo', 'bar baz'))
+        self.assertEqual((m.nick, m.user, m.host),
+                         ('nick', '~user', '2001:db8::1'))
+        m = ircmsgs.IrcMsg(':irc.server.net 353 nick = #foo :@a +b c')
+        self.assertEqual(m.args, ('nick', '=', '#foo', '@a +b c'))
+        self.assertEqual(m.nick, 'irc.server.net')
+        self.assertEqual(m.host, 'irc.server.net')
+        m = ircmsgs.IrcMsg('MODE #foo +ov  nick nick\r\n')
+        self.assertEqual(m.prefix, '')
+        self.assertEqual(m.args, ('#foo', '+ov', 'nick', 'nick'))
+        m = ircmsgs.IrcMsg('PRIVMSG #foo :')
+        self.assertEqual(m.args, ('#foo', ''))
+
 class FunctionsTestCase(SupyTestCase):
     def testIsAction(self):
         L = [':jemfinch!~jfincher@ts26-2.homenet.ohio-state.edu PRIVMSG'
@@ -31,6 +31,7 @@
 from supybot.test import *
 
 import copy
+import pickle
 import random
 
 import supybot.ircmsgs as ircmsgs
@@ -256,6 +257,10 @@ class FunctionsTestCase(SupyTestCase):
     def testToLower(self):
         self.assertEqual('jemfinch', ircutils.toLower('jemfinch'))
         self.assertEqual('{}|^', ircutils.toLower('[]\\~'))
+        self.assertEqual('{}|~', ircutils.toLower('[]\\~', 'strict-rfc1459'))
+        self.assertEqual('[]\\~', ircutils.toLower('[]\\~', 'ascii'))
+        self.assertEqual('foo', ircutils.toLower('FOO', 'ascii'))
+        self.assertRaises(ValueError, ircutils.toLower, 'foo', 'bar')
 
     def testReplyTo(self):
         prefix = 'foo!bar@baz'
@@ -332,6 +337,58 @@ class IrcDictTestCase(SupyTestCase):
         self.failUnless(d == copy.copy(d))
         self.failUnless(d == copy.deepcopy(d))
 
+    def testCasemapping(self):
+        d = ircutils.IrcDict(casemapping='ascii')
+        d['Foo[]'] = 1
+        self.assertEqual(d['foo[]'], 1)
+        self.failIf('foo{}' in d)
+        d1 = pickle.loads(pickle.dumps(d))
+        self.assertEqual(d1.casemapping, 'ascii')
+        self.failIf('foo{}' in d1)
+        d.setCasemapping('rfc1459')
+        self.assertEqual(d['FOO{}'], 1)
+        self.assertEqual(d.keys(), ['Foo[]'])
+        self.assertRaises(ValueError, d.setCasemapping, 'foo')
+
+
+class HostmaskIndexTestCase(SupyTestCase):
+    def testMatch(self):
+        index = ircutils.HostmaskIndex()
+        patterns = ['foo!bar@baz', '*!*@*.example.com', 'nick!*@*',
+                    '*!user@*', '*!*@host-?.example.net', 'Qux[]!*@*']
+        for (i, pattern) in enumerate(patterns):
+            index.add(pattern, i)
+        self.assertEqual(len(index), len(patterns))
+        def match(hostmask):
+            return sorted([value for (_, value) in index.match(hostmask)])
+        self.assertEqual(match('FOO!bar@BAZ'), [0])
+        self.assertEqual(match('x!y@www.example.com'), [1])
+        self.assertEqual(match('nick!user@www.example.com'), [1, 2, 3])
+        self.assertEqual(match('a!b@host-1.example.net'), [4])
+        self.assertEqual(match('a!b@host-10.example.net'), [])
+        self.assertEqual(match('qux{}!a@b'), [5])
+        self.assertEqual(match('foo!bar@qux'), [])
+        index.remove('*!*@*.example.com', 1)
+        self.assertEqual(match('nick!user@www.example.com'), [2, 3])
+        self.assertRaises(KeyError, index.remove, '*!*@*.example.com', 1)
+        index.clear()
+        self.assertEqual(match('nick!user@www.example.com'), [])
+        self.assertEqual(len(index), 0)
+
+    def testMatchedBy(self):
+        index = ircutils.HostmaskIndex()
+        patterns = ['foo!bar@baz.example.com', '*!*@*.example.com',
+                    'nick!*@*', 'Qux!a@b']
+        for (i, pattern) in enumerate(patterns):
+            index.add(pattern, i)
+        def matchedBy(pattern):
+            return sorted([value for (_, value) in index.matchedBy(pattern)])
+        self.assertEqual(matchedBy('*!*@*.example.com'), [0, 1])
+        self.assertEqual(matchedBy('*!bar@baz.example.c?m'), [0])
+        self.assertEqual(matchedBy('nick!*'), [2])
+        self.assertEqual(matchedBy('qux!a@b'), [3])
+        self.assertEqual(matchedBy('*!*@*.example.net'), [])
+
 
 class IrcSetTestCase(SupyTestCase):
     def test(self):
@@ -359,6 +416,20 @@ class IrcSetTestCase(SupyTestCase):
         self.failUnless('foo' in s1)
         self.failUnless('FOO' in s1)
         s1.discard('alfkj')
+
+    def testCasemapping(self):
+        s = ircutils.IrcSet(['Foo[]'], casemapping='ascii')
+        self.failUnless('FOO[]' in s)
+        self.failIf('foo{}' in s)
+        s1 = copy.deepcopy(s)
+        self.failIf('foo{}' in s1)
+        self.failUnless('foo{}' in ircutils.IrcSet(s))
+
+    def testSharedStrings(self):
+        s1 = ircutils.IrcSet(['Foo'])
+        s2 = ircutils.IrcSet(['Foo'])
+        self.failUnless(list(s1)[0] is list(s2)[0])
+        self.assertEqual(list(s1), ['Foo'])
         s1.remove('FOo')
         self.failIf('foo' in s1)
         self.failIf('FOo' in s1)
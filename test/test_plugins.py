@@ -32,3 +32,157 @@ from supybot.test import *
 
 import supybot.irclib as irclib
 import supybot.plugins as plugins
+
+import os
+import sqlite3
+import threading
+
+def connect(filename):
+    return sqlite3.connect(filename, check_same_thread=False)
+
+class SqliteDatabaseTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize('test.sqlite')
+        self.db = plugins.openSqliteDatabase(self.filename, connect=connect)
+        self.db.execute('CREATE TABLE t (k TEXT PRIMARY KEY, v INTEGER)')
+
+    def tearDown(self):
+        self.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
+        SupyTestCase.tearDown(self)
+
+    def testShared(self):
+        db = plugins.openSqliteDatabase(self.filename, connect=connect)
+        self.failUnless(db is self.db)
+        db.close()
+        self.assertEqual(self.db.query('SELECT COUNT(*) FROM t'), [(0,)])
+
+    def testReadsSeeWrites(self):
+        db = self.db
+        for i in xrange(100):
+            db.execute('INSERT INTO t VALUES (?, ?)', ('k%s' % i, i))
+        self.assertEqual(db.query('SELECT COUNT(*) FROM t'), [(100,)])
+        self.assertEqual(db.committed, db.submitted)
+        self.assertEqual(db.query('PRAGMA journal_mode'), [('wal',)])
+
+    def testTransaction(self):
+        def insert(cursor, k):
+            cursor.execute('SELECT COUNT(*) FROM t')
+            (n,) = cursor.fetchone()
+            cursor.execute('INSERT INTO t VALUES (?, ?)', (k, n))
+            return n
+        self.assertEqual(self.db.transaction(insert, 'a'), 0)
+        self.assertEqual(self.db.transaction(insert, 'b'), 1)
+        self.assertRaises(sqlite3.IntegrityError,
+                          self.db.transaction, insert, 'a')
+        self.assertEqual(self.db.query('SELECT v FROM t WHERE k=?', ('b',)),
+                         [(1,)])
+
+    def testFailedWritesAreRolledBack(self):
+        def insertAndFail(cursor, k):
+            cursor.execute('INSERT INTO t VALUES (?, ?)', (k, 0))
+            raise ValueError, k
+        db = self.db
+        db.execute('INSERT INTO t VALUES (?, ?)', ('a', 1))
+        db.submit(insertAndFail, 'b')
+        db.execute('INSERT INTO t VALUES (?, ?)', ('c', 2))
+        self.assertRaises(ValueError, db.transaction, insertAndFail, 'd')
+        db.execute('INSERT INTO t VALUES (?, ?)', ('e', 3))
+        db.sync()
+        self.assertEqual(db.query('SELECT k, v FROM t ORDER BY k'),
+                         [('a', 1), ('c', 2), ('e', 3)])
+        self.assertEqual(db.committed, db.submitted)
+
+    def testConcurrentReaders(self):
+        db = self.db
+        db.execute('INSERT INTO t VALUES (?, ?)', ('k', 1))
+        errors = []
+        def read():
+            for _ in xrange(20):
+                if db.query('SELECT v FROM t') != [(1,)]:
+                    errors.append(None)
+        threads = [threading.Thread(target=read) for _ in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.failUnless(db.openReaders <= db.maxReaders)
+
+
+class StringDB(plugins.ChannelUserDB):
+    def serialize(self, v):
+        return [v]
+
+    def deserialize(self, channel, id, L):
+        (v,) = L
+        return v
+
+class ChannelUserDBTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize('test.cudb')
+
+    def tearDown(self):
+        for filename in (self.filename, self.filename + '.journal'):
+            if os.path.exists(filename):
+                os.remove(filename)
+        SupyTestCase.tearDown(self)
+
+    def testJournal(self):
+        db = StringDB(self.filename)
+        db['#foo', 1] = 'one'
+        db['#foo', 'bar'] = 'bar'
+        db.flush()
+        # The first flush writes the file itself.
+        self.failIf(os.path.exists(db.journalName))
+        size = os.path.getsize(self.filename)
+        db['#foo', 1] = 'uno'
+        del db['#foo', 'bar']
+        db['#Baz', 2] = 'two'
+        db.flush()
+        self.assertEqual(os.path.getsize(self.filename), size)
+        self.failUnless(os.path.exists(db.journalName))
+        # Nothing changed, so nothing is written.
+        journalSize = os.path.getsize(db.journalName)
+        db.flush()
+        self.assertEqual(os.path.getsize(db.journalName), journalSize)
+        db.close()
+        db = StringDB(self.filename)
+        self.assertEqual(sorted(db.items()),
+                         [(('#Baz', 2), 'two'), (('#foo', 1), 'uno')])
+        db.close()
+
+    def testSnapshot(self):
+        db = StringDB(self.filename)
+        db.minimumJournalSize = 0
+        db['#foo', 1] = 'one'
+        db.flush()
+        for i in xrange(10):
+            db['#foo', 1] = str(i)
+            db.flush()
+        # The journal outgrew the file, so the file was rewritten.
+        self.failIf(os.path.exists(db.journalName) and
+                    os.path.getsize(db.journalName) >
+                    os.path.getsize(self.filename) * 2)
+        db.close()
+        db = StringDB(self.filename)
+        self.assertEqual(db['#foo', 1], '9')
+        db.close()
+
+    def testInPlace(self):
+        db = StringDB(self.filename)
+        db['#foo', 1] = ['one']
+        db.serialize = list
+        db.flush()
+        db['#foo', 1][0] = 'uno'
+        db.markDirty('#foo', 1)
+        db.flush()
+        db = StringDB(self.filename)
+        self.assertEqual(db['#foo', 1], 'uno')
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -30,8 +30,14 @@
 
 from supybot.test import *
 
+import os
 import time
 import pickle
+import shutil
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
 import supybot.utils as utils
 from supybot.utils.structures import *
 
@@ -74,6 +80,12 @@ class GenTest(SupyTestCase):
         self.assertEqual(d.keys(), ['Foo'])
         self.assertEqual(d.get('foo'), 10)
         self.assertEqual(d.get('Foo'), 10)
+        d1 = d.copy()
+        d1['BAR'] = 1
+        self.failIf('bar' in d)
+        del d['FOO']
+        self.assertEqual(sorted(d1.keys()), ['BAR', 'Foo'])
+        self.assertEqual(len(d), 0)
 
     def testFindBinaryInPath(self):
         if os.name == 'posix':
@@ -520,6 +532,178 @@ class WebTest(SupyTestCase):
             url = 'http://slashdot.org/'
             self.failUnless(len(utils.web.getUrl(url, 1024)) == 1024)
 
+class LocalHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = 'x' * 10000
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.clients.add(self.client_address)
+        self.server.conditional.append(self.headers.get('If-None-Match'))
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/etag')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.body)))
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            if self.path == '/etag':
+                self.send_header('ETag', '"v1"')
+            self.end_headers()
+            self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+class LocalHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    def handle_error(self, request, client_address):
+        pass # Clients closing connections we're reading from, mostly.
+
+class LocalWebTest(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.server = LocalHttpServer(('127.0.0.1', 0), LocalHttpHandler)
+        self.server.requests = []
+        self.server.clients = set()
+        self.server.conditional = []
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        utils.web.cache.clear()
+
+    def tearDown(self):
+        utils.web.connections.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        SupyTestCase.tearDown(self)
+
+    def testConnectionsAreReused(self):
+        for _ in xrange(3):
+            self.assertEqual(utils.web.getUrl(self.url + '/plain'),
+                             LocalHttpHandler.body)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.server.clients), 1)
+
+    def testSize(self):
+        self.assertEqual(utils.web.getUrl(self.url + '/plain', size=10),
+                         'x' * 10)
+        # The rest of the body wasn't read, so that connection can't be used
+        # again.
+        utils.web.getUrl(self.url + '/plain')
+        self.assertEqual(len(self.server.clients), 2)
+
+    def testRevalidation(self):
+        url = self.url + '/etag'
+        self.assertEqual(utils.web.getUrl(url, size=10), 'x' * 10)
+        self.assertEqual(utils.web.getUrl(url, size=5), 'x' * 5)
+        self.assertEqual(self.server.requests, ['/etag', '/etag'])
+        # We only had the first 10 bytes cached.
+        self.assertEqual(utils.web.getUrl(url), LocalHttpHandler.body)
+        self.assertEqual(utils.web.getUrl(url), LocalHttpHandler.body)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def testGetUrlWithHeaders(self):
+        url = self.url + '/etag'
+        for _ in xrange(2):
+            # The second time, the page comes from the cache.
+            (text, headers) = utils.web.getUrlWithHeaders(url)
+            self.assertEqual(text, LocalHttpHandler.body)
+            self.assertEqual(headers,
+                             {'content-type': 'text/plain; charset=utf-8'})
+        self.assertEqual(self.server.conditional, [None, '"v1"'])
+
+    def testCustomHeadersSkipTheCache(self):
+        url = self.url + '/etag'
+        utils.web.getUrl(url)
+        headers = {'Cookie': 'foo=bar'}
+        self.assertEqual(utils.web.getUrl(url, headers=headers),
+                         LocalHttpHandler.body)
+        self.assertEqual(utils.web.getUrl(url, headers=headers),
+                         LocalHttpHandler.body)
+        self.assertEqual(self.server.conditional, [None, None, None])
+        utils.web.getUrl(url)
+        self.assertEqual(self.server.conditional[-1], '"v1"')
+
+    def testRedirect(self):
+        fd = utils.web.getUrlFd(self.url + '/redirect')
+        try:
+            self.assertEqual(fd.geturl(), self.url + '/etag')
+            self.assertEqual(fd.headers['ETag'], '"v1"')
+        finally:
+            fd.close()
+
+    def testErrors(self):
+        self.assertRaises(utils.web.Error, utils.web.getUrl,
+                          'http://127.0.0.1:1/')
+
+class ResponseCacheTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.cache = utils.web.ResponseCache(diskSize=1000, maxAge=60)
+        self.cache.directory = self.directory
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        SupyTestCase.tearDown(self)
+
+    def store(self, url, body='x' * 200, **headers):
+        headers.setdefault('etag', '"v1"')
+        self.cache.store(url, headers, body, True)
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def testOldestFilesAreEvicted(self):
+        for i in range(10):
+            self.store('http://example.com/%s' % i)
+            # Make sure the files' mtimes are in the order they were written.
+            filename = self.cache._filename('http://example.com/%s' % i)
+            os.utime(filename, (time.time() - 10 + i, time.time() - 10 + i))
+        size = sum([os.path.getsize(os.path.join(self.directory, name))
+                    for name in self.files()])
+        self.failUnless(size <= 1000, size)
+        self.failUnless(len(self.files()) < 10)
+        self.cache.memory.clear()
+        self.failUnless(self.cache.get('http://example.com/9'))
+        self.failIf(self.cache.get('http://example.com/0'))
+
+    def testOldFilesExpire(self):
+        url = 'http://example.com/'
+        self.store(url)
+        self.cache.memory.clear()
+        self.failUnless(self.cache.get(url))
+        self.cache.memory.clear()
+        then = time.time() - 120
+        os.utime(self.cache._filename(url), (then, then))
+        self.failIf(self.cache.get(url))
+        self.assertEqual(self.files(), [])
+
+    def testClearRemovesFiles(self):
+        self.store('http://example.com/')
+        self.assertEqual(len(self.files()), 1)
+        open(os.path.join(self.directory, 'notours'), 'w').close()
+        self.cache.clear()
+        self.assertEqual(self.files(), ['notours'])
+        self.failIf(self.cache.get('http://example.com/'))
+
+    def testVary(self):
+        url = 'http://example.com/'
+        self.store(url, vary='User-Agent, Accept-Language')
+        self.failUnless(self.cache.get(url))
+        self.failIf(self.cache.get(url, {'User-agent': 'foo'}))
+        headers = dict(utils.web.defaultHeaders)
+        headers['Accept-Language'] = 'fr'
+        self.failIf(self.cache.get(url, headers))
+        self.store('http://example.com/star', vary='*')
+        self.failIf(self.cache.get('http://example.com/star'))
+
 class FormatTestCase(SupyTestCase):
     def testNormal(self):
         format = utils.str.format
@@ -1121,7 +1305,74 @@ class TestCacheDict(SupyTestCase):
             self.failUnless(len(d) <= max)
             self.failUnless(i in d)
             self.failUnless(d[i] == i)
-            
+
+    def testLeastRecentlyUsedEvicted(self):
+        d = CacheDict(3)
+        d['a'] = 1
+        d['b'] = 2
+        d['c'] = 3
+        self.assertEqual(d['a'], 1)
+        d['d'] = 4
+        self.failIf('b' in d)
+        self.assertEqual(sorted(d.keys()), ['a', 'c', 'd'])
+        d['c'] = 5
+        d['e'] = 6
+        self.failIf('a' in d)
+        self.assertEqual(sorted(d.iteritems()), [('c', 5), ('d', 4), ('e', 6)])
+        del d['d']
+        d['f'] = 7
+        d['g'] = 8
+        self.assertEqual(sorted(d), ['e', 'f', 'g'])
+        self.assertEqual(d.evictions, 3)
+        d.clear()
+        self.assertEqual(len(d), 0)
+        d['h'] = 9
+        self.assertEqual(d.items(), [('h', 9)])
+
+    def testCounters(self):
+        d = CacheDict(2)
+        d[1] = 1
+        d[1]
+        self.assertRaises(KeyError, d.__getitem__, 2)
+        self.assertEqual(d.get(3), None)
+        self.assertEqual((d.hits, d.misses, d.evictions), (1, 2, 0))
+        self.failUnless('1 hits, 2 misses' in d.stats())
+
+
+class TestMemoDict(SupyTestCase):
+    def test(self):
+        L = []
+        def f(x):
+            L.append(x)
+            return x * 2
+        d = MemoDict(f, max=2)
+        self.assertEqual(d[1], 2)
+        self.assertEqual(d[1], 2)
+        self.assertEqual(d[2], 4)
+        self.assertEqual(L, [1, 2])
+        # When it's full, what's in it is moved aside...
+        self.assertEqual(d[3], 6)
+        self.assertEqual(d.items(), [(3, 6)])
+        # ...and moved back, rather than recomputed, when it's used again.
+        self.assertEqual(d[1], 2)
+        self.assertEqual(L, [1, 2, 3])
+        # Then what wasn't used since is dropped.
+        self.assertEqual(d[4], 8)
+        self.assertEqual(sorted(d.old), [1, 3])
+        self.assertEqual(d[2], 4)
+        self.assertEqual(L, [1, 2, 3, 4, 2])
+        self.failUnless(len(d) + len(d.old) <= 2 * d.max)
+        d.clear()
+        self.assertEqual((d.items(), d.old), ([], {}))
+
+    def testBounded(self):
+        d = MemoDict(lambda x: x, max=100)
+        for i in xrange(10000):
+            d[i]
+            d[0]
+            self.failUnless(len(d) + len(d.old) <= 200)
+        self.failUnless(0 in d)
+
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
 
@@ -0,0 +1,176 @@
+###
+# Copyright (c) 2002-2005, Jeremiah Fincher
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+from supybot.test import *
+
+import time
+import threading
+
+import supybot.world as world
+import supybot.schedule as schedule
+
+class ThreadPoolTestCase(SupyTestCase):
+    def testSubmit(self):
+        pool = world.ThreadPool(2, 2, 10)
+        done = threading.Event()
+        L = []
+        def f(x):
+            L.append((x, threading.currentThread().getName()))
+            done.set()
+        self.failUnless(pool.submit(f, args=(1,), name='foo'))
+        done.wait(5)
+        self.assertEqual(L, [(1, 'foo')])
+        self.assertEqual(pool.submitted, 1)
+
+    def waitFor(self, pool, predicate):
+        deadline = time.time() + 5
+        pool.cond.acquire()
+        try:
+            while not predicate() and time.time() < deadline:
+                pool.cond.wait(deadline - time.time())
+        finally:
+            pool.cond.release()
+        self.failUnless(predicate())
+
+    def testPerGroupAndQueueSize(self):
+        pool = world.ThreadPool(3, 1, 2)
+        release = threading.Event()
+        started = []
+        began = threading.Semaphore(0)
+        finished = threading.Semaphore(0)
+        def f(x):
+            started.append(x)
+            began.release()
+            release.wait(5)
+            finished.release()
+        self.failUnless(pool.submit(f, args=(1,), group='Foo'))
+        self.failUnless(pool.submit(f, args=(2,), group='Foo'))
+        self.failUnless(pool.submit(f, args=(3,), group='Bar'))
+        began.acquire()
+        began.acquire()
+        # Foo can only run one task at once; 2 waits.
+        self.assertEqual(sorted(started), [1, 3])
+        self.assertEqual(pool.running, {'Foo': 1, 'Bar': 1})
+        self.assertEqual([task[1] for task in pool.queue], [(2,)])
+        self.failUnless(pool.submit(f, args=(4,), group='Foo'))
+        self.failIf(pool.submit(f, args=(5,), group='Bar'))
+        self.assertEqual(pool.rejected, 1)
+        release.set()
+        for _ in range(4):
+            finished.acquire()
+        self.assertEqual(sorted(started), [1, 2, 3, 4])
+        # The last task may not have been accounted for yet.
+        self.waitFor(pool, lambda: pool.completed == 4)
+
+    def testExceptionsDontKillThreads(self):
+        pool = world.ThreadPool(1, 1, 10)
+        done = threading.Event()
+        def f():
+            raise Exception, 'Oops.'
+        pool.submit(f)
+        pool.submit(done.set)
+        done.wait(5)
+        self.failUnless(done.isSet())
+        self.assertEqual(pool.threads, 1)
+
+class FlushTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.flushers = world.flushers[:]
+        world.flushers[:] = []
+        world.flushTimes.clear()
+
+    def tearDown(self):
+        world.flushers[:] = self.flushers
+        SupyTestCase.tearDown(self)
+
+    def testFlush(self):
+        L = []
+        def written():
+            L.append(threading.currentThread().getName())
+        def flusher():
+            L.append(threading.currentThread().getName())
+            return written
+        def noWrites():
+            L.append('noWrites')
+        world.flushers.extend([flusher, noWrites])
+        world.flush()
+        main = threading.currentThread().getName()
+        # The write may happen before or after noWrites runs.
+        self.assertEqual(L[0], main)
+        self.assertEqual(sorted(L[1:]), ['Flush writer', 'noWrites'])
+        stats = world.flushTimes.stats()
+        self.failUnless('flusher: 1 runs' in stats, stats)
+        self.failUnless('noWrites: 1 runs' in stats, stats)
+
+    def testExceptions(self):
+        L = []
+        def broken():
+            raise Exception, 'Oops.'
+        def brokenWrite():
+            def write():
+                raise Exception, 'Oops.'
+            return write
+        world.flushers.extend([broken, brokenWrite,
+                               lambda: lambda: L.append(1)])
+        world.flush()
+        self.assertEqual(L, [1])
+
+    def testFlusherName(self):
+        class Db(object):
+            filename = '/foo/bar.db'
+            def snapshot(self):
+                pass
+        self.assertEqual(world.flusherName(Db().snapshot),
+                         'Db.snapshot (bar.db)')
+
+    def testScheduleFlushes(self):
+        L = []
+        def first():
+            L.append(1)
+        def second():
+            L.append(2)
+        world.flushers.extend([first, second])
+        world.scheduleFlushes(100)
+        try:
+            schedule.run()
+            world.flushWriter.wait()
+            # The second isn't due for another 50 seconds.
+            self.assertEqual(L, [1])
+            # Removed flushers aren't run.
+            world.flushers.remove(second)
+            schedule.rescheduleEvent(world._scheduledFlushes[1], 0)
+            schedule.run()
+            self.assertEqual(L, [1])
+        finally:
+            world.scheduleFlushes(0)
+            schedule.run()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79: